@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        # register the checks and the metrics, connect the signal receivers
+        from . import checks, fanout, recent, write_behind  # noqa: F401
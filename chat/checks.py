@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.checks import Error, register
+from django.db import connection
+
+# the backends whose entries only the process sees
+PROCESS_CACHES = ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache')
+
+
+@register()
+def check_snapshot_cache(app_configs, **kwargs):
+    """the versions of the chat snapshots must be seen by every worker, or their snapshots are never invalidated"""
+    alias = getattr(settings, 'CHAT_SNAPSHOT_CACHE', 'default')
+    if alias not in settings.CACHES:
+        return [Error(f'CHAT_SNAPSHOT_CACHE {alias!r} is not a cache of CACHES', id='chat.E001')]
+    backend = settings.CACHES[alias]['BACKEND']
+    if backend in PROCESS_CACHES:
+        return [Error(f'CHAT_SNAPSHOT_CACHE {alias!r} is a cache of the process ({backend}), the workers would '
+                      f'serve stale chat snapshots',
+                      hint='use a cache shared by the workers, e.g. django.core.cache.backends.redis.RedisCache, '
+                           'or silence chat.E001 with a single worker',
+                      id='chat.E001')]
+    return []
+
+
+@register()
+def check_write_behind_database(app_configs, **kwargs):
+    """the write-behind reserves the ids of the messages from their postgres sequence"""
+    if getattr(settings, 'CHAT_WRITE_BEHIND', False) and connection.vendor != 'postgresql':
+        return [Error(f'CHAT_WRITE_BEHIND needs a postgresql database, not {connection.vendor}',
+                      hint='set CHAT_WRITE_BEHIND = False, the messages are then saved by the consumers',
+                      id='chat.E002')]
+    return []
@@ -1,41 +1,71 @@
 import asyncio
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
 
 
 from channels.db import database_sync_to_async
 
 from .models import Chat, Msg
 from . import serializers
-from multiprocessing import Lock
+from .fanout import SendQueue
+from .history import history_page
+from .recent import recent_messages
+from .write_behind import msg_writer, write_behind_enabled
+from django.core.exceptions import ValidationError
+from rest_framework.exceptions import NotFound
+from store.metrics import instrument
 
 
-listeners_dic = {}
+def chat_group(chat_id):
+    """the channel layer group of the consumers connected to the chat, on every worker"""
+    return f'chat.{chat_id}'
 
 
-class PracticeConsumer(AsyncWebsocketConsumer):
+async def broadcast(chat_id, text):
+    """send text to every consumer connected to the chat, whatever its worker"""
+    await get_channel_layer().group_send(chat_group(chat_id), {'type': 'chat.message', 'text': text})
+
 
+class PracticeConsumer(AsyncWebsocketConsumer):
     def __init__(self):
-        self.msgs_number = 0  # to keep tracking on how many msgs are loaded, so it know what to load more if requested
         self.chat_id = None
-        self.listeners_dic_id = None
+        # the messages of the chat group wait there until they are sent to this client
+        self.outbox = None
         super().__init__()
 
     @database_sync_to_async
     def get_chat(self):
         return json.dumps(serializers.ChatSerializer(Chat.objects.get(pk=self.chat_id)).data).encode('utf-8')
 
-    @database_sync_to_async
-    def send_new_msg(self, msg):
+    @instrument('new', query_budget=2)
+    def new_msg(self, msg, msg_id=None):
         msg_obj = Msg(chat_id=Chat(id=self.chat_id), msg=msg, sender=self.scope['user'])
-        msg_obj.save()
+        if write_behind_enabled():
+            # written later in a batch, broadcast now
+            msg_writer.add(msg_obj, msg_id)
+        else:
+            msg_obj.save()
         response = {
             'type': 'new',
             'msg': serializers.MsgSerializer(msg_obj).data}
         return json.dumps(response)
 
+    async def send_new_msg(self, msg):
+        if write_behind_enabled():
+            msg_id = msg_writer.take_id()
+            if msg_id is not None:
+                # a reserved id, no query: neither a thread nor a database connection is needed
+                return self.new_msg(msg, msg_id)
+        return await database_sync_to_async(self.new_msg)(msg)
+
+    # one more query for the flush of the write-behind
     @database_sync_to_async
+    @instrument('update', query_budget=4)
     def update_msg(self, msg_id, msg):
+        if write_behind_enabled():
+            # the message may not be written yet
+            msg_writer.flush()
         msg_obj = Msg.objects.get(id=msg_id)
         if msg_obj.sender.id != self.scope['user'].id:
             raise Exception('user not allow to change this msg!')
@@ -46,8 +76,12 @@ class PracticeConsumer(AsyncWebsocketConsumer):
             'msg': serializers.MsgSerializer(msg_obj).data}
         return json.dumps(response)
 
+    # one more query for the flush of the write-behind
     @database_sync_to_async
+    @instrument('delete', query_budget=4)
     def delete_msg(self, msg_id):
+        if write_behind_enabled():
+            msg_writer.flush()
         msg_obj = Msg.objects.get(id=msg_id)
         if msg_obj.sender.id != self.scope['user'].id:
             raise Exception('user not allow to change this msg!')
@@ -58,57 +92,69 @@ class PracticeConsumer(AsyncWebsocketConsumer):
         return json.dumps(response)
 
     @database_sync_to_async
-    def is_user_allowed(self):
-        return self.scope['user'].chats.contains(Chat(pk=self.chat_id))
-
-    @staticmethod
-    async def broadcast(msg, chat_id):
-        for listener in listeners_dic[chat_id]['listeners'].values():
-            await listener.send(msg)
-
+    @instrument('history', query_budget=1)
+    def get_history(self, cursor, page_size):
+        msgs, next_cursor = history_page(self.chat_id, cursor, page_size)
+        return json.dumps({'type': 'history', 'msgs': serializers.MsgSerializer(msgs, many=True).data,
+                           'next': next_cursor})
+
+    async def chat_message(self, event):
+        """a message broadcast to the chat group, queued so a slow client doesn't hold the others"""
+        if self.outbox is not None:
+            self.outbox.put(event['text'])
+
+    # the membership, then the chat, its members and its messages when the snapshot isn't cached
     @database_sync_to_async
-    def get_chat_as_str(self):
-        return json.dumps(serializers.ChatSerializer(Chat.objects.get(pk=self.chat_id)).data)
+    @instrument('connect', query_budget=4)
+    def get_snapshot(self):
+        """the snapshot of the chat, None when the user isn't one of its members"""
+        # the membership from the database, the snapshot is cached
+        if not self.scope['user'].chats.filter(pk=self.chat_id).exists():
+            return None
+        return recent_messages.snapshot(self.chat_id)
 
     async def websocket_connect(self, event):
         self.chat_id = self.scope['url_route']['kwargs']['id']
 
-        if not await self.is_user_allowed():
+        # joined before the snapshot is taken so no message falls in between, left by websocket_disconnect
+        self.groups.append(chat_group(self.chat_id))
+        await self.channel_layer.group_add(chat_group(self.chat_id), self.channel_name)
+
+        snapshot = await self.get_snapshot()
+        if snapshot is None:
+            await self.channel_layer.group_discard(chat_group(self.chat_id), self.channel_name)
             await self.close()
             return
 
-        if self.chat_id in listeners_dic:
-            with listeners_dic[self.chat_id]['lock']:
-                self.listeners_dic_id = listeners_dic[self.chat_id]['serial_id']
-                listeners_dic[self.chat_id]['serial_id'] += 1
-                listeners_dic[self.chat_id]['listeners'][self.listeners_dic_id] = self
-        else:
-            listeners_dic[self.chat_id] = {}
-            listeners_dic[self.chat_id]['lock'] = Lock()
-            with listeners_dic[self.chat_id]['lock']:
-                self.listeners_dic_id = 1
-                listeners_dic[self.chat_id]['serial_id'] = 2
-                listeners_dic[self.chat_id]['listeners'] = {self.listeners_dic_id: self}
-
         await self.accept()
 
-        await self.send(await self.get_chat_as_str())
+        await self.send(json.dumps(snapshot))
+        # the messages broadcast meanwhile wait for this consumer to process them, after the snapshot
+        self.outbox = SendQueue(self.send, self.close)
+        self.outbox.start()
 
     async def websocket_receive(self, event):
 
         my_obj = json.loads(event['text'])
         method = my_obj['method']
         msg = ''
+        if method == 'history':
+            # older messages, only for this client: {"method": "history", "cursor": .., "page_size": ..}
+            try:
+                page_size = int(my_obj.get('page_size') or 0)
+                await self.send(await self.get_history(my_obj.get('cursor'), page_size))
+            except (ValueError, ValidationError, NotFound):
+                await self.send(json.dumps({'type': 'error', 'error': 'invalid history request'}))
+            return
         if method=='new':
             msg = await self.send_new_msg(my_obj['msg'])
         elif method=='update':
             msg = await self.update_msg(my_obj['id'], my_obj['msg'])
         elif method=='delete':
             msg = await self.delete_msg(my_obj['id'])
-        await self.broadcast(msg, self.chat_id)
+        await broadcast(self.chat_id, msg)
 
     async def websocket_disconnect(self, event):
-        listeners_dic[self.chat_id]['listeners'].pop(self.listeners_dic_id)
-        if len(listeners_dic[self.chat_id]['listeners']) == 0:
-            with listeners_dic[self.chat_id]['lock']:
-                listeners_dic.pop(self.chat_id)
+        if self.outbox is not None:
+            await self.outbox.stop()
+        await super().websocket_disconnect(event)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import weakref
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from store.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# what happens to a message for a connection whose queue is full
+SLOW_CONSUMER_POLICIES = ('drop-oldest', 'drop-newest', 'disconnect')
+# going away, try again later
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class FanoutStats:
+    """the counters of the send queues of the process"""
+
+    def __init__(self):
+        self.queues = weakref.WeakSet()
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.dropped = 0
+        self.disconnected = 0
+
+    def prometheus(self):
+        depths = [queue.depth() for queue in list(self.queues) if queue.task is not None]
+        return '\n'.join([
+            '# HELP websocket_connections websocket connections with a send queue',
+            '# TYPE websocket_connections gauge',
+            f'websocket_connections {len(depths)}',
+            '# HELP websocket_send_queue_depth messages waiting in the send queues',
+            '# TYPE websocket_send_queue_depth gauge',
+            f'websocket_send_queue_depth {sum(depths)}',
+            '# HELP websocket_send_queue_max_depth messages waiting in the fullest send queue',
+            '# TYPE websocket_send_queue_max_depth gauge',
+            f'websocket_send_queue_max_depth {max(depths, default=0)}',
+            '# HELP websocket_messages_sent_total messages sent from the send queues',
+            '# TYPE websocket_messages_sent_total counter',
+            f'websocket_messages_sent_total {self.sent}',
+            '# HELP websocket_messages_dropped_total messages dropped because a send queue was full',
+            '# TYPE websocket_messages_dropped_total counter',
+            f'websocket_messages_dropped_total {self.dropped}',
+            '# HELP websocket_slow_consumers_disconnected_total connections closed because their send queue was full',
+            '# TYPE websocket_slow_consumers_disconnected_total counter',
+            f'websocket_slow_consumers_disconnected_total {self.disconnected}',
+        ]) + '\n'
+
+
+fanout_stats = FanoutStats()
+metrics.register(fanout_stats.prometheus)
+
+
+class SendQueue:
+    """
+    the bounded outbound queue of a websocket connection, drained by its own task so a slow client only
+    delays its own messages. put never waits, when the queue is full the message is handled according to
+    WEBSOCKET_SLOW_CONSUMER_POLICY: the oldest or the new message is dropped, or the connection is closed
+    """
+
+    def __init__(self, send, close, size=None, policy=None):
+        self.send = send
+        self.close = close
+        self.size = size or getattr(settings, 'WEBSOCKET_SEND_QUEUE_SIZE', 100)
+        self.policy = policy or getattr(settings, 'WEBSOCKET_SLOW_CONSUMER_POLICY', 'drop-oldest')
+        if self.policy not in SLOW_CONSUMER_POLICIES:
+            raise ImproperlyConfigured(f'WEBSOCKET_SLOW_CONSUMER_POLICY must be one of {SLOW_CONSUMER_POLICIES}')
+        self.queue = asyncio.Queue(self.size)
+        self.task = None
+        self.closing = False
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._drain())
+        fanout_stats.queues.add(self)
+
+    async def stop(self):
+        fanout_stats.queues.discard(self)
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # the disconnect of the consumer goes on
+                logger.exception('the send queue of a websocket connection failed')
+            self.task = None
+
+    def put(self, text):
+        if self.closing:
+            return
+        if self.queue.full():
+            if self.policy == 'disconnect':
+                fanout_stats.disconnected += 1
+                self.closing = True
+                asyncio.ensure_future(self.close(code=SLOW_CONSUMER_CLOSE_CODE))
+                return
+            fanout_stats.dropped += 1
+            if self.policy == 'drop-newest':
+                return
+            self.queue.get_nowait()
+        self.queue.put_nowait(text)
+
+    async def _drain(self):
+        try:
+            while True:
+                text = await self.queue.get()
+                await self.send(text)
+                fanout_stats.sent += 1
+        except Exception:
+            # e.g. the client went away, the next messages are ignored and the connection is closed
+            logger.exception('sending to a websocket connection failed, it is closed')
+            self.closing = True
+            await self.close()
@@ -0,0 +1,42 @@
+from django.conf import settings
+from rest_framework.exceptions import NotFound
+
+from store.pagination import ResultsSetPagination
+from .models import Msg
+
+# newest first, the id breaks the ties of the messages sent at the same time, see the msg_chat_history_idx index
+HISTORY_ORDERING = ('-time_sent', '-id')
+
+
+class MessageHistoryPagination(ResultsSetPagination):
+    """keyset pages of the messages of a chat, newest first, without a cursor the first page"""
+
+    def __init__(self):
+        self.page_size = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 20)
+        self.max_page_size = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 100)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.ordering = HISTORY_ORDERING
+        return self.paginate_keyset(queryset, request)
+
+
+def history_page(chat_id, cursor=None, page_size=None):
+    """
+    the page of messages of the chat older than cursor (the newest ones without it) and the cursor of the next
+    page, None on the last one. the cursors are the ones of the REST history, raises NotFound for an invalid one
+    """
+    paginator = MessageHistoryPagination()
+    paginator.ordering = HISTORY_ORDERING
+    page_size = max(1, min(page_size or paginator.page_size, paginator.max_page_size))
+    msgs = Msg.objects.filter(chat_id=chat_id).select_related('sender').order_by(*paginator.keyset_order(Msg, False))
+    if cursor:
+        values, reverse = paginator.decode_cursor(cursor)
+        if reverse:
+            raise NotFound(paginator.invalid_cursor_message)
+        msgs = msgs.filter(paginator.keyset_filter(Msg, values, False))
+    msgs = list(msgs[:page_size + 1])
+    if len(msgs) <= page_size:
+        return msgs, None
+    msgs = msgs[:page_size]
+    return msgs, paginator.cursor_token(paginator.row_values(msgs[-1]), False)
+
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.1 on 2026-10-18 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chat_admin_chat_group'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='msg',
+            index=models.Index(fields=['chat_id', '-time_sent', '-id'], name='msg_chat_history_idx'),
+        ),
+    ]
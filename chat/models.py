@@ -20,6 +20,10 @@ class Msg (models.Model):
 
     class Meta:
         ordering = ["-time_sent"]
+        indexes = [
+            # the pages of the history of a chat, see chat.history
+            models.Index(fields=["chat_id", "-time_sent", "-id"], name="msg_chat_history_idx"),
+        ]
 
     def __str__(self):
         return f"{self.time_sent} {self.sender}: {self.msg}"
@@ -4,6 +4,7 @@ from .models import Chat
 
 class IsChatMember(permissions.BasePermission):
     def has_permission(self, request, view):
+        # the members of the cached snapshots may be stale, a removed member would keep its access
         chat_id = view.kwargs.get('pk', None)
         user = request.user
         return user.chats.contains(Chat(pk=chat_id))
@@ -0,0 +1,210 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils.dateparse import parse_datetime
+
+from restsite.serializers import plain
+from store.metrics import metrics
+from .history import MessageHistoryPagination
+from .models import Chat, Msg
+from . import serializers
+
+
+def history_key(msg):
+    """the place of a serialized message in the history, see HISTORY_ORDERING"""
+    return parse_datetime(msg['time_sent']), msg['id']
+
+
+class Snapshot:
+    """the chat, its members and a ring buffer of its latest serialized messages, newest first"""
+
+    def __init__(self, data, version, size):
+        self.chat = {'id': data['id'], 'name': data['name'], 'users': list(data['users'])}
+        self.msgs = deque(plain(data['msgs']), maxlen=size)
+        # whether the history goes on after the oldest buffered message
+        self.has_older = data['history'] is not None
+        self.version = version
+        self.loaded = time.monotonic()
+
+    def data(self):
+        msgs = list(self.msgs)
+        history = None
+        if self.has_older and msgs:
+            # the cursor of the history page after the oldest buffered message
+            history = MessageHistoryPagination().cursor_token(list(history_key(msgs[-1])), False)
+        return {**self.chat, 'history': history, 'msgs': msgs}
+
+    def add(self, msg):
+        """insert msg at its place in the history order, or replace the buffered message with its id"""
+        if not self.msgs or history_key(msg) > history_key(self.msgs[0]):
+            if len(self.msgs) == self.msgs.maxlen:
+                self.has_older = True
+            self.msgs.appendleft(msg)
+            return True
+        # a message sent before the newest one but written after it, e.g. by the write-behind
+        msgs = [buffered for buffered in self.msgs if buffered['id'] != msg['id']]
+        position = next((i for i, buffered in enumerate(msgs) if history_key(buffered) < history_key(msg)), len(msgs))
+        msgs.insert(position, msg)
+        self.has_older = self.has_older or len(msgs) > self.msgs.maxlen
+        self.msgs = deque(msgs[:self.msgs.maxlen], maxlen=self.msgs.maxlen)
+        return True
+
+    def update(self, msg):
+        for i, buffered in enumerate(self.msgs):
+            if buffered['id'] == msg['id']:
+                self.msgs[i] = msg
+        return True
+
+    def delete(self, msg_id):
+        # the buffer can't be refilled without the database, the next snapshot reloads it
+        return all(buffered['id'] != msg_id for buffered in self.msgs)
+
+
+class RecentMessages:
+    """
+    the connect snapshots of the chats, in a bounded in-process LRU (CHAT_SNAPSHOT_CHATS chats) served
+    without a query. the message writes of this worker are applied to its snapshots, the other workers
+    see the version of the chat in the cache alias CHAT_SNAPSHOT_CACHE (shared by the workers, e.g. redis)
+    move past the one of their snapshot and reload it. a snapshot is reloaded at the latest
+    CHAT_SNAPSHOT_TIMEOUT seconds after it was loaded, the versions expire after as many seconds without
+    a write. the members of a snapshot are only shown, the permissions ask the database
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.stats = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def shared():
+        return caches[getattr(settings, 'CHAT_SNAPSHOT_CACHE', 'default')]
+
+    @staticmethod
+    def version_key(chat_id):
+        return f'chat-snapshot:{chat_id}'
+
+    @staticmethod
+    def timeout():
+        return getattr(settings, 'CHAT_SNAPSHOT_TIMEOUT', 300)
+
+    def snapshot(self, chat_id):
+        """{'id', 'name', 'users', 'history', 'msgs'} of the chat, as ChatSerializer has it, None if it doesn't exist"""
+        chat_id = int(chat_id)
+        # None once the version expired, no write to the chat for a while
+        version = self.shared().get(self.version_key(chat_id))
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is not None and entry.version == version and time.monotonic() - entry.loaded < self.timeout():
+                self.entries.move_to_end(chat_id)
+                self.stats['hits'] += 1
+                return entry.data()
+            self.stats['misses'] += 1
+        try:
+            chat = Chat.objects.get(pk=chat_id)
+        except Chat.DoesNotExist:
+            return None
+        entry = Snapshot(serializers.ChatSerializer(chat).data, version, getattr(settings, 'CHAT_RECENT_MESSAGES', 5))
+        with self.lock:
+            self.entries[chat_id] = entry
+            self.entries.move_to_end(chat_id)
+            while len(self.entries) > getattr(settings, 'CHAT_SNAPSHOT_CHATS', 1000):
+                self.entries.popitem(last=False)
+        return entry.data()
+
+    def prometheus(self):
+        with self.lock:
+            stats, size = dict(self.stats), len(self.entries)
+        return '\n'.join([
+            '# HELP chat_snapshot_hits_total chat snapshots served from the in-process cache',
+            '# TYPE chat_snapshot_hits_total counter',
+            f'chat_snapshot_hits_total {stats["hits"]}',
+            '# HELP chat_snapshot_misses_total chat snapshots loaded from the database',
+            '# TYPE chat_snapshot_misses_total counter',
+            f'chat_snapshot_misses_total {stats["misses"]}',
+            '# HELP chat_snapshot_entries chats of the in-process snapshot cache',
+            '# TYPE chat_snapshot_entries gauge',
+            f'chat_snapshot_entries {size}',
+        ]) + '\n'
+
+    def bump(self, chat_id):
+        """the next version of the chat, every worker's snapshot of the previous ones is stale"""
+        shared, key, timeout = self.shared(), self.version_key(chat_id), self.timeout()
+        # an expired version starts over from a value none of the snapshots has
+        start = time.time_ns()
+        if shared.add(key, start, timeout):
+            return start
+        try:
+            version = shared.incr(key)
+        except ValueError:
+            # expired meanwhile
+            shared.set(key, start, timeout)
+            return start
+        shared.touch(key, timeout)
+        return version
+
+    def apply(self, chat_id, change):
+        """
+        record a change of the chat, change(snapshot) applies it to the local snapshot and returns False
+        when it can't. a snapshot which missed a change of another worker is dropped
+        """
+        version = self.bump(chat_id)
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is None:
+                return
+            if entry.version == version - 1 and change(entry):
+                entry.version = version
+            else:
+                del self.entries[chat_id]
+
+    def on_commit(self, chat_id, change):
+        # a rolled back write changes nothing
+        transaction.on_commit(lambda: self.apply(chat_id, change))
+
+
+recent_messages = RecentMessages()
+metrics.register(recent_messages.prometheus)
+
+
+@receiver(post_save, sender=Msg)
+def msg_saved(sender, instance, created, **kwargs):
+    msg = plain(serializers.MsgSerializer(instance).data)
+    recent_messages.on_commit(instance.chat_id_id, (lambda entry: entry.add(msg)) if created else
+                              (lambda entry: entry.update(msg)))
+
+
+@receiver(post_delete, sender=Msg)
+def msg_deleted(sender, instance, **kwargs):
+    msg_id = instance.id
+    recent_messages.on_commit(instance.chat_id_id, lambda entry: entry.delete(msg_id))
+
+
+@receiver(post_save, sender=Chat)
+@receiver(post_delete, sender=Chat)
+def chat_changed(sender, instance, **kwargs):
+    recent_messages.on_commit(instance.pk, lambda entry: False)
+
+
+@receiver(m2m_changed, sender=Chat.users.through)
+def chat_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        chat_ids = [instance.pk]
+    elif action == 'pre_clear':
+        # from user.chats.clear(), the instance is a user
+        chat_ids = list(instance.chats.values_list('pk', flat=True))
+    else:
+        chat_ids = pk_set
+    for chat_id in chat_ids:
+        recent_messages.on_commit(chat_id, lambda entry: False)
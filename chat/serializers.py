@@ -1,6 +1,15 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import Chat, Msg
 from django.contrib.auth.models import User
+from restsite.serializers import BatchListSerializer, get_loader, group_by
+from .history import history_page
+
+
+def load_chat_usernames(chat_ids):
+    members = Chat.users.through.objects.filter(chat_id__in=chat_ids).order_by('id')\
+        .values_list('chat_id', 'user__username')
+    return group_by(members, lambda row: row[0], lambda row: row[1])
 
 
 class ChatListSerializer(serializers.ModelSerializer):
@@ -10,13 +19,18 @@ class ChatListSerializer(serializers.ModelSerializer):
         read_only_fields = ['id']
         write_only_fields = ['group', 'admin']
         optional_fields = ['group', 'name']
+        # the usernames are added by to_representation
+        extra_kwargs = {'users': {'write_only': True}}
+        list_serializer_class = BatchListSerializer
+
+    def prime_loaders(self, instances):
+        get_loader(self.context, 'chat_usernames', load_chat_usernames, ()).prime(chat.pk for chat in instances)
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
 
         # adding msgs
-        users = instance.users.all()
-        data['users'] = [user.username for user in users]
+        data['users'] = list(get_loader(self.context, 'chat_usernames', load_chat_usernames, ()).load(instance.pk))
         return data
 
     def get_usernames(self, obj):
@@ -54,8 +68,8 @@ class ChatSerializer(serializers.ModelSerializer):
     def to_representation(self, instance):
         data = super().to_representation(instance)
 
-        # adding msgs
-        msgs = Msg.objects.filter(chat_id=data['id'])[:5]
+        # adding msgs, the older ones are loaded with the cursor of the history
+        msgs, data['history'] = history_page(data['id'], page_size=getattr(settings, 'CHAT_RECENT_MESSAGES', 5))
         data['msgs'] = [MsgSerializer(msg).data for msg in msgs]
         return data
 
@@ -0,0 +1,295 @@
+import asyncio
+import json
+
+import pytest
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .fixtures import create_user, create_superuser
+from ..consumers import chat_group
+from ..fanout import SendQueue, fanout_stats
+from ..models import Chat, Msg
+from ..recent import recent_messages
+from ..serializers import ChatSerializer, MsgSerializer
+
+
+async def connect(user, chat):
+    from restsite.routing import application
+    communicator = WebsocketCommunicator(application, f'chat/{chat.pk}/', headers=[
+        (b'authorization', f'Bearer {AccessToken.for_user(user)}'.encode())])
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+@pytest.fixture
+def chat(create_user, create_superuser):
+    chat = Chat.objects.create(name='chat')
+    chat.users.add(create_user, create_superuser)
+    return chat
+
+
+# the consumers query the database from other threads, they must see the committed rows
+@pytest.mark.django_db(transaction=True)
+def test_messages_are_broadcast_to_the_chat_group(chat, create_user, create_superuser):
+    async def run():
+        sender, listener = await connect(create_user, chat), await connect(create_superuser, chat)
+        for communicator in (sender, listener):
+            assert json.loads(await communicator.receive_from())['id'] == chat.pk
+
+        await sender.send_to(text_data=json.dumps({'method': 'new', 'msg': 'hello'}))
+        for communicator in (sender, listener):
+            message = json.loads(await communicator.receive_from())
+            assert (message['type'], message['msg']['msg']) == ('new', 'hello')
+
+        # what the consumers of another worker publish reaches this one through the layer
+        await get_channel_layer().group_send(chat_group(chat.pk), {'type': 'chat.message', 'text': 'from worker b'})
+        for communicator in (sender, listener):
+            assert await communicator.receive_from() == 'from worker b'
+
+        # a disconnected consumer leaves the group
+        await listener.disconnect()
+        await sender.send_to(text_data=json.dumps({'method': 'new', 'msg': 'bye'}))
+        assert json.loads(await sender.receive_from())['msg']['msg'] == 'bye'
+        assert len(get_channel_layer().groups[chat_group(chat.pk)]) == 1
+        await sender.disconnect()
+
+    async_to_sync(run)()
+    assert list(Msg.objects.values_list('msg', flat=True).order_by('id')) == ['hello', 'bye']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_users_outside_the_chat_are_refused(chat, django_user_model):
+    from restsite.routing import application
+    outsider = django_user_model.objects.create_user(username='outsider', password='123')
+
+    async def run():
+        communicator = WebsocketCommunicator(application, f'chat/{chat.pk}/', headers=[
+            (b'authorization', f'Bearer {AccessToken.for_user(outsider)}'.encode())])
+        connected, _ = await communicator.connect()
+        assert not connected
+        assert chat_group(chat.pk) not in get_channel_layer().groups
+
+    async_to_sync(run)()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_history(chat, create_user):
+    for i in range(7):
+        Msg.objects.create(chat_id=chat, sender=create_user, msg=f'msg {i}')
+
+    async def run():
+        communicator = await connect(create_user, chat)
+        snapshot = json.loads(await communicator.receive_from())
+        cursor, pages = snapshot['history'], []
+        while cursor:
+            await communicator.send_to(text_data=json.dumps({'method': 'history', 'cursor': cursor, 'page_size': 1}))
+            page = json.loads(await communicator.receive_from())
+            assert page['type'] == 'history'
+            pages.append([msg['msg'] for msg in page['msgs']])
+            cursor = page['next']
+        await communicator.send_to(text_data=json.dumps({'method': 'history', 'cursor': 'nope'}))
+        assert json.loads(await communicator.receive_from())['type'] == 'error'
+        await communicator.disconnect()
+        return [msg['msg'] for msg in snapshot['msgs']], pages
+
+    latest, pages = async_to_sync(run)()
+    assert latest == ['msg 6', 'msg 5', 'msg 4', 'msg 3', 'msg 2']
+    assert pages == [['msg 1'], ['msg 0']]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_connect_snapshot_from_the_ring_buffer(chat, create_user, create_superuser):
+    async def run():
+        sender = await connect(create_user, chat)
+        await sender.receive_from()
+        for i in range(6):
+            await sender.send_to(text_data=json.dumps({'method': 'new', 'msg': f'msg {i}'}))
+            msg_id = json.loads(await sender.receive_from())['msg']['id']
+        await sender.send_to(text_data=json.dumps({'method': 'update', 'id': msg_id, 'msg': 'edited'}))
+        await sender.receive_from()
+        hits = recent_messages.stats['hits']
+        listener = await connect(create_superuser, chat)
+        snapshot = json.loads(await listener.receive_from())
+        assert recent_messages.stats['hits'] == hits + 1
+        for communicator in (sender, listener):
+            await communicator.disconnect()
+        return snapshot
+
+    snapshot = async_to_sync(run)()
+    assert [msg['msg'] for msg in snapshot['msgs']] == ['edited', 'msg 4', 'msg 3', 'msg 2', 'msg 1']
+    assert snapshot == json.loads(json.dumps(ChatSerializer(chat).data))
+
+
+def slow_client():
+    """a send which waits for the returned event, and the texts sent"""
+    release, sent = asyncio.Event(), []
+
+    async def send(text):
+        await release.wait()
+        sent.append(text)
+    return send, release, sent
+
+
+async def until(condition):
+    while not condition():
+        await asyncio.sleep(0)
+
+
+@pytest.mark.parametrize('policy, delivered, dropped, closed', [
+    ('drop-oldest', ['0', '2', '3'], 1, []),
+    ('drop-newest', ['0', '1', '2'], 1, []),
+    ('disconnect', ['0', '1', '2'], 0, [1013]),
+])
+def test_send_queue_slow_client(policy, delivered, dropped, closed):
+    fanout_stats.reset()
+
+    async def run():
+        send, release, sent = slow_client()
+        close_codes = []
+
+        async def close(code=None):
+            close_codes.append(code)
+        queue = SendQueue(send, close, size=2, policy=policy)
+        queue.start()
+        queue.put('0')
+        # the client is busy with 0
+        await asyncio.sleep(0)
+        for text in ['1', '2', '3']:
+            queue.put(text)
+        assert 'websocket_send_queue_depth 2' in fanout_stats.prometheus()
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.wait_for(until(lambda: len(sent) == 3), 1)
+        await queue.stop()
+        return sent, close_codes
+
+    assert async_to_sync(run)() == (delivered, closed)
+    assert (fanout_stats.sent, fanout_stats.dropped, fanout_stats.disconnected) == (3, dropped, len(closed))
+
+
+def test_send_queue_failed_send(caplog):
+    async def run():
+        closed = []
+
+        async def send(text):
+            raise OSError('the client went away')
+
+        async def close(code=None):
+            closed.append(code)
+        queue = SendQueue(send, close, size=2)
+        queue.start()
+        queue.put('0')
+        await asyncio.wait_for(until(lambda: closed), 1)
+        # ignored once the connection is closing
+        queue.put('1')
+        assert queue.depth() == 0
+        await queue.stop()
+        return closed
+
+    assert async_to_sync(run)() == [None]
+    assert 'sending to a websocket connection failed' in caplog.text
+
+
+def test_slow_client_does_not_delay_the_others():
+    async def run():
+        slow_send, _, _ = slow_client()
+        fast_sent = []
+
+        async def fast_send(text):
+            fast_sent.append(text)
+        queues = [SendQueue(slow_send, None, size=10), SendQueue(fast_send, None, size=10)]
+        for queue in queues:
+            queue.start()
+        for i in range(5):
+            # what a broadcast does for each connection, without waiting
+            for queue in queues:
+                queue.put(str(i))
+        await asyncio.wait_for(until(lambda: len(fast_sent) == 5), 1)
+        assert queues[0].depth() == 4
+        for queue in queues:
+            await queue.stop()
+
+    async_to_sync(run)()
+
+
+@pytest.fixture
+def write_behind(settings, tmp_path):
+    from ..write_behind import msg_writer
+    settings.CHAT_WRITE_BEHIND = True
+    settings.CHAT_WRITE_BEHIND_ID_BLOCK = 3
+    settings.CHAT_WRITE_BEHIND_SPOOL = str(tmp_path / 'spool')
+    yield msg_writer
+    msg_writer.stop()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_write_behind(chat, create_user, create_superuser, write_behind):
+    written_before = write_behind.stats['msgs']
+
+    async def run():
+        sender, listener = await connect(create_user, chat), await connect(create_superuser, chat)
+        for communicator in (sender, listener):
+            await communicator.receive_from()
+        sent = []
+        for i in range(5):
+            await sender.send_to(text_data=json.dumps({'method': 'new', 'msg': f'msg {i}'}))
+            sent.append(json.loads(await listener.receive_from())['msg'])
+            await sender.receive_from()
+        # a pending message is written before it is changed
+        await sender.send_to(text_data=json.dumps({'method': 'update', 'id': sent[4]['id'], 'msg': 'edited'}))
+        assert json.loads(await listener.receive_from())['msg']['msg'] == 'edited'
+        late = await connect(create_superuser, chat)
+        snapshot = json.loads(await late.receive_from())
+        for communicator in (sender, listener, late):
+            await communicator.disconnect()
+        return sent, snapshot
+
+    sent, snapshot = async_to_sync(run)()
+    write_behind.stop()
+    assert [msg['msg'] for msg in snapshot['msgs']] == ['edited', 'msg 3', 'msg 2', 'msg 1', 'msg 0']
+    # the messages are the ones broadcast, ids and times included
+    sent[4]['msg'] = 'edited'
+    written = MsgSerializer(Msg.objects.filter(chat_id=chat).order_by('id'), many=True).data
+    assert [{key: msg[key] for key in ('id', 'msg', 'time_sent')} for msg in written] == \
+        [{key: msg[key] for key in ('id', 'msg', 'time_sent')} for msg in sent]
+    assert write_behind.stats['msgs'] - written_before == 5
+
+
+@pytest.mark.django_db(transaction=True)
+def test_write_behind_spools_what_the_database_refuses(chat, create_user, write_behind, settings, monkeypatch):
+    from django.db import OperationalError
+    from .. import write_behind as module
+    settings.CHAT_WRITE_BEHIND_INTERVAL = 60
+    insert_msgs = module.insert_msgs
+
+    def database_down(msgs):
+        raise OperationalError('the database is down')
+    monkeypatch.setattr(module, 'insert_msgs', database_down)
+    write_behind.add(Msg(chat_id=chat, sender=create_user, msg='spooled'))
+    assert write_behind.flush() == 0 and not Msg.objects.exists()
+
+    monkeypatch.setattr(module, 'insert_msgs', insert_msgs)
+    write_behind.add(Msg(chat_id=chat, sender=create_user, msg='written'))
+    # the spool is written after the next batch
+    assert write_behind.flush() == 1
+    assert sorted(Msg.objects.values_list('msg', flat=True)) == ['spooled', 'written']
+    assert write_behind.replay() == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_write_behind_ids(chat, create_user, write_behind, settings):
+    settings.CHAT_WRITE_BEHIND_INTERVAL = 60
+    write_behind.ids.clear()
+    assert write_behind.take_id() is None
+    # a block is reserved
+    write_behind.add(Msg(chat_id=chat, sender=create_user, msg='first'))
+    assert len(write_behind.ids) == 2
+    assert recent_messages.snapshot(chat.id)['msgs'] == []
+    write_behind.add(Msg(chat_id=chat, sender=create_user, msg='second'), write_behind.take_id())
+    # the snapshots only have the written messages
+    assert recent_messages.snapshot(chat.id)['msgs'] == []
+    assert write_behind.flush() == 2
+    assert [msg['msg'] for msg in recent_messages.snapshot(chat.id)['msgs']] == ['second', 'first']
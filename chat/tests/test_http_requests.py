@@ -4,6 +4,8 @@ import pytest
 from django.urls import reverse
 from rest_framework import status
 from .fixtures import auth_api_user, create_user, create_superuser
+from store.tests.fixtures import assert_constant_queries, explain_ordered_queries
+from ..history import history_page
 from ..models import Chat
 
 
@@ -19,3 +21,142 @@ def test_chat_list(auth_api_user, create_user, create_superuser):
     response = auth_api_user.get(url)
     assert response.status_code == status.HTTP_200_OK
     assert "'users': ['user', 'admin']" in str(response.json())
+
+
+@pytest.mark.django_db
+def test_chat_list_constant_queries(auth_api_user, create_user, create_superuser, assert_constant_queries):
+    def add_chats():
+        for i in range(5):
+            chat = Chat.objects.create(name=f'chat {i}')
+            chat.users.add(create_user, create_superuser)
+
+    add_chats()
+    assert_constant_queries(lambda: auth_api_user.get(reverse('chat-list')), add_chats)
+    assert len(auth_api_user.get(reverse('chat-list')).json()) == 10
+
+
+@pytest.mark.django_db
+def test_chat_view(auth_api_user, create_user, create_superuser):
+    from ..models import Msg
+    chat = Chat.objects.create(name='chat')
+    chat.users.add(create_user, create_superuser)
+    for i in range(6):
+        Msg.objects.create(chat_id=chat, sender=create_superuser if i % 2 else create_user, msg=f'msg {i}')
+    response = auth_api_user.get(reverse('view-chat', kwargs={'pk': chat.id}))
+    assert response.status_code == status.HTTP_200_OK
+    assert [msg['msg'] for msg in response.json()['msgs']] == [f'msg {i}' for i in range(5, 0, -1)]
+
+
+@pytest.mark.django_db
+def test_chat_history(auth_api_user, create_user, create_superuser, settings, django_assert_max_num_queries):
+    from django.db import connection
+    from ..models import Msg
+    settings.CHAT_HISTORY_PAGE_SIZE = 4
+    chat = Chat.objects.create(name='chat')
+    chat.users.add(create_user, create_superuser)
+    msgs = [Msg.objects.create(chat_id=chat, sender=create_user, msg=f'msg {i}') for i in range(10)]
+    # messages sent at the same time are ordered by id
+    Msg.objects.filter(pk__in=[msg.pk for msg in msgs[4:7]]).update(time_sent=msgs[4].time_sent)
+
+    snapshot = auth_api_user.get(reverse('view-chat', kwargs={'pk': chat.id})).json()
+    assert [msg['msg'] for msg in snapshot['msgs']] == [f'msg {i}' for i in range(9, 4, -1)]
+    url = reverse('chat-history', kwargs={'pk': chat.id})
+    # the cursor of the snapshot continues where it stops
+    pages, next_url = [], f'{url}?cursor={snapshot["history"]}'
+    while next_url:
+        with django_assert_max_num_queries(3):
+            response = auth_api_user.get(next_url)
+        assert response.status_code == status.HTTP_200_OK
+        pages.append([msg['msg'] for msg in response.json()['results']])
+        next_url = response.json()['next']
+    assert pages == [['msg 4', 'msg 3', 'msg 2', 'msg 1'], ['msg 0']]
+    assert [msg['msg'] for msg in auth_api_user.get(url).json()['results']] == ['msg 9', 'msg 8', 'msg 7', 'msg 6']
+
+    chat2 = Chat.objects.create(name='other')
+    chat2.users.add(create_superuser)
+    assert auth_api_user.get(reverse('chat-history', kwargs={'pk': chat2.id})).status_code == \
+        status.HTTP_403_FORBIDDEN
+
+    if connection.vendor == 'postgresql':
+        # the first page and a page after a cursor, as history_page queries them
+        plans = explain_ordered_queries(lambda: history_page(chat.id, history_page(chat.id, page_size=3)[1]),
+                                        Msg._meta.db_table)
+        assert len(plans) == 2
+        assert all('msg_chat_history_idx' in plan and 'Sort' not in plan for plan in plans)
+
+
+@pytest.mark.django_db
+def test_chat_snapshot_cache(auth_api_user, create_user, create_superuser, django_assert_num_queries,
+                             django_capture_on_commit_callbacks, settings):
+    from ..models import Msg
+    from ..recent import recent_messages
+    from ..serializers import ChatSerializer
+    chat = Chat.objects.create(name='chat')
+    chat.users.add(create_user, create_superuser)
+    with django_capture_on_commit_callbacks(execute=True):
+        msgs = [Msg.objects.create(chat_id=chat, sender=create_user, msg=f'msg {i}') for i in range(7)]
+    url = reverse('view-chat', kwargs={'pk': chat.id})
+    assert auth_api_user.get(url).json() == json.loads(json.dumps(ChatSerializer(chat).data))
+
+    def cached_snapshot():
+        # only the user of the token and the membership are loaded
+        with django_assert_num_queries(2):
+            response = auth_api_user.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        return response.json()
+
+    # the writes are applied to the ring buffer
+    with django_capture_on_commit_callbacks(execute=True):
+        msgs.append(Msg.objects.create(chat_id=chat, sender=create_superuser, msg='msg 7'))
+        msgs[6].msg = 'edited'
+        msgs[6].save()
+    snapshot = cached_snapshot()
+    assert [msg['msg'] for msg in snapshot['msgs']] == ['msg 7', 'edited', 'msg 5', 'msg 4', 'msg 3']
+    assert snapshot == json.loads(json.dumps(ChatSerializer(chat).data))
+    history = auth_api_user.get(reverse('chat-history', kwargs={'pk': chat.id}) + f'?cursor={snapshot["history"]}')
+    assert [msg['msg'] for msg in history.json()['results']] == ['msg 2', 'msg 1', 'msg 0']
+
+    # a buffered message deleted, the buffer is reloaded
+    with django_capture_on_commit_callbacks(execute=True):
+        msgs[7].delete()
+    assert [msg['msg'] for msg in auth_api_user.get(url).json()['msgs']] == ['edited', 'msg 5', 'msg 4', 'msg 3', 'msg 2']
+    cached_snapshot()
+
+    # a write of another worker moves the version of the chat past the cached one
+    recent_messages.bump(chat.id)
+    Msg.objects.filter(pk=msgs[6].pk).update(msg='from worker b')
+    assert auth_api_user.get(url).json()['msgs'][0]['msg'] == 'from worker b'
+
+    # the snapshots expire
+    settings.CHAT_SNAPSHOT_TIMEOUT = 0
+    misses = recent_messages.stats['misses']
+    auth_api_user.get(url)
+    assert recent_messages.stats['misses'] == misses + 1
+    settings.CHAT_SNAPSHOT_TIMEOUT = 300
+
+    # the membership isn't the one of the cached snapshot, even before the removal is applied to it
+    chat.users.remove(create_user)
+    assert auth_api_user.get(url).status_code == status.HTTP_403_FORBIDDEN
+    assert auth_api_user.get(reverse('view-chat', kwargs={'pk': chat.id + 1000})).status_code == \
+        status.HTTP_403_FORBIDDEN
+
+
+def test_snapshot_cache_must_be_shared(settings):
+    from ..checks import check_snapshot_cache
+    settings.CHAT_SNAPSHOT_CACHE = 'default'
+    assert [error.id for error in check_snapshot_cache(None)] == ['chat.E001']
+    settings.CACHES = {**settings.CACHES, 'shared': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                                                     'LOCATION': 'redis://localhost:6379/1'}}
+    settings.CHAT_SNAPSHOT_CACHE = 'shared'
+    assert check_snapshot_cache(None) == []
+
+
+def test_write_behind_needs_postgres(settings, monkeypatch):
+    from django.db import connection
+    from ..checks import check_write_behind_database
+    settings.CHAT_WRITE_BEHIND = True
+    assert check_write_behind_database(None) == []
+    monkeypatch.setattr(connection, 'vendor', 'sqlite')
+    assert [error.id for error in check_write_behind_database(None)] == ['chat.E002']
+    settings.CHAT_WRITE_BEHIND = False
+    assert check_write_behind_database(None) == []
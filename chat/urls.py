@@ -4,4 +4,5 @@ from . import views
 urlpatterns = [
     path('', views.ChatListView.as_view(), name="chat-list"),
     path('<int:pk>/', views.ChatView.as_view(), name='view-chat'),
+    path('<int:pk>/msgs/', views.ChatHistoryView.as_view(), name='chat-history'),
 ]
@@ -1,5 +1,5 @@
 import json
-import asyncio
+from asgiref.sync import async_to_sync
 from django.http import HttpResponse
 from rest_framework import generics
 from rest_framework.pagination import PageNumberPagination
@@ -14,12 +14,15 @@ import re
 from . import serializers
 from .models import Chat, Msg
 from . import permissions
-from .consumers import listeners_dic, PracticeConsumer
+from .consumers import broadcast
+from .history import MessageHistoryPagination
+from .recent import recent_messages
 
 
 class ChatListView(generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = serializers.ChatListSerializer
+    query_budget = {'GET': 3}
 
     def get_queryset(self):
         user = self.request.user
@@ -30,6 +33,11 @@ class ChatView(generics.RetrieveAPIView):
     permission_classes = [IsAuthenticated, permissions.IsChatMember]
     serializer_class = serializers.ChatSerializer
     queryset = Chat.objects.all()
+    query_budget = {'GET': 5}
+
+    def retrieve(self, request, *args, **kwargs):
+        # the snapshot the websocket consumers send on connect
+        return Response(recent_messages.snapshot(self.kwargs['pk']))
 
     def post(self, request, pk):
         chat = Chat()
@@ -40,10 +48,21 @@ class ChatView(generics.RetrieveAPIView):
         image.name = f"{pk}-{msg.pk}-{image.name}"
         msg.image = image
         msg.save()
-        asyncio.run(PracticeConsumer.broadcast(json.dumps({'type': 'new', 'msg': serializers.MsgSerializer(msg).data}), pk))
+        async_to_sync(broadcast)(pk, json.dumps({'type': 'new', 'msg': serializers.MsgSerializer(msg).data}))
         return Response(status=status.HTTP_201_CREATED)
 
 
+class ChatHistoryView(generics.ListAPIView):
+    """the messages of the chat, newest first, older pages are reached with the next link (a cursor)"""
+    permission_classes = [IsAuthenticated, permissions.IsChatMember]
+    serializer_class = serializers.MsgSerializer
+    pagination_class = MessageHistoryPagination
+    query_budget = {'GET': 3}
+
+    def get_queryset(self):
+        return Msg.objects.filter(chat_id=self.kwargs['pk']).select_related('sender')
+
+
 class ImageView(APIView):
     permission_classes = [IsAuthenticated]
 
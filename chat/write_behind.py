@@ -0,0 +1,222 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connection, DatabaseError, IntegrityError
+from django.utils.timezone import now
+
+from restsite.serializers import plain
+from store.metrics import metrics
+from .models import Msg
+from .recent import recent_messages
+from . import serializers
+
+logger = logging.getLogger(__name__)
+
+# rows of a single INSERT
+INSERT_CHUNK_SIZE = 1000
+
+
+def write_behind_enabled():
+    return getattr(settings, 'CHAT_WRITE_BEHIND', False)
+
+
+def insert_msgs(msgs):
+    """insert the messages, ids included, the ones already written are skipped"""
+    fields = Msg._meta.concrete_fields
+    table = connection.ops.quote_name(Msg._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    row = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    with connection.cursor() as cursor:
+        for start in range(0, len(msgs), INSERT_CHUNK_SIZE):
+            chunk = msgs[start:start + INSERT_CHUNK_SIZE]
+            # bulk_create would set time_sent again, it must stay the one broadcast
+            cursor.execute(f'INSERT INTO {table} ({columns}) VALUES {", ".join([row] * len(chunk))} '
+                           f'ON CONFLICT ({connection.ops.quote_name(Msg._meta.pk.column)}) DO NOTHING',
+                           [field.get_db_prep_save(getattr(msg, field.attname), connection)
+                            for msg in chunk for field in fields])
+
+
+class MsgWriter:
+    """
+    the write-behind of the new chat messages (CHAT_WRITE_BEHIND): add gives a message its id, from a
+    block of the sequence of the table reserved in advance, and its timestamps so it can be broadcast
+    right away, a thread of the process inserts the pending messages every CHAT_WRITE_BEHIND_INTERVAL
+    seconds, or as soon as CHAT_WRITE_BEHIND_BATCH_SIZE are waiting, with a single statement.
+    the batches the database refuses are appended to the CHAT_WRITE_BEHIND_SPOOL file and written again
+    after the next successful flush. stop, called at exit, writes what is pending, the messages added
+    since the last flush are lost if the process is killed
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # one flush at a time, the thread's or the one of an update of a pending message
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = []
+        self.ids = deque()
+        self.thread = None
+        self.stop_event = None
+        self.stats = {'msgs': 0, 'batches': 0, 'spooled': 0}
+        self.exit_handler = False
+
+    def take_id(self):
+        """one of the reserved ids, None when none is left"""
+        with self.lock:
+            return self.ids.popleft() if self.ids else None
+
+    def reserve_ids(self):
+        """take the next CHAT_WRITE_BEHIND_ID_BLOCK ids of the sequence of the messages"""
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                           [Msg._meta.db_table, Msg._meta.pk.column,
+                            getattr(settings, 'CHAT_WRITE_BEHIND_ID_BLOCK', 100)])
+            ids = [row[0] for row in cursor.fetchall()]
+        with self.lock:
+            self.ids.extend(ids)
+
+    def add(self, msg, msg_id=None):
+        """
+        queue an unsaved message with msg_id, taken with take_id, or the next reserved id, a query
+        when none is left. its snapshots are updated once it is written, by the thread
+        """
+        while msg_id is None:
+            msg_id = self.take_id()
+            if msg_id is None:
+                self.reserve_ids()
+        with self.lock:
+            msg.id = msg_id
+            msg.time_sent = msg.last_change = now()
+            self.pending.append(msg)
+            full = len(self.pending) >= getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 500)
+            if self.thread is None:
+                self.start()
+        if full:
+            self.wakeup.set()
+
+    def start(self):
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(self.stop_event,), name='chat-write-behind',
+                                       daemon=True)
+        self.thread.start()
+        if not self.exit_handler:
+            atexit.register(self.stop)
+            self.exit_handler = True
+
+    def stop(self):
+        """flush the pending messages and stop the thread"""
+        with self.lock:
+            thread, stop, self.thread = self.thread, self.stop_event, None
+        if thread is None:
+            return
+        stop.set()
+        self.wakeup.set()
+        thread.join()
+
+    def run(self, stop):
+        try:
+            # what a previous process couldn't write
+            self.replay()
+            while not stop.is_set():
+                self.wakeup.wait(getattr(settings, 'CHAT_WRITE_BEHIND_INTERVAL', 0.005))
+                self.wakeup.clear()
+                self.flush()
+            self.flush()
+        finally:
+            connection.close()
+
+    def flush(self):
+        """write the pending messages, returns their number"""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return 0
+            try:
+                self.write(batch)
+            except DatabaseError:
+                logger.exception('%d chat messages could not be written, they are spooled', len(batch))
+                self.spool(batch)
+                # a new connection for the next flush
+                connection.close()
+                return 0
+            self.stats['msgs'] += len(batch)
+            self.stats['batches'] += 1
+            for msg in batch:
+                data = plain(serializers.MsgSerializer(msg).data)
+                recent_messages.apply(msg.chat_id_id, lambda entry, data=data: entry.add(data))
+            self.replay()
+            return len(batch)
+
+    @staticmethod
+    def write(batch):
+        try:
+            insert_msgs(batch)
+        except IntegrityError:
+            # a chat or a sender deleted meanwhile, the other messages are kept
+            for msg in batch:
+                try:
+                    insert_msgs([msg])
+                except IntegrityError:
+                    logger.warning('chat message %s dropped, its chat or sender is gone', msg.id)
+
+    def spool(self, batch):
+        with open(getattr(settings, 'CHAT_WRITE_BEHIND_SPOOL', 'chat_write_behind.spool'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # a line per batch, the values as the fields write them, time_sent keeps its microseconds
+            f.write(json.dumps([[field.value_to_string(msg) for field in Msg._meta.concrete_fields]
+                                for msg in batch]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.stats['spooled'] += len(batch)
+
+    def replay(self):
+        """write the spooled messages, returns their number"""
+        path = getattr(settings, 'CHAT_WRITE_BEHIND_SPOOL', 'chat_write_behind.spool')
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return 0
+        fields = Msg._meta.concrete_fields
+        with open(path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            batches = [[Msg(**{field.attname: field.to_python(value) for field, value in zip(fields, row)})
+                        for row in json.loads(line)] for line in f if line.strip()]
+            try:
+                for batch in batches:
+                    self.write(batch)
+                    for chat_id in {msg.chat_id_id for msg in batch}:
+                        recent_messages.apply(chat_id, lambda entry: False)
+            except DatabaseError:
+                # kept for the next time, the messages already written are skipped then
+                logger.exception('the spooled chat messages could not be written')
+                connection.close()
+                return 0
+            f.truncate(0)
+        logger.info('%d spooled chat messages written', sum(len(batch) for batch in batches))
+        return sum(len(batch) for batch in batches)
+
+    def prometheus(self):
+        with self.lock:
+            stats, pending = dict(self.stats), len(self.pending)
+        return '\n'.join([
+            '# HELP chat_write_behind_pending chat messages waiting to be written',
+            '# TYPE chat_write_behind_pending gauge',
+            f'chat_write_behind_pending {pending}',
+            '# HELP chat_write_behind_msgs_total chat messages written by the write-behind',
+            '# TYPE chat_write_behind_msgs_total counter',
+            f'chat_write_behind_msgs_total {stats["msgs"]}',
+            '# HELP chat_write_behind_batches_total batches written by the write-behind',
+            '# TYPE chat_write_behind_batches_total counter',
+            f'chat_write_behind_batches_total {stats["batches"]}',
+            '# HELP chat_write_behind_spooled_total chat messages spooled because the database refused them',
+            '# TYPE chat_write_behind_spooled_total counter',
+            f'chat_write_behind_spooled_total {stats["spooled"]}',
+        ]) + '\n'
+
+
+msg_writer = MsgWriter()
+metrics.register(msg_writer.prometheus)
@@ -0,0 +1,37 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def strict_query_budgets(settings):
+    # a view running more queries than its query_budget fails the test
+    settings.QUERY_BUDGET_STRICT = True
+
+
+@pytest.fixture(autouse=True)
+def in_memory_channel_layer(settings):
+    # a single process, no redis needed
+    settings.CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    # the version stamps start over with each test database transaction
+    from store.response_cache import response_cache
+    response_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def reset_search_index():
+    # the products of the previous tests are gone
+    from store.search_index import product_index
+    product_index.reset()
+
+
+@pytest.fixture(autouse=True)
+def clear_chat_snapshots(settings):
+    from django.core.cache import caches
+    from chat.recent import recent_messages
+    # a single process, no redis needed
+    settings.CHAT_SNAPSHOT_CACHE = 'default'
+    recent_messages.clear()
+    caches['default'].clear()
@@ -0,0 +1,66 @@
+from collections import defaultdict
+
+from rest_framework import serializers
+
+
+class BatchLoader:
+    """
+    resolve a relation for many keys at once: the keys primed before the first load are fetched
+    together with a single query by batch_fn(keys) -> {key: value}, the results are cached
+    """
+
+    def __init__(self, batch_fn, default=None):
+        self.batch_fn = batch_fn
+        self.default = default
+        self.pending = set()
+        self.cache = {}
+
+    def prime(self, keys):
+        self.pending.update(key for key in keys if key not in self.cache)
+
+    def load(self, key):
+        if key not in self.cache:
+            self.pending.add(key)
+            self.dispatch()
+        return self.cache[key]
+
+    def dispatch(self):
+        keys, self.pending = self.pending, set()
+        results = self.batch_fn(keys)
+        for key in keys:
+            self.cache[key] = results.get(key, self.default)
+
+
+def get_loader(context, name, batch_fn, default=None):
+    """the loader named name of the serializer context, shared by every serializer of the request"""
+    loaders = context.setdefault('loaders', {})
+    if name not in loaders:
+        loaders[name] = BatchLoader(batch_fn, default)
+    return loaders[name]
+
+
+class BatchListSerializer(serializers.ListSerializer):
+    """prime the loaders of the child serializer with the whole page before serializing it"""
+
+    def to_representation(self, data):
+        instances = list(data.all() if hasattr(data, 'all') else data)
+        prime = getattr(self.child, 'prime_loaders', None)
+        if prime is not None and instances:
+            prime(instances)
+        return super().to_representation(instances)
+
+
+def group_by(rows, key, value=lambda row: row):
+    result = defaultdict(list)
+    for row in rows:
+        result[key(row)].append(value(row))
+    return result
+
+
+def plain(data):
+    """a copy of serialized data without the references to its serializers"""
+    if isinstance(data, dict):
+        return {key: plain(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [plain(value) for value in data]
+    return data
@@ -41,6 +41,13 @@ REST_FRAMEWORK = {
     }
 }
 
+SIMPLE_JWT = {
+    # tokens carry the role and the user fields the permissions need, see store/tokens.py
+    'TOKEN_OBTAIN_SERIALIZER': 'store.tokens.RoleTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'store.tokens.RoleTokenRefreshSerializer',
+    'TOKEN_USER_CLASS': 'store.tokens.RoleTokenUser',
+}
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -59,6 +66,7 @@ INSTALLED_APPS = [
     'channels'
 ]
 MIDDLEWARE = [
+    'store.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -99,7 +107,10 @@ DATABASES = {
         "NAME": "postgres",
         "USER": "postgres",
         'PASSWORD': '123',
-
+        'OPTIONS': {
+            # the threshold of the trigram % operator, store.search.SIMILARITY_THRESHOLD, set when connecting
+            'options': '-c pg_trgm.similarity_threshold=0.1',
+        },
     }
 }
 
@@ -162,6 +173,77 @@ ASGI_APPLICATION = 'restsite.asgi.application'
 WSGI_APPLICATION = 'restsite.wsgi.application'
 
 
+# how cart updates are serialized between workers: store.carts.RowCartLock (SELECT ... FOR UPDATE)
+# or store.carts.AdvisoryCartLock (postgres advisory locks), timeout in seconds
+CART_LOCK_BACKEND = 'store.carts.RowCartLock'
+CART_LOCK_TIMEOUT = 5
+
+# 'database' (postgres trigram/full text search) or 'memory' (in-process trigram index),
+# None picks 'database' on postgres, with the pg_trgm extension for the fuzzy searches, and 'memory' otherwise
+PRODUCT_SEARCH_ENGINE = None
+# seconds before the in-process index is rebuilt from the database to catch other workers changes
+PRODUCT_SEARCH_INDEX_TTL = 300
+
+# seconds between two loads of the new blacklisted tokens by each worker
+TOKEN_BLACKLIST_SYNC_INTERVAL = 5
+
+# cart status emails are queued and sent by manage.py run_notifications, a failed email is retried
+# NOTIFICATION_RETRY_DELAY seconds later, the delay doubling after each failure
+NOTIFICATION_BATCH_SIZE = 100
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = 60
+
+# raise instead of logging when a view runs more queries than its query_budget (enabled in the tests)
+QUERY_BUDGET_STRICT = False
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # shared by the workers, the redis of the channel layer
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+    },
+}
+
+# the catalog responses of anonymous users are cached in each worker (RESPONSE_CACHE_SIZE responses at most),
+# and in the cache alias RESPONSE_CACHE_SHARED if set (e.g. a redis cache shared by the workers) for
+# RESPONSE_CACHE_TIMEOUT seconds, the writes to the catalog invalidate them
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_SHARED = None
+RESPONSE_CACHE_TIMEOUT = 300
+
+
+# the messages per page of the chat history (websocket history method and /chat/<id>/msgs/)
+CHAT_HISTORY_PAGE_SIZE = 20
+CHAT_HISTORY_MAX_PAGE_SIZE = 100
+
+# the chat snapshots (the chat, its members and its CHAT_RECENT_MESSAGES latest messages) are cached in each
+# worker, CHAT_SNAPSHOT_CHATS chats at most, the writes of the other workers are seen through a version of
+# each chat in the cache alias CHAT_SNAPSHOT_CACHE, which must be shared by the workers (the checks refuse a
+# cache of the process). a snapshot is reloaded CHAT_SNAPSHOT_TIMEOUT seconds after it was loaded at the latest
+CHAT_RECENT_MESSAGES = 5
+CHAT_SNAPSHOT_CHATS = 1000
+CHAT_SNAPSHOT_CACHE = 'shared'
+CHAT_SNAPSHOT_TIMEOUT = 300
+
+# write-behind of the websocket chat messages: broadcast with an id of a block of CHAT_WRITE_BEHIND_ID_BLOCK
+# reserved ids, written by a thread of the worker every CHAT_WRITE_BEHIND_INTERVAL seconds (or once
+# CHAT_WRITE_BEHIND_BATCH_SIZE are waiting), the batches the database refuses are kept in CHAT_WRITE_BEHIND_SPOOL
+# until they can be written. the messages of the last interval are lost if the worker is killed
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_INTERVAL = 0.005
+CHAT_WRITE_BEHIND_BATCH_SIZE = 500
+CHAT_WRITE_BEHIND_ID_BLOCK = 100
+CHAT_WRITE_BEHIND_SPOOL = os.path.join(BASE_DIR, 'chat_write_behind.spool')
+
+# each websocket connection queues at most WEBSOCKET_SEND_QUEUE_SIZE messages not sent yet, when its
+# queue is full 'drop-oldest' or 'drop-newest' drops a message, 'disconnect' closes the connection
+WEBSOCKET_SEND_QUEUE_SIZE = 100
+WEBSOCKET_SLOW_CONSUMER_POLICY = 'drop-oldest'
+
+# the websocket consumers of every worker exchange the chat messages through this layer
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -1,8 +1,11 @@
 from django.contrib import admin
-from .models import Product, Cart, CartItem, BlackListedToken
+from .models import Product, Cart, CartItem, BlackListedToken, ProductRecommendation, ProductCoPurchase, CartNotification
 # Register your models here.
 
 admin.site.register(Product)
 admin.site.register(Cart)
 admin.site.register(CartItem)
 admin.site.register(BlackListedToken)
+admin.site.register(ProductRecommendation)
+admin.site.register(ProductCoPurchase)
+admin.site.register(CartNotification)
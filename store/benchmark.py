@@ -0,0 +1,473 @@
+import datetime
+import io
+import itertools
+import json
+import random
+import subprocess
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache.backends.dummy import DummyCache
+from django.db import connection, transaction
+from django.urls import reverse
+from django.utils.timezone import now
+from rest_framework.test import APIClient
+from rest_framework.throttling import SimpleRateThrottle
+from taggit.models import Tag, TaggedItem
+
+from chat.models import Chat, Msg
+from .facets import rebuild_tag_counts
+from .metrics import QueryCounter
+from .models import Product, Cart, CartItem
+
+WORDS = ['wood', 'wool', 'blanket', 'chair', 'table', 'lamp', 'cotton', 'steel', 'glass', 'desk', 'sofa', 'shelf',
+         'mirror', 'carpet', 'pillow', 'curtain', 'towel', 'basket', 'candle', 'vase', 'clock', 'frame', 'stool',
+         'bench', 'drawer', 'cabinet', 'hook', 'rack', 'mat', 'bowl']
+# seeded carts are never drafts, a customer can only have one
+SEED_CART_STATUSES = [Cart.Status.ORDERED, Cart.Status.ON_WAY, Cart.Status.REJECTED, Cart.Status.RECEIVED,
+                      Cart.Status.DELIVERED, Cart.Status.APPROVED]
+BENCHMARK_PASSWORD = 'benchmark'
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(model, columns, rows, batch_size=50000):
+    """
+    insert rows (tuples of the values of columns) into the table of model with COPY on postgres,
+    multi-row INSERT elsewhere, batch_size rows at a time. returns the number of rows inserted
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    column_list = ', '.join(connection.ops.quote_name(column) for column in columns)
+    inserted = 0
+    batch = []
+
+    def flush():
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                buffer = io.StringIO(''.join('\t'.join(map(_copy_value, row)) + '\n' for row in batch))
+                cursor.copy_expert(f'COPY {table} ({column_list}) FROM STDIN', buffer)
+            else:
+                placeholders = f"({', '.join(['%s'] * len(columns))})"
+                cursor.executemany(f'INSERT INTO {table} ({column_list}) VALUES {placeholders}', batch)
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            flush()
+            inserted += len(batch)
+            batch = []
+    if batch:
+        flush()
+        inserted += len(batch)
+    return inserted
+
+
+def _new_ids(model, after_id):
+    return np.array(model.objects.filter(id__gt=after_id).order_by('id').values_list('id', flat=True), dtype=np.int64)
+
+
+def _max_id(model):
+    return model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def _column(model, field):
+    return model._meta.get_field(field).column
+
+
+def seed(products=0, tags=100, tags_per_product=3, users=0, carts=0, cart_items=0, chats=0, messages=0,
+         random_seed=0, batch_size=50000, log=lambda message: None):
+    """
+    add synthetic rows on top of the existing ones: products with tags, customers, ordered carts
+    with their items spread over the customers and the products, chats between two customers and their messages.
+    the same arguments and random_seed give the same data
+    """
+    rng = np.random.default_rng(random_seed)
+    words = np.array(WORDS)
+    created = now()
+
+    def timestamps(count, days=365):
+        seconds = rng.integers(0, days * 86400, count)
+        return [created - datetime.timedelta(seconds=int(second)) for second in seconds]
+
+    with transaction.atomic():
+        if products:
+            last_id = _max_id(Product)
+
+            def product_rows():
+                for start in range(0, products, batch_size):
+                    count = min(batch_size, products - start)
+                    names = rng.choice(words, (count, 2))
+                    descriptions = rng.choice(words, (count, 12))
+                    rates = np.round(rng.random(count) * 5, 2)
+                    for name, description, rate in zip(names, descriptions, rates):
+                        yield ' '.join(name), ' '.join(description), float(rate)
+            copy_rows(Product, ['name', 'description', 'rate'], product_rows(), batch_size)
+            product_ids = _new_ids(Product, last_id)
+            log(f'{len(product_ids)} products')
+
+            tag_names = [f'tag{i}' for i in range(tags)]
+            Tag.objects.bulk_create([Tag(name=name, slug=name) for name in tag_names], ignore_conflicts=True)
+            tag_ids = np.array(Tag.objects.filter(name__in=tag_names).order_by('name').values_list('id', flat=True))
+            content_type_id = ContentType.objects.get_for_model(Product).id
+            per_product = min(tags_per_product, len(tag_ids))
+
+            def tagged_rows():
+                for product_id in product_ids:
+                    for tag_id in rng.choice(tag_ids, per_product, replace=False):
+                        yield int(tag_id), content_type_id, int(product_id)
+            tagged = copy_rows(TaggedItem, ['tag_id', 'content_type_id', 'object_id'], tagged_rows(), batch_size)
+            rebuild_tag_counts()
+            log(f'{tagged} tagged items')
+
+        if users:
+            last_id = _max_id(User)
+            password = make_password(BENCHMARK_PASSWORD)
+            copy_rows(User, ['username', 'email', 'password', 'first_name', 'last_name', 'is_superuser',
+                             'is_staff', 'is_active', 'date_joined'],
+                      ((f'bench{last_id + i}', f'bench{last_id + i}@example.com', password, '', '', False, False,
+                        True, created) for i in range(1, users + 1)), batch_size)
+            log(f'{users} users')
+
+        customer_ids = np.array(User.objects.filter(is_superuser=False).order_by('id').values_list('id', flat=True))
+        all_product_ids = np.array(Product.objects.order_by('id').values_list('id', flat=True))
+        if carts and len(customer_ids):
+            last_id = _max_id(Cart)
+            statuses = rng.choice(SEED_CART_STATUSES, carts)
+            copy_rows(Cart, [_column(Cart, 'customer'), 'order_date', 'status', 'version'],
+                      zip(rng.choice(customer_ids, carts).tolist(), timestamps(carts), statuses.tolist(),
+                          itertools.repeat(0)), batch_size)
+            cart_ids = _new_ids(Cart, last_id)
+            log(f'{len(cart_ids)} carts')
+        else:
+            cart_ids = np.array(Cart.objects.order_by('id').values_list('id', flat=True))
+
+        if cart_items and len(cart_ids) and len(all_product_ids):
+            n = len(all_product_ids)
+            # cart_items spread over the carts, each cart gets distinct products: start + k * stride modulo n
+            if cart_items >= len(cart_ids):
+                sizes = 1 + rng.multinomial(cart_items - len(cart_ids), np.full(len(cart_ids), 1 / len(cart_ids)))
+            else:
+                sizes = (np.arange(len(cart_ids)) < cart_items).astype(np.int64)
+            sizes = np.minimum(sizes, n)
+
+            def item_rows():
+                for cart_id, size in zip(cart_ids, sizes.tolist()):
+                    start, stride = rng.integers(0, n), rng.integers(1, max(n // max(size, 1), 1) + 1)
+                    for k in range(size):
+                        yield int(all_product_ids[(start + k * stride) % n]), int(cart_id), int(rng.integers(1, 4))
+            items = copy_rows(CartItem, [_column(CartItem, 'product'), _column(CartItem, 'cart'), 'count'],
+                              item_rows(), batch_size)
+            log(f'{items} cart items')
+
+        if chats and len(customer_ids) > 1:
+            last_id = _max_id(Chat)
+            copy_rows(Chat, ['name', 'group'], ((f'chat {i}', False) for i in range(chats)), batch_size)
+            chat_ids = _new_ids(Chat, last_id)
+            members = [(int(chat_id), int(user_id)) for chat_id in chat_ids
+                       for user_id in rng.choice(customer_ids, 2, replace=False)]
+            copy_rows(Chat.users.through, ['chat_id', 'user_id'], members, batch_size)
+            log(f'{len(chat_ids)} chats')
+
+            if messages:
+                chat_members = np.array(members, dtype=np.int64).reshape(-1, 2, 2)
+
+                def message_rows():
+                    for start in range(0, messages, batch_size):
+                        count = min(batch_size, messages - start)
+                        picked = chat_members[rng.integers(0, len(chat_members), count), rng.integers(0, 2, count)]
+                        texts = rng.choice(words, (count, 6))
+                        for (chat_id, sender_id), text, sent in zip(picked, texts, timestamps(count)):
+                            yield int(chat_id), ' '.join(text), int(sender_id), sent, sent, '', ''
+                sent = copy_rows(Msg, [_column(Msg, 'chat_id'), 'msg', _column(Msg, 'sender'), 'time_sent',
+                                       'last_change', 'image', 'file'], message_rows(), batch_size)
+                log(f'{sent} messages')
+
+
+def _benchmark_user(username, superuser=False):
+    user = User.objects.filter(username=username).first()
+    if user is None:
+        create = User.objects.create_superuser if superuser else User.objects.create_user
+        user = create(username=username, email=f'{username}@example.com', password=BENCHMARK_PASSWORD)
+    return user
+
+
+def _client(user):
+    client = APIClient()
+    response = client.post(reverse('token-obtain-pair'), {'username': user.username, 'password': BENCHMARK_PASSWORD})
+    client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.json()['access'])
+    return client
+
+
+def _sample_product_ids(rng, count=1000):
+    product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+    return rng.sample(product_ids, min(count, len(product_ids)))
+
+
+@contextmanager
+def throttling_disabled():
+    """the rate limits would turn the benchmark requests into 429s, the throttles get a cache which keeps nothing"""
+    cache = SimpleRateThrottle.cache
+    SimpleRateThrottle.cache = DummyCache('benchmark', {})
+    try:
+        yield
+    finally:
+        SimpleRateThrottle.cache = cache
+
+
+def _measure(requests, call):
+    """run call(i) requests times, returns the latencies in ms and the number of queries of each call"""
+    latencies, queries = [], []
+    for i in range(requests):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            call(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+        queries.append(counter.queries)
+    return latencies, queries
+
+
+def _expect(response, status_code=200):
+    assert response.status_code == status_code, response.content
+    return response
+
+
+def scenario_search(requests, rng, mode='fuzzy'):
+    client = APIClient()
+    url = reverse('index')
+    return _measure(requests, lambda i: _expect(client.get(url, {'query': rng.choice(WORDS), 'mode': mode})))
+
+
+def scenario_product_detail(requests, rng):
+    client = APIClient()
+    product_ids = _sample_product_ids(rng)
+    return _measure(requests, lambda i: _expect(
+        client.get(reverse('RUD-product', kwargs={'pk': rng.choice(product_ids)}))))
+
+
+def scenario_cart_create(requests, rng):
+    client = _client(_benchmark_user('benchmark-customer'))
+    product_ids = _sample_product_ids(rng)
+    url = reverse('list-create-cart')
+    return _measure(requests, lambda i: _expect(client.post(
+        url, {'products': rng.sample(product_ids, 5), 'status': Cart.Status.ORDERED}), 201))
+
+
+def scenario_cart_update(requests, rng):
+    user = _benchmark_user('benchmark-customer')
+    client = _client(user)
+    product_ids = _sample_product_ids(rng)
+    cart = Cart.objects.filter(customer=user, status=Cart.Status.DRAFT).first() or \
+        Cart.objects.create(customer=user)
+    url = reverse('RUD-cart', kwargs={'pk': cart.pk})
+    return _measure(requests, lambda i: _expect(client.patch(url, {'products': rng.sample(product_ids, 5)})))
+
+
+def scenario_admin_carts(requests, rng):
+    client = _client(_benchmark_user('benchmark-admin', superuser=True))
+    url = reverse('list-create-cart-admin')
+    return _measure(requests, lambda i: _expect(client.get(url, {'page_size': 10, 'cursor': ''})))
+
+
+async def _connect(user_id, chat_id):
+    from channels.testing import WebsocketCommunicator
+    from restsite.routing import application
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    token = AccessToken()
+    token['user_id'] = user_id
+    communicator = WebsocketCommunicator(application, f'chat/{chat_id}/', headers=[
+        (b'authorization', f'Bearer {token}'.encode())])
+    connected, _ = await communicator.connect()
+    assert connected, 'the subscriber could not connect'
+    # the snapshot of the chat
+    await communicator.receive_from()
+    return communicator
+
+
+async def _subscribe(user_ids, chat_id, messages, ready):
+    """
+    connect a subscriber for each user, call ready() and wait for the messages, returns
+    {message number: time.time() when the last subscriber received it}
+    """
+    import asyncio
+    communicators = [await _connect(user_id, chat_id) for user_id in user_ids]
+    ready()
+    delivered = {}
+
+    async def receive(communicator):
+        for _ in range(messages):
+            number = int(json.loads(await communicator.receive_from(timeout=30))['msg']['msg'])
+            delivered[number] = max(delivered.get(number, 0), time.time())
+
+    await asyncio.gather(*(receive(communicator) for communicator in communicators))
+    for communicator in communicators:
+        await communicator.disconnect()
+    return delivered
+
+
+def _subscriber_process(user_ids, chat_id, messages, ready, results):
+    # a forked worker, with its own database connections and channel layer connection
+    results.put(async_to_sync(_subscribe)(user_ids, chat_id, messages, ready.release))
+
+
+def scenario_websocket_fanout(requests, rng, workers=0, subscribers=20):
+    """
+    time from sending a message to its delivery to every subscriber of the chat, the subscribers are
+    spread over workers processes which only share the channel layer (every process but the one of the
+    sender must be reached through it), or all run in this process with workers=0
+    """
+    import asyncio
+    import multiprocessing
+    from channels.layers import get_channel_layer, InMemoryChannelLayer
+    from django.db import connections
+
+    if workers and isinstance(get_channel_layer(), InMemoryChannelLayer):
+        raise ValueError('the worker processes need a channel layer they share, e.g. redis')
+    users = [_benchmark_user(f'benchmark-listener{i}') for i in range(subscribers)]
+    sender = _benchmark_user('benchmark-sender')
+    chat = Chat.objects.create(name='benchmark', group=True)
+    chat.users.set(users + [sender])
+    user_ids = [user.id for user in users]
+
+    processes, context = [], multiprocessing.get_context('fork')
+    ready, results = context.Semaphore(0), context.Queue()
+    if workers:
+        # the children must not share the connections of this process
+        connections.close_all()
+        for i in range(workers):
+            process = context.Process(target=_subscriber_process,
+                                      args=(user_ids[i::workers], chat.pk, requests, ready, results))
+            process.start()
+            processes.append(process)
+
+    async def run():
+        local = None
+        if not workers:
+            subscribed = asyncio.Event()
+            local = asyncio.ensure_future(_subscribe(user_ids, chat.pk, requests, subscribed.set))
+            await subscribed.wait()
+        else:
+            for _ in range(workers):
+                await asyncio.get_running_loop().run_in_executor(None, ready.acquire)
+        publisher = await _connect(sender.id, chat.pk)
+        sent = {}
+        for i in range(requests):
+            sent[i] = time.time()
+            await publisher.send_to(text_data=json.dumps({'method': 'new', 'msg': str(i)}))
+            # the sender gets its own message back once it went through the layer
+            await publisher.receive_from(timeout=30)
+        await publisher.disconnect()
+        return sent, [await local] if local is not None else []
+
+    try:
+        sent, deliveries = async_to_sync(run)()
+        deliveries += [results.get(timeout=60) for _ in processes]
+        latencies = [(max(delivered[i] for delivered in deliveries) - sent[i]) * 1000 for i in range(requests)]
+        # the queries run in the threads of database_sync_to_async, they are counted by the metrics instead
+        return latencies, None
+    finally:
+        for process in processes:
+            process.join(timeout=10)
+        chat.delete()
+
+
+def scenario_chat_send(requests, rng, write_behind=False):
+    """
+    time from sending a chat message to getting it back from the consumer, with the messages saved one
+    by one or by the write-behind (CHAT_WRITE_BEHIND), which writes them all before the scenario ends
+    """
+    from django.test import override_settings
+    from chat.write_behind import msg_writer
+
+    sender = _benchmark_user('benchmark-sender')
+    chat = Chat.objects.create(name='benchmark')
+    chat.users.set([sender])
+
+    async def run():
+        publisher = await _connect(sender.id, chat.pk)
+        latencies = []
+        for i in range(requests):
+            start = time.perf_counter()
+            await publisher.send_to(text_data=json.dumps({'method': 'new', 'msg': str(i)}))
+            await publisher.receive_from(timeout=30)
+            latencies.append((time.perf_counter() - start) * 1000)
+        await publisher.disconnect()
+        return latencies
+
+    try:
+        with override_settings(CHAT_WRITE_BEHIND=write_behind):
+            latencies = async_to_sync(run)()
+            msg_writer.stop()
+        assert Msg.objects.filter(chat_id=chat).count() == requests, 'messages were lost'
+        # the queries run in the threads of database_sync_to_async, they are counted by the metrics instead
+        return latencies, None
+    finally:
+        chat.delete()
+
+
+SCENARIOS = {
+    'search': scenario_search,
+    'search-fulltext': lambda requests, rng: scenario_search(requests, rng, 'fulltext'),
+    'product-detail': scenario_product_detail,
+    'cart-create': scenario_cart_create,
+    'cart-update': scenario_cart_update,
+    'admin-carts': scenario_admin_carts,
+    'websocket-fanout': scenario_websocket_fanout,
+    'chat-send': scenario_chat_send,
+    'chat-send-write-behind': lambda requests, rng: scenario_chat_send(requests, rng, write_behind=True),
+}
+
+
+def summarize(latencies, queries):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    result = {'requests': len(latencies), 'throughput': round(len(latencies) / (sum(latencies) / 1000), 2),
+              'p50_ms': round(float(p50), 3), 'p95_ms': round(float(p95), 3), 'p99_ms': round(float(p99), 3)}
+    if queries is not None:
+        result['queries'] = {'mean': round(float(np.mean(queries)), 2), 'max': int(max(queries))}
+    return result
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(scenarios, requests, random_seed=0, log=lambda message: None, options=None):
+    """
+    run the given scenarios, options are the keyword arguments of some of them, {scenario: {name: value}},
+    returns a report which can be dumped to JSON
+    """
+    options = options or {}
+    report = {
+        'commit': _commit(),
+        'date': now().isoformat(),
+        'database': connection.vendor,
+        'rows': {model.__name__: model.objects.count() for model in (Product, TaggedItem, User, Cart, CartItem,
+                                                                     Chat, Msg)},
+        'scenarios': {},
+    }
+    with throttling_disabled():
+        for name in scenarios:
+            rng = random.Random(random_seed)
+            latencies, queries = SCENARIOS[name](requests, rng, **options.get(name, {}))
+            report['scenarios'][name] = summarize(latencies, queries)
+            if options.get(name):
+                report['scenarios'][name]['options'] = options[name]
+            log(f'{name}: {report["scenarios"][name]}')
+    return report
@@ -0,0 +1,172 @@
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction, connection, OperationalError, IntegrityError
+from django.utils.module_loading import import_string
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+from .metrics import metrics
+from .models import Cart, CartItem
+
+logger = logging.getLogger(__name__)
+
+# advisory locks keys are (namespace, cart id) so they don't collide with other users of advisory locks
+ADVISORY_LOCK_NAMESPACE = 7401
+
+# a customer has at most one draft cart, see Cart.Meta
+DRAFT_CART_CONSTRAINT = 'unique_draft_cart_per_customer'
+
+# the transitions a delivery man can apply, from the expected status to the new one
+DELIVERY_TRANSITIONS = {Cart.Status.ON_WAY: Cart.Status.DELIVERED, Cart.Status.RECEIVED: Cart.Status.APPROVED}
+# the transitions applied when a customer reports a cart as received
+RECEIVE_TRANSITIONS = {Cart.Status.ON_WAY: Cart.Status.RECEIVED, Cart.Status.DELIVERED: Cart.Status.APPROVED}
+
+lock_stats = {'acquired': 0, 'timeouts': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+
+@metrics.register
+def lock_stats_prometheus():
+    return '\n'.join([
+        '# HELP cart_lock_acquired_total cart locks acquired',
+        '# TYPE cart_lock_acquired_total counter',
+        f'cart_lock_acquired_total {lock_stats["acquired"]}',
+        '# HELP cart_lock_timeouts_total cart updates refused because the cart stayed locked',
+        '# TYPE cart_lock_timeouts_total counter',
+        f'cart_lock_timeouts_total {lock_stats["timeouts"]}',
+        '# HELP cart_lock_wait_seconds_total time spent waiting for the cart locks acquired',
+        '# TYPE cart_lock_wait_seconds_total counter',
+        f'cart_lock_wait_seconds_total {lock_stats["wait_seconds"]}',
+        '# HELP cart_lock_max_wait_seconds longest wait for a cart lock',
+        '# TYPE cart_lock_max_wait_seconds gauge',
+        f'cart_lock_max_wait_seconds {lock_stats["max_wait_seconds"]}',
+    ]) + '\n'
+
+
+class CartLockTimeout(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'the cart is being updated by another request, try again later'
+    default_code = 'cart_locked'
+
+
+class BaseCartLock:
+    """
+    serialize the updates of a cart across processes and hosts, the lock is held by a transaction
+    opened on enter and is released when it ends, on enter the cart is reloaded and returned
+    """
+
+    def __init__(self, cart, timeout):
+        self.cart = cart
+        self.timeout = timeout
+        self.atomic = transaction.atomic()
+
+    def acquire(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        self.atomic.__enter__()
+        start = time.monotonic()
+        try:
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL lock_timeout = %s", [f'{int(self.timeout * 1000)}ms'])
+            self.acquire()
+        except OperationalError as e:
+            self.atomic.__exit__(type(e), e, e.__traceback__)
+            lock_stats['timeouts'] += 1
+            logger.warning('timeout while waiting for the lock of cart %s', self.cart.pk)
+            raise CartLockTimeout() from e
+        waited = time.monotonic() - start
+        lock_stats['acquired'] += 1
+        lock_stats['wait_seconds'] += waited
+        lock_stats['max_wait_seconds'] = max(lock_stats['max_wait_seconds'], waited)
+        logger.debug('waited %.4fs for the lock of cart %s', waited, self.cart.pk)
+        self.cart.refresh_from_db()
+        return self.cart
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.atomic.__exit__(exc_type, exc_val, exc_tb)
+
+
+class RowCartLock(BaseCartLock):
+    """lock the row of the cart with SELECT ... FOR UPDATE"""
+
+    def acquire(self):
+        list(Cart.objects.select_for_update().filter(pk=self.cart.pk).values_list('pk'))
+
+
+class AdvisoryCartLock(BaseCartLock):
+    """take a transaction level postgres advisory lock on the cart id, without touching the cart row"""
+
+    def acquire(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [ADVISORY_LOCK_NAMESPACE, self.cart.pk])
+
+
+def cart_lock(cart):
+    backend = import_string(getattr(settings, 'CART_LOCK_BACKEND', 'store.carts.RowCartLock'))
+    return backend(cart, getattr(settings, 'CART_LOCK_TIMEOUT', 5))
+
+
+def add_cart_items(cart, products, replace=False):
+    """
+    add the given products to the cart (a product given n times is added n times),
+    or replace its content with them if replace is set, in a constant number of queries
+    """
+    counter = Counter(product.id for product in products)
+    if not counter:
+        return
+    quote = connection.ops.quote_name
+    table = quote(CartItem._meta.db_table)
+    cart_column, product_column, count_column = (quote(CartItem._meta.get_field(name).column)
+                                                 for name in ('cart', 'product', 'count'))
+    # the unique (cart, product) constraint makes adding to the existing items a single upsert
+    sql = f"INSERT INTO {table} ({cart_column}, {product_column}, {count_column}) " \
+          f"VALUES {', '.join(['(%s, %s, %s)'] * len(counter))} " \
+          f"ON CONFLICT ({cart_column}, {product_column}) " \
+          f"DO UPDATE SET {count_column} = {table}.{count_column} + EXCLUDED.{count_column}"
+    params = [value for product_id, count in counter.items() for value in (cart.pk, product_id, count)]
+    with transaction.atomic():
+        if replace:
+            CartItem.objects.filter(cart=cart).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+
+@contextmanager
+def one_draft_per_customer():
+    """turn a violation of the one draft cart per customer constraint into a validation error"""
+    try:
+        with transaction.atomic():
+            yield
+    except IntegrityError as e:
+        if DRAFT_CART_CONSTRAINT not in str(e):
+            raise
+        raise ValidationError({'status': 'there is already a draft cart, you can\'t make new one'}) from e
+
+
+def apply_transitions(cart_ids, transitions):
+    """
+    move the given carts to the status mapped to their current one in transitions with a single
+    conditional UPDATE (compare-and-swap on the status), so concurrent transitions can't both apply.
+    returns {cart id: new status} for the updated carts, the missing ids are conflicts
+    """
+    cart_ids = list(cart_ids)
+    if not cart_ids or not transitions:
+        return {}
+    quote = connection.ops.quote_name
+    status_column = quote(Cart._meta.get_field('status').column)
+    version_column = quote(Cart._meta.get_field('version').column)
+    cases = ' '.join(['WHEN %s THEN %s'] * len(transitions))
+    sql = f"UPDATE {quote(Cart._meta.db_table)} SET {status_column} = CASE {status_column} {cases} END, " \
+          f"{version_column} = {version_column} + 1 " \
+          f"WHERE {quote(Cart._meta.pk.column)} IN ({', '.join(['%s'] * len(cart_ids))}) " \
+          f"AND {status_column} IN ({', '.join(['%s'] * len(transitions))}) " \
+          f"RETURNING {quote(Cart._meta.pk.column)}, {status_column}"
+    params = [value for item in transitions.items() for value in item] + cart_ids + list(transitions)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return dict(cursor.fetchall())
@@ -0,0 +1,99 @@
+from calendar import timegm
+
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.utils.timezone import now
+from taggit.models import Tag, TaggedItem
+
+from .models import DataVersion, Product
+
+# the products, their tags and recommendations, everything a product list or page shows
+CATALOG = 'catalog'
+# all the co-purchase scores, bumped by a full rebuild of them
+CO_PURCHASES = 'co-purchases'
+
+
+def co_purchases_of(product_id):
+    """the name of the co-purchase scores of a product, its bought together products"""
+    return f'{CO_PURCHASES}:{product_id}'
+
+
+def bump_version(*names):
+    """
+    mark the data named names as changed once the transaction commits, right away outside of one.
+    the rows of names are updated by a statement of their own, in autocommit, the transactions of the
+    writers don't hold their locks and don't wait on each other. the new versions are only visible once
+    the change is, a reader can't cache the previous data under them
+    """
+    if names:
+        transaction.on_commit(lambda: _increment_versions(sorted(set(names))))
+
+
+def _increment_versions(names):
+    table = connection.ops.quote_name(DataVersion._meta.db_table)
+    with connection.cursor() as cursor:
+        # a single statement whatever the number of names, the rows are locked in name order
+        cursor.execute(f"INSERT INTO {table} (name, version, updated_at) "
+                       f"SELECT name, 1, %s FROM unnest(%s::varchar[]) AS names(name) "
+                       f"ON CONFLICT (name) DO UPDATE SET version = {table}.version + 1, "
+                       f"updated_at = EXCLUDED.updated_at", [now(), names])
+
+
+def get_versions(*names):
+    """{name: (version, updated at)} in a single query, (0, None) for data never written"""
+    versions = dict.fromkeys(names, (0, None))
+    versions.update((name, (version, updated_at)) for name, version, updated_at in
+                    DataVersion.objects.filter(name__in=names).values_list('name', 'version', 'updated_at'))
+    return versions
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def product_changed(sender, **kwargs):
+    bump_version(CATALOG)
+
+
+@receiver(m2m_changed, sender=TaggedItem)
+def product_tags_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version(CATALOG)
+
+
+class ConditionalGetMixin:
+    """
+    answer a GET with 304 Not Modified, before the queryset runs and the response is serialized,
+    when the If-None-Match or If-Modified-Since headers match the validators of the representation
+    """
+
+    def get_validators(self):
+        """(version stamp, last modified datetime or None) of the representation"""
+        raise NotImplementedError
+
+    def conditional_response(self, request):
+        """a 304 or 412 response when the preconditions of the request don't hold, else None"""
+        self.load_validators()
+        return get_conditional_response(request, etag=self.etag, last_modified=self.last_modified)
+
+    def load_validators(self):
+        stamp, last_modified = self.get_validators()
+        self.etag = quote_etag(stamp)
+        self.last_modified = timegm(last_modified.utctimetuple()) if last_modified is not None else None
+
+    def set_validators(self, response):
+        response['ETag'] = self.etag
+        if self.last_modified is not None:
+            response['Last-Modified'] = http_date(self.last_modified)
+        return response
+
+    def get(self, request, *args, **kwargs):
+        response = self.conditional_response(request) or self.get_response(request, *args, **kwargs)
+        return self.set_validators(response)
+
+    def get_response(self, request, *args, **kwargs):
+        """the full response, once the validators are loaded"""
+        return super().get(request, *args, **kwargs)
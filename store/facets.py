@@ -0,0 +1,75 @@
+from collections import Counter
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import Count, F
+from django.db.models.signals import m2m_changed, pre_delete
+from django.dispatch import receiver
+from taggit.models import TaggedItem
+
+from .models import Product, TagCount
+from .search import SearchResults
+
+
+def adjust_tag_counts(deltas):
+    """add deltas, {tag id: change of its number of products}, to the tag counts with a single upsert"""
+    deltas = sorted((tag_id, delta) for tag_id, delta in deltas.items() if delta)
+    if not deltas:
+        return
+    quote = connection.ops.quote_name
+    table = quote(TagCount._meta.db_table)
+    # the rows are locked in the tag id order, so concurrent updates don't deadlock
+    sql = f"INSERT INTO {table} (tag_id, count) VALUES {', '.join(['(%s, %s)'] * len(deltas))} " \
+          f"ON CONFLICT (tag_id) DO UPDATE SET count = {table}.count + EXCLUDED.count"
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [value for delta in deltas for value in delta])
+
+
+def product_tag_counts(filters):
+    """{tag id: number of products} of the tagged products matching filters"""
+    return dict(TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Product), **filters)
+                .order_by().values('tag_id').annotate(count=Count('id')).values_list('tag_id', 'count'))
+
+
+def rebuild_tag_counts():
+    """recount every tag, for the writes which bypass the signals (e.g. a COPY)"""
+    TagCount.objects.all().delete()
+    TagCount.objects.bulk_create([TagCount(tag_id=tag_id, count=count)
+                                  for tag_id, count in product_tag_counts({}).items()])
+
+
+@receiver(m2m_changed, sender=TaggedItem)
+def product_tags_changed(sender, instance, action, pk_set, **kwargs):
+    if not isinstance(instance, Product):
+        return
+    if action == 'pre_clear':
+        instance._cleared_tag_ids = list(instance.tags.values_list('id', flat=True))
+    elif action == 'post_clear':
+        adjust_tag_counts(Counter({tag_id: -1 for tag_id in getattr(instance, '_cleared_tag_ids', ())}))
+    elif action in ('post_add', 'post_remove'):
+        # taggit only puts the tags actually added or removed in pk_set
+        adjust_tag_counts({tag_id: 1 if action == 'post_add' else -1 for tag_id in pk_set})
+
+
+@receiver(pre_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    # its tagged items are deleted with it, without m2m_changed
+    adjust_tag_counts({tag_id: -count for tag_id, count in product_tag_counts({'object_id': instance.pk}).items()})
+
+
+def tag_facets(products=None, limit=50):
+    """
+    [{'name': tag name, 'count': number of products}, ...] of the products, a queryset or SearchResults,
+    the most used tags first. every product by default, read from the tag counts
+    """
+    if products is None:
+        facets = TagCount.objects.filter(count__gt=0).annotate(name=F('tag__name'))
+    else:
+        if isinstance(products, SearchResults):
+            product_ids = products.product_ids
+        else:
+            product_ids = products.order_by().values('id')
+        facets = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Product),
+                                           object_id__in=product_ids) \
+            .values(name=F('tag__name')).annotate(count=Count('id'))
+    return list(facets.order_by('-count', 'name').values('name', 'count')[:limit])
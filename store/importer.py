@@ -0,0 +1,233 @@
+import csv
+import functools
+import itertools
+import json
+import operator
+from collections import Counter
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Case, When, Value, F, Q
+from taggit.models import Tag, TaggedItem
+
+from .models import Product
+from .recommendations import refresh_recommendations
+from .search_index import product_index
+from .conditional import bump_version, CATALOG
+from .facets import adjust_tag_counts, product_tag_counts
+
+CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 100
+FORMATS = ('ndjson', 'csv', 'json')
+
+
+def resolve_tags(names):
+    """the tags with the given names, the missing ones are created, {name: tag}"""
+    names = set(names)
+    if not names:
+        return {}
+    tags = {tag.name: tag for tag in Tag.objects.filter(name__in=names)}
+    missing = [Tag(name=name, slug=Tag().slugify(name)) for name in names - set(tags)]
+    while missing:
+        Tag.objects.bulk_create(missing, ignore_conflicts=True)
+        tags.update((tag.name, tag) for tag in Tag.objects.filter(name__in=[tag.name for tag in missing]))
+        # a slug already taken by another name
+        missing = [tag for tag in missing if tag.name not in tags]
+        if missing:
+            number_slugs(missing)
+    return tags
+
+
+def number_slugs(tags):
+    """give the tags the first free <slug>_<n>, the way taggit does, with a single query"""
+    max_length = Tag._meta.get_field('slug').max_length
+    # room for the number
+    bases = [tag.slug[:max_length - 8] for tag in tags]
+    taken = set(Tag.objects.filter(functools.reduce(operator.or_, [Q(slug__startswith=f'{base}_')
+                                                                  for base in set(bases)]))
+                .values_list('slug', flat=True))
+    for tag, base in zip(tags, bases):
+        number = 1
+        while f'{base}_{number}' in taken:
+            number += 1
+        tag.slug = f'{base}_{number}'
+        taken.add(tag.slug)
+
+
+def set_tags(product, names):
+    """
+    make names the tags of the product by adding and removing only the differences,
+    returns the ids of its previous tags, None when they didn't change
+    """
+    current = dict(product.tags.values_list('name', 'id'))
+    names = set(names)
+    removed, added = set(current) - names, names - set(current)
+    if not removed and not added:
+        return None
+    if removed:
+        product.tags.remove(*removed)
+    if added:
+        product.tags.add(*resolve_tags(added).values())
+    return list(current.values())
+
+
+def read_ndjson(lines):
+    for line_number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as e:
+                yield line_number, e
+
+
+def read_csv(lines):
+    """the tags column holds comma separated names"""
+    for line_number, row in enumerate(csv.DictReader(lines), 2):
+        if row.get('tags') is not None:
+            row['tags'] = [name.strip() for name in row['tags'].split(',') if name.strip()]
+        yield line_number, row
+
+
+def read_json(items):
+    yield from enumerate(items, 1)
+
+
+READERS = {'ndjson': read_ndjson, 'csv': read_csv, 'json': read_json}
+
+
+def clean_row(row):
+    """validate a product row, raises ValueError"""
+    if isinstance(row, ValueError):
+        raise ValueError(f'invalid row: {row}')
+    if not isinstance(row, dict):
+        raise ValueError('a product must be an object')
+    product = {}
+    name = row.get('name')
+    max_length = Product._meta.get_field('name').max_length
+    if not isinstance(name, str) or not name.strip() or len(name) > max_length:
+        raise ValueError(f'name must be a non empty string of at most {max_length} characters')
+    product['name'] = name
+    if row.get('description') not in (None, ''):
+        product['description'] = str(row['description'])
+    if row.get('rate') not in (None, ''):
+        try:
+            product['rate'] = float(row['rate'])
+        except (TypeError, ValueError):
+            raise ValueError('rate must be a number')
+    sku = row.get('sku')
+    if sku not in (None, ''):
+        if len(str(sku)) > Product._meta.get_field('sku').max_length:
+            raise ValueError('sku is too long')
+        product['sku'] = str(sku)
+    if row.get('tags') is not None:
+        tags = row['tags']
+        if not isinstance(tags, list) or not all(isinstance(tag, str) and tag for tag in tags):
+            raise ValueError('tags must be a list of names')
+        product['tags'] = tags
+    return product
+
+
+def _import_chunk(rows, report):
+    # the last row of a sku wins
+    by_sku = {}
+    for row in rows:
+        if 'sku' in row:
+            by_sku[row['sku']] = row
+    rows = [row for row in rows if 'sku' not in row] + list(by_sku.values())
+    tags = resolve_tags(itertools.chain.from_iterable(row.get('tags', ()) for row in rows))
+
+    existing = Product.objects.in_bulk(list(by_sku), field_name='sku')
+    to_create, to_update, update_fields = [], [], set()
+    for row in rows:
+        fields = {field: value for field, value in row.items() if field != 'tags'}
+        product = existing.get(row.get('sku'))
+        if product is None:
+            product = Product(**fields)
+            to_create.append(product)
+            row['created'] = True
+        else:
+            for field, value in fields.items():
+                setattr(product, field, value)
+            update_fields.update(fields)
+            to_update.append(product)
+        row['product'] = product
+    Product.objects.bulk_create(to_create)
+    if to_update:
+        Product.objects.bulk_update(to_update, sorted(update_fields - {'sku'}))
+
+    # the tags of a row replace the ones of the product
+    tagged = [row for row in rows if 'tags' in row]
+    content_type = ContentType.objects.get_for_model(Product)
+    updated_ids = [row['product'].id for row in tagged if not row.get('created')]
+    tag_counts = Counter()
+    if updated_ids:
+        tag_counts.subtract(product_tag_counts({'object_id__in': updated_ids}))
+        TaggedItem.objects.filter(content_type=content_type, object_id__in=updated_ids).delete()
+    tagged_items = TaggedItem.objects.bulk_create([TaggedItem(content_type=content_type, object_id=row['product'].id,
+                                                              tag=tags[name])
+                                                   for row in tagged for name in set(row['tags'])])
+    # bulk writes send no m2m_changed
+    tag_counts.update(item.tag_id for item in tagged_items)
+    adjust_tag_counts(tag_counts)
+    report['created'] += len(to_create)
+    report['updated'] += len(to_update)
+    return [row['product'].id for row in rows]
+
+
+def import_products(rows, chunk_size=CHUNK_SIZE, recommendations=True):
+    """
+    create or update (when their sku exists) the products of rows, an iterable of (line number, row),
+    chunk_size rows at a time so the memory doesn't depend on the input size. each chunk is imported in
+    one transaction with a constant number of queries, the invalid rows are skipped and reported.
+    the search index and, unless recommendations is False, the recommendations affected by the products
+    of a chunk are refreshed after it.
+    returns {'created': n, 'updated': n, 'skipped': n, 'errors': [{'line': n, 'error': message}, ...]},
+    only the first MAX_REPORTED_ERRORS errors are listed
+    """
+    report = {'created': 0, 'updated': 0, 'skipped': 0, 'errors': []}
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, chunk_size))
+        if not batch:
+            break
+        chunk = []
+        for line_number, row in batch:
+            try:
+                chunk.append(clean_row(row))
+            except ValueError as e:
+                report['skipped'] += 1
+                if len(report['errors']) < MAX_REPORTED_ERRORS:
+                    report['errors'].append({'line': line_number, 'error': str(e)})
+        if chunk:
+            with transaction.atomic():
+                product_ids = _import_chunk(chunk, report)
+            # bulk writes don't send the signals which keep them up to date
+            product_index.refresh_products(product_ids)
+            if recommendations:
+                refresh_recommendations(product_ids)
+    if report['created'] or report['updated']:
+        bump_version(CATALOG)
+    return report
+
+
+def update_products(changes):
+    """
+    apply per product changes, [{'id': id, field: value, ...}, ...], with a single UPDATE where
+    each column is only set on the products whose change has it. returns (updated ids, missing ids)
+    """
+    ids = {change['id'] for change in changes}
+    existing = set(Product.objects.filter(id__in=ids).values_list('id', flat=True))
+    changes = [change for change in changes if change['id'] in existing]
+    fields = sorted({field for change in changes for field in change} - {'id'})
+    if fields:
+        Product.objects.filter(id__in=existing).update(**{
+            field: Case(*[When(id=change['id'], then=Value(change[field])) for change in changes if field in change],
+                        default=F(field), output_field=Product._meta.get_field(field))
+            for field in fields})
+        # a queryset update sends no signal
+        product_index.update_products(existing)
+        bump_version(CATALOG)
+        rated = [change['id'] for change in changes if 'rate' in change]
+        if rated:
+            refresh_recommendations(rated)
+    return sorted(existing), sorted(ids - existing)
@@ -0,0 +1,31 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from taggit.models import TaggedItem
+
+from restsite.serializers import group_by
+from .models import Product, ProductRecommendation, ProductCoPurchase, CartItem
+from .recommendations import RECOMMEND_COUNT
+
+
+def load_product_tags(product_ids):
+    items = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Product),
+                                      object_id__in=product_ids).order_by('id').values_list('object_id', 'tag__name')
+    return group_by(items, lambda row: row[0], lambda row: row[1])
+
+
+def load_recommendations(product_ids):
+    recommendations = ProductRecommendation.objects.filter(product_id__in=product_ids).select_related('recommended')
+    return group_by(recommendations, lambda row: row.product_id, lambda row: row.recommended)
+
+
+def load_bought_together(product_ids):
+    co_purchases = ProductCoPurchase.objects.filter(product_id__in=product_ids).annotate(
+        position=Window(RowNumber(), partition_by=F('product_id'), order_by=[F('score').desc(), F('other_id').asc()])
+    ).filter(position__lte=RECOMMEND_COUNT).select_related('other').order_by('product_id', 'position')
+    return group_by(co_purchases, lambda row: row.product_id, lambda row: row.other)
+
+
+def load_cart_items(cart_ids):
+    items = CartItem.objects.filter(cart_id__in=cart_ids).select_related('product').order_by('id')
+    return group_by(items, lambda row: row.cart_id)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from store.recommendations import build_bought_together
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the "bought together" co-purchase scores from the ordered carts'
+
+    def handle(self, *args, **options):
+        created = build_bought_together()
+        self.stdout.write(self.style.SUCCESS(f'{created} co-purchase pairs built'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.recommendations import build_recommendations, RECOMMEND_COUNT
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the materialized tag-similarity recommendations of all products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=RECOMMEND_COUNT, help='recommendations kept per product')
+
+    def handle(self, *args, **options):
+        created = build_recommendations(count=options['count'])
+        self.stdout.write(self.style.SUCCESS(f'{created} recommendations built'))
@@ -0,0 +1,45 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.importer import READERS, CHUNK_SIZE, import_products
+from store.recommendations import build_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Create or update (by sku) products from a NDJSON or CSV file, streamed in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='file to import, - for the standard input')
+        parser.add_argument('--format', choices=['ndjson', 'csv'],
+                            help='guessed from the file extension when omitted')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        recommendations = parser.add_mutually_exclusive_group()
+        recommendations.add_argument('--skip-recommendations', action='store_true',
+                                     help='don\'t refresh the recommendations of the imported products')
+        recommendations.add_argument('--rebuild-recommendations', action='store_true',
+                                     help='rebuild the recommendations of the whole catalog after the import, '
+                                          'instead of refreshing the ones of the imported products chunk by chunk')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or ('csv' if options['path'].endswith('.csv') else 'ndjson')
+        if options['path'] == '-':
+            report = self.run(sys.stdin, file_format, options)
+        else:
+            try:
+                with open(options['path'], newline='', encoding='utf-8') as f:
+                    report = self.run(f, file_format, options)
+            except OSError as e:
+                raise CommandError(e)
+        for error in report['errors']:
+            self.stderr.write(f'line {error["line"]}: {error["error"]}')
+        self.stdout.write(self.style.SUCCESS(f'{report["created"]} products created, {report["updated"]} updated, '
+                                             f'{report["skipped"]} skipped'))
+
+    def run(self, f, file_format, options):
+        report = import_products(READERS[file_format](f), options['chunk_size'],
+                                 recommendations=not (options['skip_recommendations'] or
+                                                      options['rebuild_recommendations']))
+        if options['rebuild_recommendations'] and (report['created'] or report['updated']):
+            build_recommendations()
+        return report
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from store.tokens import prune_blacklisted_tokens
+
+
+class Command(BaseCommand):
+    help = 'Delete the blacklisted tokens which have expired, meant to run periodically (e.g. from cron)'
+
+    def handle(self, *args, **options):
+        deleted = prune_blacklisted_tokens()
+        self.stdout.write(self.style.SUCCESS(f'{deleted} expired tokens deleted'))
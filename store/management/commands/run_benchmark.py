@@ -0,0 +1,33 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from store.benchmark import SCENARIOS, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Time the main endpoints against the current data (see seed_data) and write the results as JSON ' \
+           'so runs can be compared between commits, the cart scenarios create carts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+        parser.add_argument('--requests', type=int, default=200, help='number of requests of each scenario')
+        parser.add_argument('--random-seed', type=int, default=0)
+        parser.add_argument('--output', help='JSON file to write the results to, printed when omitted')
+        parser.add_argument('--websocket-workers', type=int, default=0,
+                            help='processes the websocket-fanout subscribers are spread over, they need a shared '
+                                 'channel layer, 0 runs them in this process')
+        parser.add_argument('--websocket-subscribers', type=int, default=20,
+                            help='subscribers of the chat of the websocket-fanout scenario')
+
+    def handle(self, *args, **options):
+        scenario_options = {'websocket-fanout': {'workers': options['websocket_workers'],
+                                                 'subscribers': options['websocket_subscribers']}}
+        report = run_benchmarks(options['scenarios'], options['requests'], options['random_seed'],
+                                log=self.stderr.write, options=scenario_options)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'results written to {options["output"]}'))
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from store.notifications import send_pending_notifications
+
+
+class Command(BaseCommand):
+    help = 'Send the queued cart status emails, polling the outbox until stopped unless --once is given'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='send the due notifications and exit')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'NOTIFICATION_BATCH_SIZE', 100))
+        parser.add_argument('--interval', type=float, default=5, help='seconds between two polls when idle')
+
+    def handle(self, *args, **options):
+        while True:
+            # a full batch means there may be more due notifications, don't wait
+            while True:
+                sent, failed = send_pending_notifications(options['batch_size'])
+                if sent or failed:
+                    self.stdout.write(f'{sent} notifications sent, {failed} failed')
+                if sent + failed < options['batch_size']:
+                    break
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from store.benchmark import seed
+
+
+class Command(BaseCommand):
+    help = 'Add synthetic products, users, carts and chat messages for load benchmarks, with COPY on postgres'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=0)
+        parser.add_argument('--tags', type=int, default=100, help='number of distinct tags')
+        parser.add_argument('--tags-per-product', type=int, default=3)
+        parser.add_argument('--users', type=int, default=0)
+        parser.add_argument('--carts', type=int, default=0)
+        parser.add_argument('--cart-items', type=int, default=0, help='total number of cart items')
+        parser.add_argument('--chats', type=int, default=0)
+        parser.add_argument('--messages', type=int, default=0, help='total number of chat messages')
+        parser.add_argument('--random-seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=50000)
+
+    def handle(self, *args, **options):
+        seed(products=options['products'], tags=options['tags'], tags_per_product=options['tags_per_product'],
+             users=options['users'], carts=options['carts'], cart_items=options['cart_items'],
+             chats=options['chats'], messages=options['messages'], random_seed=options['random_seed'],
+             batch_size=options['batch_size'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS('seeding done, run build_recommendations and build_bought_together '
+                                             'to compute the recommendations of the new data'))
@@ -0,0 +1,175 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {cumulative}'
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.queries = Histogram(QUERIES_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+        self.sql_seconds = 0.0
+        self.budget_exceeded = 0
+
+
+class Metrics:
+    """the measures of each (protocol, endpoint), kept per process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # the prometheus() of the other components of the process (caches, queues...)
+        self.providers = []
+        self.reset()
+
+    def reset(self):
+        self.endpoints = defaultdict(EndpointMetrics)
+
+    def register(self, provider):
+        """add provider(), metrics in the prometheus text format, to the exposition"""
+        self.providers.append(provider)
+        return provider
+
+    def exposition(self):
+        """the metrics of the process, the ones of the requests and the registered ones"""
+        return self.prometheus() + ''.join(provider() for provider in self.providers)
+
+    def record(self, protocol, endpoint, duration, queries, sql_seconds, response_bytes, budget=None):
+        with self.lock:
+            metrics = self.endpoints[protocol, endpoint]
+            metrics.duration.observe(duration)
+            metrics.queries.observe(queries)
+            metrics.response_bytes.observe(response_bytes)
+            metrics.sql_seconds += sql_seconds
+            exceeded = budget is not None and queries > budget
+            if exceeded:
+                metrics.budget_exceeded += 1
+        if exceeded:
+            message = f'{protocol} {endpoint} ran {queries} queries, its budget is {budget}'
+            if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+
+    def prometheus(self):
+        """the metrics in the prometheus text exposition format"""
+        families = [
+            ('request_duration_seconds', 'histogram', 'time spent handling the request or operation',
+             lambda m: m.duration),
+            ('request_queries', 'histogram', 'SQL queries run by the request or operation', lambda m: m.queries),
+            ('response_size_bytes', 'histogram', 'size of the response body or message',
+             lambda m: m.response_bytes),
+            ('request_sql_duration_seconds_total', 'counter', 'time spent in SQL queries',
+             lambda m: m.sql_seconds),
+            ('query_budget_exceeded_total', 'counter', 'requests which ran more queries than their budget',
+             lambda m: m.budget_exceeded),
+        ]
+        with self.lock:
+            lines = []
+            for name, kind, help_text, value in families:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+                for (protocol, endpoint), metrics in sorted(self.endpoints.items()):
+                    labels = f'protocol="{protocol}",endpoint="{endpoint}"'
+                    if kind == 'histogram':
+                        lines += value(metrics).samples(name, labels)
+                    else:
+                        lines.append(f'{name}{{{labels}}} {value(metrics)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class QueryCounter:
+    """execute wrapper counting the queries and the time spent in them"""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+    """
+    record the latency, queries and response size of every request under its url name.
+    views can declare a query_budget, {method: max queries}, exceeding it is logged
+    (or raised with QUERY_BUDGET_STRICT)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+        match = request.resolver_match
+        endpoint = (match.url_name or match.view_name) if match is not None else 'unresolved'
+        view_class = getattr(getattr(match, 'func', None), 'view_class', None)
+        budget = getattr(view_class, 'query_budget', {}).get(request.method)
+        size = len(response.content) if not response.streaming else 0
+        metrics.record('http', endpoint, duration, counter.queries, counter.seconds, size, budget)
+        return response
+
+
+def instrument(operation, query_budget=None):
+    """
+    record a websocket operation like the middleware records requests, for the synchronous
+    functions wrapped by database_sync_to_async (the queries run in their thread), the size is
+    the one of the returned message
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            counter = QueryCounter()
+            start = time.perf_counter()
+            with connection.execute_wrapper(counter):
+                result = func(*args, **kwargs)
+            size = len(result) if isinstance(result, (str, bytes)) else 0
+            metrics.record('websocket', operation, time.perf_counter() - start, counter.queries, counter.seconds,
+                           size, query_budget)
+            return result
+        return wrapper
+    return decorator
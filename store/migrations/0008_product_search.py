@@ -0,0 +1,70 @@
+# Generated by Django 4.2.1 on 2026-10-18 08:07
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+SEARCH_VECTOR_SQL = [
+    """
+    CREATE OR REPLACE FUNCTION store_product_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', coalesce(NEW.name, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(NEW.description, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER store_product_search_vector_trigger BEFORE INSERT OR UPDATE ON store_product
+    FOR EACH ROW EXECUTE FUNCTION store_product_search_vector_update()
+    """,
+    "UPDATE store_product SET search_vector = NULL",
+    "CREATE INDEX store_product_search_vector_idx ON store_product USING gin (search_vector)",
+]
+
+TRIGRAM_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX store_product_name_trgm_idx ON store_product USING gin (name gin_trgm_ops)",
+    "CREATE INDEX store_product_description_trgm_idx ON store_product USING gin (description gin_trgm_ops)",
+]
+
+
+def create_search_indexes(apps, schema_editor):
+    # the trigger and the gin indexes are postgres only, pg_trgm may not be installable on every server
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for sql in SEARCH_VECTOR_SQL:
+        schema_editor.execute(sql)
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        has_trigram = cursor.fetchone() is not None
+    if has_trigram:
+        for sql in TRIGRAM_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS store_product_name_trgm_idx")
+    schema_editor.execute("DROP INDEX IF EXISTS store_product_description_trgm_idx")
+    schema_editor.execute("DROP INDEX IF EXISTS store_product_search_vector_idx")
+    schema_editor.execute("DROP TRIGGER IF EXISTS store_product_search_vector_trigger ON store_product")
+    schema_editor.execute("DROP FUNCTION IF EXISTS store_product_search_vector_update()")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0007_productcopurchase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.1 on 2026-10-18 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_product_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['order_date', 'id'], name='cart_order_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['customer', 'order_date', 'id'], name='cart_customer_order_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-rate', 'id'], name='product_rate_id_idx'),
+        ),
+    ]
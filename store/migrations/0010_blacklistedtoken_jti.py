@@ -0,0 +1,40 @@
+# Generated by Django 4.2.1 on 2026-10-18 09:02
+
+import datetime
+
+import jwt
+from django.db import migrations, models
+
+
+def tokens_to_jti(apps, schema_editor):
+    BlackListedToken = apps.get_model('store', 'BlackListedToken')
+    for blacklisted in BlackListedToken.objects.all():
+        try:
+            payload = jwt.decode(blacklisted.token, options={'verify_signature': False})
+            blacklisted.jti = payload['jti']
+            blacklisted.expires_at = datetime.datetime.fromtimestamp(payload['exp'], tz=datetime.timezone.utc)
+        except (jwt.InvalidTokenError, KeyError):
+            blacklisted.delete()
+            continue
+        blacklisted.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blacklistedtoken',
+            name='jti',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='blacklistedtoken',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.RunPython(tokens_to_jti, migrations.RunPython.noop),
+    ]
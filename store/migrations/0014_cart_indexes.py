@@ -0,0 +1,51 @@
+# Generated by Django 4.2.1 on 2026-10-18 08:35
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_duplicates(apps, schema_editor):
+    Cart = apps.get_model('store', 'Cart')
+    CartItem = apps.get_model('store', 'CartItem')
+    # the items of the older drafts of a customer move to its newest draft
+    customers = Cart.objects.filter(status='Draft').values('customer').annotate(drafts=Count('id'))\
+        .filter(drafts__gt=1).values_list('customer', flat=True)
+    for customer_id in customers:
+        newest, *older = Cart.objects.filter(customer_id=customer_id, status='Draft').order_by('-id')
+        CartItem.objects.filter(cart__in=older).update(cart=newest)
+        Cart.objects.filter(id__in=[cart.id for cart in older]).delete()
+    # the same product twice in a cart becomes one item with the sum of the counts
+    duplicates = CartItem.objects.values('cart', 'product').annotate(items=Count('id'), total=Sum('count'))\
+        .filter(items__gt=1)
+    for duplicate in duplicates:
+        items = CartItem.objects.filter(cart_id=duplicate['cart'], product_id=duplicate['product']).order_by('id')
+        kept = items.first()
+        items.exclude(id=kept.id).delete()
+        CartItem.objects.filter(id=kept.id).update(count=duplicate['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_cartnotification'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['customer', 'status'], name='cart_customer_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['status', 'order_date'], name='cart_status_order_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'Draft')), fields=('customer',), name='unique_draft_cart_per_customer'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_item_product'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.1 on 2026-10-18 08:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_tags(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    TaggedItem = apps.get_model('taggit', 'TaggedItem')
+    TagCount = apps.get_model('store', 'TagCount')
+    content_type = ContentType.objects.filter(app_label='store', model='product').first()
+    if content_type is None:
+        return
+    counts = TaggedItem.objects.filter(content_type=content_type).order_by().values('tag_id') \
+        .annotate(count=models.Count('id')).values_list('tag_id', 'count')
+    TagCount.objects.bulk_create([TagCount(tag_id=tag_id, count=count) for tag_id, count in counts])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('taggit', '0005_auto_20220424_2025'),
+        ('store', '0016_conditional_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagCount',
+            fields=[
+                ('tag', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='product_count', serialize=False, to='taggit.tag')),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-count'], name='tag_count_idx')],
+            },
+        ),
+        migrations.RunPython(count_tags, migrations.RunPython.noop),
+    ]
@@ -1,21 +1,29 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from taggit.managers import TaggableManager
+from taggit.models import Tag
+from django.contrib.postgres.search import SearchVectorField
 from django.urls import reverse
 from django.dispatch import receiver
-from django.db.models.signals import pre_save
-from django.core.mail import send_mail
-from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.signals import pre_save, post_save
+from django.utils.timezone import now
 
 
 class Product(models.Model):
     name = models.CharField(max_length=50)
     description = models.TextField(default="")
     rate = models.FloatField(default=0)
+    # optional identifier from the catalog source, the key of the product imports
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)
     tags = TaggableManager()
+    # maintained by a database trigger on postgres, see migration 0008
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         ordering = ["-rate"]
+        indexes = [
+            models.Index(fields=["-rate", "id"], name="product_rate_id_idx"),
+        ]
 
     def __str__(self):
         return f"{self.name}"
@@ -24,6 +32,22 @@ class Product(models.Model):
         return reverse('RUD-product', kwargs={'pk': self.pk})
 
 
+class ProductRecommendation(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommendations')
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    same_tags = models.IntegerField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ["rank"]
+        constraints = [
+            models.UniqueConstraint(fields=["product", "rank"], name="unique_product_recommendation_rank"),
+        ]
+
+    def __str__(self):
+        return f"{self.recommended} for {self.product}"
+
+
 class Cart(models.Model):
     class Status(models.TextChoices):
         DRAFT = 'Draft', 'Draft'
@@ -37,30 +61,76 @@ class Cart(models.Model):
     customer = models.ForeignKey(User, on_delete=models.CASCADE, related_name="carts")
     order_date = models.DateTimeField(null=True)
     status = models.CharField(max_length=10, choices=Status.choices, default=Status.DRAFT)
+    # incremented by every write to the cart, the ETag of its representation
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["order_date", "id"], name="cart_order_date_id_idx"),
+            models.Index(fields=["customer", "order_date", "id"], name="cart_customer_order_date_idx"),
+            models.Index(fields=["customer", "status"], name="cart_customer_status_idx"),
+            models.Index(fields=["status", "order_date"], name="cart_status_order_date_idx"),
+        ]
+        constraints = [
+            # a customer has at most one draft cart
+            models.UniqueConstraint(fields=["customer"], condition=models.Q(status="Draft"),
+                                    name="unique_draft_cart_per_customer"),
+        ]
 
     def __str__(self):
         return f"cart for {self.customer} at:{self.order_date}"
 
+    # the status of the row when the instance was loaded or last saved, None for a new cart
+    _loaded_status = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        if fields is None or 'status' in fields:
+            self._loaded_status = self.status
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self.version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        # so the notifications queued by cart_pre_save are committed with the status change
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('RUD-cart', kwargs={'pk': self.pk})
 
 
 @receiver(pre_save, sender=Cart)
 def cart_pre_save(sender, instance, **kwargs):
-    try:
-        old_instance = sender.objects.get(pk=instance.pk)
-    except ObjectDoesNotExist:
+    # the status the cart was loaded with, no need to fetch the old row
+    old_status = instance._loaded_status
+    new_status = instance.status
+    if old_status is None or old_status == new_status:
         return
 
-    old_status = old_instance.status
-    new_status = instance.status
+    if old_status == sender.Status.DRAFT and new_status == sender.Status.ORDERED:
+        from .recommendations import add_ordered_cart
+        add_ordered_cart(instance.pk)
 
     if old_status == sender.Status.ORDERED and (new_status == Cart.Status.ON_WAY or new_status == Cart.Status.REJECTED):
-        subject = f"Your cart status updated"
-        message = f"Hello {instance.customer.username}\n" \
-                  f"Your cart with id:{instance.pk} which is ordered at:{instance.order_date}" \
-                  f" is {sender.Status(instance.status).label}"
-        send_mail(subject, message, 'pmsmanage0@gmail.com', [instance.customer.email])
+        # delivered by the run_notifications command, written in the transaction of the status change
+        CartNotification.objects.create(
+            cart=instance, recipient=instance.customer.email, subject="Your cart status updated",
+            message=f"Hello {instance.customer.username}\n"
+                    f"Your cart with id:{instance.pk} which is ordered at:{instance.order_date}"
+                    f" is {sender.Status(instance.status).label}")
+
+
+@receiver(post_save, sender=Cart)
+def cart_post_save(sender, instance, **kwargs):
+    instance._loaded_status = instance.status
 
 
 class CartItem(models.Model):
@@ -68,11 +138,89 @@ class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
     count = models.IntegerField(default=1)
 
+    class Meta:
+        constraints = [
+            # lets add_cart_items upsert the items
+            models.UniqueConstraint(fields=["cart", "product"], name="unique_cart_item_product"),
+        ]
+
+
+class ProductCoPurchase(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='co_purchases')
+    other = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    score = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ["-score", "other"]
+        constraints = [
+            models.UniqueConstraint(fields=["product", "other"], name="unique_product_co_purchase"),
+        ]
+        indexes = [
+            models.Index(fields=["product", "-score"], name="co_purchase_product_score_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.other} bought with {self.product}: {self.score}"
+
 
 class BlackListedToken(models.Model):
-    token = models.CharField(max_length=500)
+    jti = models.CharField(max_length=255, unique=True)
     user = models.ForeignKey(User, related_name="token_user", on_delete=models.CASCADE)
     timestamp = models.DateTimeField(auto_now=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+
+class UserTokenRevocation(models.Model):
+    """the tokens of the user issued before revoked_before are revoked, e.g. because its role changed"""
+    user = models.OneToOneField(User, related_name="token_revocation", on_delete=models.CASCADE)
+    revoked_before = models.DateTimeField(db_index=True)
+
+
+class CartNotification(models.Model):
+    """outbox of the cart status emails, sent by the run_notifications command"""
+    cart = models.ForeignKey(Cart, related_name="notifications", on_delete=models.CASCADE)
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=now)
+    last_error = models.TextField(blank=True, default="")
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # only the pending notifications are looked up
+            models.Index(fields=["next_attempt_at", "id"], name="notification_pending_idx",
+                         condition=models.Q(sent_at__isnull=True)),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {self.recipient}"
+
+
+class DataVersion(models.Model):
+    """
+    version stamp of a set of data (e.g. the catalog) bumped by every write to it, see store.conditional,
+    the validators of the responses built from that data
+    """
+    name = models.CharField(max_length=32, primary_key=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=now)
+
+    def __str__(self):
+        return f"{self.name} v{self.version}"
+
+
+class TagCount(models.Model):
+    """the number of products of each tag, kept up to date by store.facets"""
+    tag = models.OneToOneField(Tag, primary_key=True, related_name="product_count", on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
 
     class Meta:
-        unique_together = ("token", "user")
+        indexes = [
+            models.Index(fields=["-count"], name="tag_count_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.tag}: {self.count}"
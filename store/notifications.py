@@ -0,0 +1,65 @@
+import datetime
+import logging
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils.timezone import now
+
+from .models import CartNotification
+
+logger = logging.getLogger(__name__)
+
+
+def retry_delay(attempts):
+    """exponential backoff, NOTIFICATION_RETRY_DELAY seconds after the first failure then doubled"""
+    base = getattr(settings, 'NOTIFICATION_RETRY_DELAY', 60)
+    return datetime.timedelta(seconds=base * 2 ** (attempts - 1))
+
+
+def send_pending_notifications(batch_size=None):
+    """
+    send a batch of the due notifications over a single connection to the email backend,
+    returns (sent, failed). the rows are locked with SKIP LOCKED so several workers can run at once,
+    a failed notification is retried later until NOTIFICATION_MAX_ATTEMPTS is reached
+    """
+    batch_size = batch_size or getattr(settings, 'NOTIFICATION_BATCH_SIZE', 100)
+    max_attempts = getattr(settings, 'NOTIFICATION_MAX_ATTEMPTS', 5)
+    sent = failed = 0
+    with transaction.atomic():
+        notifications = list(CartNotification.objects.select_for_update(skip_locked=True)
+                             .filter(sent_at__isnull=True, attempts__lt=max_attempts, next_attempt_at__lte=now())
+                             .order_by('next_attempt_at', 'id')[:batch_size])
+        if not notifications:
+            return sent, failed
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            # nothing can be sent, the whole batch is retried later
+            connection = None
+            open_error = e
+        try:
+            for notification in notifications:
+                notification.attempts += 1
+                try:
+                    if connection is None:
+                        raise open_error
+                    EmailMessage(notification.subject, notification.message, settings.EMAIL_HOST_USER,
+                                 [notification.recipient], connection=connection).send()
+                except Exception as e:
+                    logger.warning('sending notification %s failed (attempt %s): %s',
+                                   notification.pk, notification.attempts, e)
+                    notification.last_error = str(e)
+                    notification.next_attempt_at = now() + retry_delay(notification.attempts)
+                    failed += 1
+                else:
+                    notification.sent_at = now()
+                    notification.last_error = ''
+                    sent += 1
+        finally:
+            if connection is not None:
+                connection.close()
+        CartNotification.objects.bulk_update(notifications,
+                                             ['attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+    return sent, failed
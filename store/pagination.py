@@ -0,0 +1,147 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connection
+from django.db.models import F, Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+def _cursor_value(value):
+    # full precision, DjangoJSONEncoder would cut the microseconds of the datetimes
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} can\'t be used in a cursor')
+
+
+def estimate_count(queryset):
+    """the planner estimation of the number of rows of the queryset, exact count on other databases"""
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class ResultsSetPagination(PageNumberPagination):
+    """
+    page number pagination, or keyset pagination when the request has a cursor parameter
+    (empty for the first page) and the view defines a keyset_ordering whose last field is unique.
+    keyset pages don't count the results unless count=estimate or count=exact is requested.
+    """
+    page_size = 5
+    page_size_query_param = 'page_size'
+    max_page_size = 10
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.ordering = None
+        if self.cursor_query_param in request.query_params and isinstance(queryset, QuerySet):
+            self.ordering = getattr(view, 'keyset_ordering', None)
+        if not self.ordering:
+            return super().paginate_queryset(queryset, request, view)
+        return self.paginate_keyset(queryset, request)
+
+    def get_paginated_response(self, data):
+        if not self.ordering:
+            return super().get_paginated_response(data)
+        response = OrderedDict([('next', self.next_link), ('previous', self.previous_link)])
+        if self.total is not None:
+            response['count'] = self.total
+        response['results'] = data
+        return Response(response)
+
+    def cursor_token(self, values, reverse):
+        payload = json.dumps({'v': values, 'r': reverse}, default=_cursor_value).encode()
+        return base64.urlsafe_b64encode(payload).decode()
+
+    def encode_cursor(self, values, reverse):
+        cursor = self.cursor_token(values, reverse)
+        # the total is only computed for the first page
+        url = remove_query_param(self.request.build_absolute_uri(), self.count_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, cursor):
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            values, reverse = payload['v'], bool(payload['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    def keyset_filter(self, model, values, reverse):
+        """rows strictly after the cursor values in the traversal order, nulls sort last"""
+        condition = None
+        for field, value in reversed(list(zip(self.ordering, values))):
+            descending, name = field.startswith('-'), field.lstrip('-')
+            try:
+                nullable = model._meta.get_field(name).null
+            except FieldDoesNotExist:
+                nullable = False
+            if value is None:
+                after = Q(**{f'{name}__isnull': False}) if reverse else Q(pk__in=[])
+                tie = Q(**{f'{name}__isnull': True})
+            else:
+                after = Q(**{f'{name}__{"lt" if descending != reverse else "gt"}': value})
+                if nullable and not reverse:
+                    after |= Q(**{f'{name}__isnull': True})
+                tie = Q(**{name: value})
+            condition = after if condition is None else after | (tie & condition)
+        return condition
+
+    def keyset_order(self, model, reverse):
+        """
+        the order by of the traversal, the null placement is only spelled out for the nullable and the
+        computed fields: on the others it would no longer match the indexes (a desc index sorts nulls first)
+        """
+        order = []
+        for field in self.ordering:
+            name = field.lstrip('-')
+            try:
+                nulls = model._meta.get_field(name).null
+            except FieldDoesNotExist:
+                nulls = True
+            nulls = ({'nulls_first': True} if reverse else {'nulls_last': True}) if nulls else {}
+            order.append(F(name).desc(**nulls) if field.startswith('-') != reverse else F(name).asc(**nulls))
+        return order
+
+    def row_values(self, row):
+        return [getattr(row, field.lstrip('-')) for field in self.ordering]
+
+    def paginate_keyset(self, queryset, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        values, reverse = self.decode_cursor(cursor) if cursor else (None, False)
+
+        count = request.query_params.get(self.count_query_param)
+        self.total = estimate_count(queryset) if count == 'estimate' else queryset.count() if count == 'exact' else None
+
+        page_queryset = queryset.order_by(*self.keyset_order(queryset.model, reverse))
+        if values is not None:
+            page_queryset = page_queryset.filter(self.keyset_filter(queryset.model, values, reverse))
+        rows = list(page_queryset[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+
+        self.next_link = self.previous_link = None
+        if rows:
+            if has_more or reverse:
+                self.next_link = self.encode_cursor(self.row_values(rows[-1]), False)
+            if (has_more and reverse) or (values is not None and not reverse):
+                self.previous_link = self.encode_cursor(self.row_values(rows[0]), True)
+        return rows
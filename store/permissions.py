@@ -1,11 +1,10 @@
 from rest_framework import permissions
-from django.contrib.auth.models import Group
-from .models import BlackListedToken
+from .tokens import revoked_tokens
 
 
 class IsOwner(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        return request.user.id == obj.customer.id
+        return request.user.id == obj.customer_id
 
 
 class IsAdminOrReadOnly(permissions.BasePermission):
@@ -17,18 +16,15 @@ class IsAdminOrReadOnly(permissions.BasePermission):
 
 class IsDelivery(permissions.BasePermission):
     def has_permission(self, request, view):
+        token = request.auth
+        if token is not None and 'role' in token:
+            return token['role'] == 'delivery'
         return request.user.groups.filter(name='delivery').exists()
 
 
 class IsTokenValid(permissions.BasePermission):
     def has_permission(self, request, view):
-        user_id = request.user.id
-        is_allowed_user = True
         token = request.auth
-        try:
-            is_blacklisted = BlackListedToken.objects.get(user=user_id, token=token)
-            if is_blacklisted:
-                is_allowed_user = False
-        except BlackListedToken.DoesNotExist:
-            is_allowed_user = True
-        return is_allowed_user
+        if token is None:
+            return True
+        return not revoked_tokens.is_revoked(token)
@@ -0,0 +1,176 @@
+import numpy as np
+from scipy import sparse
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction, connection
+from taggit.models import TaggedItem
+
+from .models import Product, ProductRecommendation, Cart, CartItem, ProductCoPurchase
+from .conditional import bump_version, co_purchases_of, CATALOG, CO_PURCHASES
+
+RECOMMEND_COUNT = 3
+CHUNK_SIZE = 1000
+# every status a cart can reach once it was ordered
+PURCHASED_STATUSES = [Cart.Status.ORDERED, Cart.Status.ON_WAY, Cart.Status.REJECTED, Cart.Status.RECEIVED,
+                      Cart.Status.DELIVERED, Cart.Status.APPROVED]
+
+
+def _tagged_items(product_ids=None, tag_ids=None):
+    items = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Product))
+    if product_ids is not None:
+        items = items.filter(object_id__in=product_ids)
+    if tag_ids is not None:
+        items = items.filter(tag_id__in=tag_ids)
+    return np.array(list(items.values_list('object_id', 'tag_id')), dtype=np.int64).reshape(-1, 2)
+
+
+def _incidence_matrix(pairs):
+    """build the product x tag matrix, returns it with the product ids of its rows"""
+    product_ids, rows = np.unique(pairs[:, 0], return_inverse=True)
+    _, cols = np.unique(pairs[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(pairs), dtype=np.int32), (rows, cols)),
+                               shape=(len(product_ids), cols.max() + 1 if len(pairs) else 0))
+    return matrix, product_ids
+
+
+def _top_neighbours(matrix, product_ids, rates, rows, count):
+    """yields (product_id, recommended_id, same_tags, rank) for the given row indexes"""
+    for start in range(0, len(rows), CHUNK_SIZE):
+        chunk = rows[start:start + CHUNK_SIZE]
+        shared = (matrix[chunk] @ matrix.T).tocsr()
+        for i, row in enumerate(chunk):
+            neighbours = shared.indices[shared.indptr[i]:shared.indptr[i + 1]]
+            same_tags = shared.data[shared.indptr[i]:shared.indptr[i + 1]]
+            mask = neighbours != row
+            neighbours, same_tags = neighbours[mask], same_tags[mask]
+            # same ordering as the old query: more shared tags first, then higher rate
+            order = np.lexsort((product_ids[neighbours], -rates[neighbours], -same_tags))[:count]
+            for rank, j in enumerate(order):
+                yield int(product_ids[row]), int(product_ids[neighbours[j]]), int(same_tags[j]), rank
+
+
+def _rates(product_ids):
+    rates = dict(Product.objects.filter(id__in=product_ids.tolist()).values_list('id', 'rate'))
+    return np.array([rates.get(int(product_id), 0) for product_id in product_ids], dtype=np.float64)
+
+
+def _recommendation_objects(matrix, product_ids, rows, count):
+    rates = _rates(product_ids)
+    return [ProductRecommendation(product_id=product_id, recommended_id=recommended_id,
+                                  same_tags=same_tags, rank=rank)
+            for product_id, recommended_id, same_tags, rank
+            in _top_neighbours(matrix, product_ids, rates, rows, count)]
+
+
+def build_recommendations(count=RECOMMEND_COUNT):
+    """recompute the recommendations of every product in one pass"""
+    matrix, product_ids = _incidence_matrix(_tagged_items())
+    objects = _recommendation_objects(matrix, product_ids, np.arange(len(product_ids)), count)
+    with transaction.atomic():
+        ProductRecommendation.objects.all().delete()
+        ProductRecommendation.objects.bulk_create(objects, batch_size=CHUNK_SIZE)
+        bump_version(CATALOG)
+    return len(objects)
+
+
+def _outranking(product_ids, count):
+    """
+    the products sharing a tag with product_ids whose recommendations one of product_ids enters: the
+    ones with less than count recommendations, or whose last one it now ranks before
+    """
+    pairs = _tagged_items(tag_ids=set(_tagged_items(product_ids=product_ids)[:, 1].tolist()))
+    if not len(pairs):
+        return set()
+    matrix, candidate_ids = _incidence_matrix(pairs)
+    changed = np.flatnonzero(np.isin(candidate_ids, list(product_ids)))
+    # candidates x changed products, the number of tags they share
+    shared = (matrix @ matrix[changed].T).toarray()
+    changed_ids = candidate_ids[changed]
+    rates = _rates(changed_ids)
+    last = {product_id: (same_tags, rate, -recommended_id) for product_id, same_tags, rate, recommended_id in
+            ProductRecommendation.objects.filter(product_id__in=candidate_ids.tolist(), rank=count - 1)
+            .values_list('product_id', 'same_tags', 'recommended__rate', 'recommended_id')}
+    outranking = set()
+    for row, candidate_id in enumerate(candidate_ids.tolist()):
+        if candidate_id in product_ids:
+            continue
+        # the ordering of _top_neighbours
+        best = max((int(same_tags), rate, -int(changed_id))
+                   for same_tags, rate, changed_id in zip(shared[row], rates, changed_ids) if same_tags)
+        if candidate_id not in last or best > last[candidate_id]:
+            outranking.add(candidate_id)
+    return outranking
+
+
+def recommending(product_ids):
+    """the products recommending one of product_ids"""
+    return set(ProductRecommendation.objects.filter(recommended_id__in=product_ids).values_list('product_id', flat=True))
+
+
+def refresh_recommendations(product_ids, recommending_ids=None, count=RECOMMEND_COUNT):
+    """
+    recompute the recommendations affected by a change in the tags or the rate of some products (or by
+    their deletion): the ones of the products themselves, of the products recommending them and of the
+    products sharing a tag with them whose recommendations they enter. the other products sharing a tag
+    are left alone, a popular tag doesn't make a write recompute a large part of the catalog.
+    the recommendations of deleted products are gone, recommending_ids are the products which recommended
+    them, see recommending
+    """
+    product_ids = set(product_ids)
+    if recommending_ids is None:
+        recommending_ids = recommending(product_ids)
+    affected_ids = product_ids | set(recommending_ids) | _outranking(product_ids, count)
+    # the candidates of the affected products are the ones sharing any of their tags
+    affected_tag_ids = set(_tagged_items(product_ids=affected_ids)[:, 1].tolist())
+    matrix, matrix_product_ids = _incidence_matrix(_tagged_items(tag_ids=affected_tag_ids))
+    rows = np.flatnonzero(np.isin(matrix_product_ids, list(affected_ids)))
+    objects = _recommendation_objects(matrix, matrix_product_ids, rows, count)
+    with transaction.atomic():
+        ProductRecommendation.objects.filter(product_id__in=affected_ids).delete()
+        ProductRecommendation.objects.bulk_create(objects, batch_size=CHUNK_SIZE)
+        bump_version(CATALOG)
+
+
+def build_bought_together():
+    """
+    recompute the co-purchase scores of every pair of products, the score of a pair being
+    the number of ordered carts containing both of them
+    """
+    pairs = np.array(list(CartItem.objects.filter(cart__status__in=PURCHASED_STATUSES)
+                          .values_list('cart_id', 'product_id').distinct()), dtype=np.int64).reshape(-1, 2)
+    cart_ids, rows = np.unique(pairs[:, 0], return_inverse=True)
+    product_ids, cols = np.unique(pairs[:, 1], return_inverse=True)
+    # product x cart matrix, its product with its transpose counts the carts shared by two products
+    matrix = sparse.csr_matrix((np.ones(len(pairs), dtype=np.int32), (cols, rows)),
+                               shape=(len(product_ids), len(cart_ids)))
+    created = 0
+    with transaction.atomic():
+        ProductCoPurchase.objects.all().delete()
+        for start in range(0, len(product_ids), CHUNK_SIZE):
+            shared = (matrix[start:start + CHUNK_SIZE] @ matrix.T).tocoo()
+            mask = shared.row + start != shared.col
+            objects = [ProductCoPurchase(product_id=int(product_ids[row + start]), other_id=int(product_ids[col]),
+                                         score=int(score))
+                       for row, col, score in zip(shared.row[mask], shared.col[mask], shared.data[mask])]
+            ProductCoPurchase.objects.bulk_create(objects, batch_size=CHUNK_SIZE)
+            created += len(objects)
+        bump_version(CO_PURCHASES)
+    return created
+
+
+def add_ordered_cart(cart_id):
+    """add the pairs of products of a newly ordered cart to the co-purchase scores"""
+    product_ids = sorted(set(CartItem.objects.filter(cart_id=cart_id).values_list('product_id', flat=True)))
+    pairs = [(product_id, other_id) for product_id in product_ids for other_id in product_ids
+             if product_id != other_id]
+    if not pairs:
+        return
+    table = connection.ops.quote_name(ProductCoPurchase._meta.db_table)
+    with connection.cursor() as cursor:
+        # a single statement whatever the size of the cart, the rows are locked in (product, other) order
+        cursor.execute(f"INSERT INTO {table} (product_id, other_id, score) "
+                       f"SELECT product_id, other_id, 1 "
+                       f"FROM unnest(%s::bigint[], %s::bigint[]) AS pairs(product_id, other_id) "
+                       f"ON CONFLICT (product_id, other_id) DO UPDATE SET score = {table}.score + EXCLUDED.score",
+                       [[pair[0] for pair in pairs], [pair[1] for pair in pairs]])
+    # only the bought together products of the products of the cart change, not every product page
+    bump_version(*(co_purchases_of(product_id) for product_id in product_ids))
@@ -0,0 +1,153 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import QueryDict
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from restsite.serializers import plain
+from .conditional import ConditionalGetMixin
+from .metrics import metrics
+
+
+class ResponseCache:
+    """
+    the data of the responses of the catalog views, in a bounded in-process LRU backed by an optional
+    shared django cache (RESPONSE_CACHE_SHARED). the keys embed the version stamp of the data, a write
+    moves the views to a new namespace and the old entries age out, nothing is deleted
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def shared():
+        alias = getattr(settings, 'RESPONSE_CACHE_SHARED', None)
+        return caches[alias] if alias else None
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['local_hits'] += 1
+                return self.entries[key]
+        shared = self.shared()
+        data = shared.get(key) if shared is not None else None
+        with self.lock:
+            self.stats['shared_hits' if data is not None else 'misses'] += 1
+        if data is not None:
+            self._set_local(key, data)
+        return data
+
+    def set(self, key, data):
+        self._set_local(key, data)
+        shared = self.shared()
+        if shared is not None:
+            shared.set(key, data, getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 300))
+
+    def _set_local(self, key, data):
+        with self.lock:
+            self.entries[key] = data
+            self.entries.move_to_end(key)
+            while len(self.entries) > getattr(settings, 'RESPONSE_CACHE_SIZE', 1000):
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def prometheus(self):
+        with self.lock:
+            stats, size = dict(self.stats), len(self.entries)
+        return '\n'.join([
+            '# HELP response_cache_hits_total catalog responses served from the cache',
+            '# TYPE response_cache_hits_total counter',
+            f'response_cache_hits_total{{tier="local"}} {stats["local_hits"]}',
+            f'response_cache_hits_total{{tier="shared"}} {stats["shared_hits"]}',
+            '# HELP response_cache_misses_total catalog responses computed because they were not cached',
+            '# TYPE response_cache_misses_total counter',
+            f'response_cache_misses_total {stats["misses"]}',
+            '# HELP response_cache_evictions_total entries evicted from the in-process cache',
+            '# TYPE response_cache_evictions_total counter',
+            f'response_cache_evictions_total {stats["evictions"]}',
+            '# HELP response_cache_entries entries of the in-process cache',
+            '# TYPE response_cache_entries gauge',
+            f'response_cache_entries {size}',
+        ]) + '\n'
+
+
+response_cache = ResponseCache()
+metrics.register(response_cache.prometheus)
+
+
+def normalize_value(value):
+    return ' '.join(value.split())
+
+
+def normalize_params(query_params, names):
+    """the non empty values of the parameters the response depends on, unknown parameters are ignored"""
+    params = []
+    for name in names:
+        value = normalize_value(query_params.get(name, ''))
+        if value:
+            params.append(f'{name}={value}')
+    return '&'.join(params)
+
+
+class CachedGetMixin(ConditionalGetMixin):
+    """
+    serve the GET responses of anonymous users from response_cache, keyed on the version stamp of
+    get_validators and the normalized cache_params of the request
+    """
+    cache_params = ()
+    # the links of the data to the other pages, built from the url of the request
+    link_fields = ('next', 'previous')
+
+    def get_cache_key(self, request):
+        key = '|'.join([type(self).__name__, request.scheme, request.get_host(), self.etag,
+                        repr(sorted(self.kwargs.items())), normalize_params(request.query_params, self.cache_params)])
+        return 'response:' + hashlib.sha256(key.encode()).hexdigest()
+
+    def get_response(self, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            return super().get_response(request, *args, **kwargs)
+        key = self.get_cache_key(request)
+        data = response_cache.get(key)
+        if data is not None:
+            return Response(self.relink(request, data))
+        response = super().get_response(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            response_cache.set(key, plain(response.data))
+        return response
+
+    def relink(self, request, data):
+        """
+        the cached data with its links made from the url of this request: the response was cached for
+        another one, with the same normalized cache_params but maybe other unknown parameters or spacing
+        """
+        if not isinstance(data, dict) or not any(data.get(field) for field in self.link_fields):
+            return data
+        data = dict(data)
+        for field in self.link_fields:
+            if data.get(field):
+                data[field] = self.relink_url(request, data[field])
+        return data
+
+    def relink_url(self, request, link):
+        """the url of this request with the cache_params of link, the ones link sets to another page"""
+        link_params = QueryDict(urlsplit(link).query)
+        url = request.build_absolute_uri()
+        for name in self.cache_params:
+            value = normalize_value(link_params.get(name, ''))
+            if value == normalize_value(request.query_params.get(name, '')):
+                continue
+            url = replace_query_param(url, name, link_params[name]) if value else remove_query_param(url, name)
+        return url
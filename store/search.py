@@ -0,0 +1,85 @@
+import functools
+
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity, SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import Q, F, FloatField
+from django.db.models.functions import Cast
+
+from .models import Product
+from .search_index import product_index
+
+# the threshold of the % operator (which can use the trigram indexes), set on connect by the OPTIONS of DATABASES
+SIMILARITY_THRESHOLD = 0.1
+SEARCH_CONFIG = 'english'
+SEARCH_MODES = ['fuzzy', 'fulltext']
+# the last field makes the orderings unique, so they can be used for keyset pagination,
+# the scores are cast to double precision so the cursors values compare equal to them
+SEARCH_ORDERINGS = {
+    'fuzzy': ('-similaritysum', '-similarity1', '-similarity2', '-rate', 'id'),
+    'fulltext': ('-rank', '-rate', 'id'),
+}
+
+
+def fuzzy_search(queryset, query):
+    """trigram search over name and description, name similarity counts twice"""
+    return queryset.filter(Q(name__trigram_similar=query) | Q(description__trigram_similar=query)).annotate(
+        similarity1=Cast(TrigramSimilarity('name', query), FloatField()),
+        similarity2=Cast(TrigramSimilarity('description', query), FloatField()),
+    ).annotate(similaritysum=F('similarity1') * 2 + F('similarity2')).order_by(*SEARCH_ORDERINGS['fuzzy'])
+
+
+def fulltext_search(queryset, query):
+    """full text search over the search vector, where name is weighted above description"""
+    search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+    return queryset.filter(search_vector=search_query)\
+        .annotate(rank=Cast(SearchRank(F('search_vector'), search_query), FloatField()))\
+        .order_by(*SEARCH_ORDERINGS['fulltext'])
+
+
+def search_products(queryset, query, mode='fuzzy'):
+    if mode == 'fulltext':
+        return fulltext_search(queryset, query)
+    return fuzzy_search(queryset, query)
+
+
+@functools.lru_cache(maxsize=None)
+def trigrams_installed():
+    """whether the pg_trgm extension, and so the trigram indexes of migration 0008, is installed"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return cursor.fetchone() is not None
+
+
+def search_engine(mode='fuzzy'):
+    """'database' or 'memory', the database search needs postgres, and pg_trgm for the fuzzy mode"""
+    engine = getattr(settings, 'PRODUCT_SEARCH_ENGINE', None)
+    if engine is None:
+        engine = 'database' if connection.vendor == 'postgresql' and \
+            (mode == 'fulltext' or trigrams_installed()) else 'memory'
+    return engine
+
+
+class SearchResults:
+    """
+    the ordered product ids found by the in-process index, it can be paginated like a queryset
+    and only the products of the requested page are loaded from the database
+    """
+
+    def __init__(self, product_ids):
+        self.product_ids = product_ids
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1 if item != -1 else None][0]
+        product_ids = self.product_ids[item]
+        products = Product.objects.defer('search_vector').in_bulk(product_ids)
+        return [products[product_id] for product_id in product_ids if product_id in products]
+
+
+def search_products_in_memory(query, tag=None):
+    # the index only ranks by trigram similarity, so every mode is a fuzzy search
+    return SearchResults(product_index.search(query, tag=tag))
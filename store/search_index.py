@@ -0,0 +1,290 @@
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from taggit.models import Tag, TaggedItem
+
+from .models import Product
+
+FIELDS = ('name', 'description')
+SIMILARITY_THRESHOLD = 0.1
+WORD_RE = re.compile(r'[^\W_]+')
+
+logger = logging.getLogger(__name__)
+
+
+def trigrams(text):
+    """the trigrams of a text, the same way pg_trgm extracts them"""
+    result = set()
+    for word in WORD_RE.findall(text.lower()):
+        padded = f'  {word} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class _IndexData:
+    """
+    posting lists trigram -> slots for each field, a product takes a new slot every time it changes
+    and its old slot is only marked as dead, so the posting lists are append only
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.dead = 0
+        self.slots = {}
+        self.product_ids = np.zeros(capacity, dtype=np.int64)
+        self.rates = np.zeros(capacity, dtype=np.float64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.lengths = {field: np.zeros(capacity, dtype=np.int32) for field in FIELDS}
+        self.postings = {field: defaultdict(list) for field in FIELDS}
+        self.posting_arrays = {field: {} for field in FIELDS}
+        self.product_tags = defaultdict(set)
+        self.tagged = defaultdict(set)
+
+    def _grow(self):
+        capacity = len(self.product_ids) * 2
+        self.product_ids = np.resize(self.product_ids, capacity)
+        self.rates = np.resize(self.rates, capacity)
+        self.alive = np.resize(self.alive, capacity)
+        self.alive[self.size:] = False
+        for field in FIELDS:
+            self.lengths[field] = np.resize(self.lengths[field], capacity)
+
+    def add(self, product_id, name, description, rate):
+        self.remove(product_id)
+        if self.size == len(self.product_ids):
+            self._grow()
+        slot = self.size
+        self.size += 1
+        self.slots[product_id] = slot
+        self.product_ids[slot] = product_id
+        self.rates[slot] = rate
+        self.alive[slot] = True
+        for field, text in zip(FIELDS, (name, description)):
+            field_trigrams = trigrams(text)
+            self.lengths[field][slot] = len(field_trigrams)
+            for trigram in field_trigrams:
+                self.postings[field][trigram].append(slot)
+                self.posting_arrays[field].pop(trigram, None)
+
+    def remove(self, product_id):
+        slot = self.slots.pop(product_id, None)
+        if slot is not None:
+            self.alive[slot] = False
+            self.dead += 1
+
+    def set_tags(self, product_id, tag_names):
+        for tag_name in self.product_tags.pop(product_id, ()):
+            self.tagged[tag_name].discard(product_id)
+        for tag_name in tag_names:
+            self.tagged[tag_name].add(product_id)
+        if tag_names:
+            self.product_tags[product_id] = set(tag_names)
+
+    def posting(self, field, trigram):
+        array = self.posting_arrays[field].get(trigram)
+        if array is None:
+            posting = self.postings[field].get(trigram)
+            if posting is None:
+                return None
+            array = self.posting_arrays[field][trigram] = np.array(posting, dtype=np.int64)
+        return array
+
+
+class ProductSearchIndex:
+    """
+    in-process trigram search over the products name and description, ranked like the database
+    fuzzy search: name similarity counts twice, then name, description similarity and rate.
+    it's built on the first search, kept in sync by the signals below and rebuilt in the background
+    every PRODUCT_SEARCH_INDEX_TTL seconds to catch the changes made by other processes
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # the first searches wait for a single build
+        self.build_lock = threading.Lock()
+        self.data = None
+        self.built_at = None
+        self.rebuilding = False
+        self.dirty = set()
+
+    def reset(self):
+        with self.lock:
+            self.data = None
+            self.built_at = None
+            self.dirty = set()
+
+    @staticmethod
+    def _load():
+        data = _IndexData(max(Product.objects.count(), 1))
+        for product_id, name, description, rate in Product.objects.values_list(
+                'id', 'name', 'description', 'rate').iterator(chunk_size=10000):
+            data.add(product_id, name, description, rate)
+        product_tags = defaultdict(set)
+        for product_id, tag_name in TaggedItem.objects.filter(
+                content_type=ContentType.objects.get_for_model(Product)).values_list('object_id', 'tag__name'):
+            product_tags[product_id].add(tag_name)
+        for product_id, tag_names in product_tags.items():
+            data.set_tags(product_id, tag_names)
+        return data
+
+    def _rebuild(self):
+        try:
+            data = self._load()
+        except BaseException:
+            # the next search tries again
+            with self.lock:
+                self.rebuilding, self.dirty = False, set()
+            raise
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            self.data, self.built_at, self.rebuilding = data, time.monotonic(), False
+        for product_id in dirty:
+            self.refresh_product(product_id)
+
+    def _rebuild_in_background(self):
+        try:
+            self._rebuild()
+        except Exception:
+            logger.exception('the product search index could not be rebuilt')
+        finally:
+            # the connection of this thread
+            connection.close()
+
+    def _ensure_built(self):
+        ttl = getattr(settings, 'PRODUCT_SEARCH_INDEX_TTL', 300)
+        with self.lock:
+            if self.data is not None:
+                if not self.rebuilding and (time.monotonic() - self.built_at > ttl or
+                                            self.data.dead > self.data.size // 2):
+                    self.rebuilding = True
+                    threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+                return
+        with self.build_lock:
+            with self.lock:
+                if self.data is not None:
+                    return
+                self.rebuilding = True
+            self._rebuild()
+
+    def search(self, query, tag=None):
+        """returns the ids of the matching products, best match first"""
+        self._ensure_built()
+        query_trigrams = trigrams(query)
+        with self.lock:
+            data = self.data
+            n = data.size
+            similarities = []
+            for field in FIELDS:
+                shared = np.zeros(n, dtype=np.int32)
+                for trigram in query_trigrams:
+                    posting = data.posting(field, trigram)
+                    if posting is not None:
+                        shared[posting] += 1
+                union = len(query_trigrams) + data.lengths[field][:n] - shared
+                similarities.append(np.divide(shared, union, out=np.zeros(n), where=union > 0))
+            mask = data.alive[:n].copy()
+            if tag is not None:
+                tag_mask = np.zeros(n, dtype=bool)
+                tag_mask[[data.slots[product_id] for product_id in data.tagged.get(tag, ()) if product_id in data.slots]] = True
+                mask &= tag_mask
+            product_ids, rates = data.product_ids[:n], data.rates[:n]
+        name_similarity, description_similarity = similarities
+        mask &= (name_similarity > SIMILARITY_THRESHOLD) | (description_similarity > SIMILARITY_THRESHOLD)
+        matches = np.flatnonzero(mask)
+        name_similarity, description_similarity = name_similarity[matches], description_similarity[matches]
+        order = np.lexsort((product_ids[matches], -rates[matches], -description_similarity, -name_similarity,
+                            -(name_similarity * 2 + description_similarity)))
+        return product_ids[matches[order]].tolist()
+
+    def _apply(self, product_id, change):
+        with self.lock:
+            if self.rebuilding:
+                self.dirty.add(product_id)
+            if self.data is not None:
+                change(self.data)
+
+    def update_product(self, product):
+        self._apply(product.id, lambda data: data.add(product.id, product.name, product.description, product.rate))
+
+    def remove_product(self, product_id):
+        def remove(data):
+            data.remove(product_id)
+            data.set_tags(product_id, ())
+        self._apply(product_id, remove)
+
+    def refresh_product(self, product_id):
+        product = Product.objects.filter(pk=product_id).first()
+        if product is None:
+            self.remove_product(product_id)
+            return
+        self.update_product(product)
+        self.update_tags(product_id)
+
+    def update_products(self, product_ids):
+        """reload products changed by a bulk update, which sends no signal"""
+        if self.data is None and not self.rebuilding:
+            return
+        for product in Product.objects.filter(pk__in=product_ids):
+            self.update_product(product)
+
+    def refresh_products(self, product_ids):
+        """reload products, their tags included, written by bulk writes, which send no signal"""
+        if self.data is None and not self.rebuilding:
+            return
+        products = {product.id: product for product in Product.objects.filter(pk__in=product_ids)}
+        product_tags = defaultdict(set)
+        for product_id, tag_name in TaggedItem.objects.filter(
+                content_type=ContentType.objects.get_for_model(Product), object_id__in=list(products)
+        ).values_list('object_id', 'tag__name'):
+            product_tags[product_id].add(tag_name)
+        for product_id in product_ids:
+            product = products.get(product_id)
+            if product is None:
+                self.remove_product(product_id)
+                continue
+            tag_names = product_tags[product_id]
+            self.update_product(product)
+            self._apply(product_id, lambda data, product_id=product_id, tag_names=tag_names:
+                        data.set_tags(product_id, tag_names))
+
+    def update_tags(self, product_id):
+        if self.data is None and not self.rebuilding:
+            return
+        tag_names = set(Tag.objects.filter(
+            taggit_taggeditem_items__content_type=ContentType.objects.get_for_model(Product),
+            taggit_taggeditem_items__object_id=product_id).values_list('name', flat=True))
+        self._apply(product_id, lambda data: data.set_tags(product_id, tag_names))
+
+
+product_index = ProductSearchIndex()
+
+
+# the index only follows the committed writes, a rolled back one leaves it as it was
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    # the values saved, the instance may change before the commit
+    product = Product(id=instance.id, name=instance.name, description=instance.description, rate=instance.rate)
+    transaction.on_commit(lambda: product_index.update_product(product))
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    product_id = instance.id
+    transaction.on_commit(lambda: product_index.remove_product(product_id))
+
+
+@receiver(m2m_changed, sender=TaggedItem)
+def index_product_tags(sender, instance, action, **kwargs):
+    if isinstance(instance, Product) and action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(lambda: product_index.update_tags(instance.id))
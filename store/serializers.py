@@ -1,61 +1,51 @@
-from django.db.models import Count
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 from django.urls import reverse
-from taggit.models import Tag
-from multiprocessing import Lock
 
 from .models import Product, Cart
+from .recommendations import refresh_recommendations
+from .importer import resolve_tags, set_tags, update_products
+from .tokens import user_role
+from restsite.serializers import BatchListSerializer, get_loader
+from .loaders import load_product_tags, load_recommendations, load_bought_together, load_cart_items
+from .carts import add_cart_items, cart_lock, apply_transitions, one_draft_per_customer, DELIVERY_TRANSITIONS, \
+    RECEIVE_TRANSITIONS
 from django.utils.timezone import now
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.password_validation import validate_password
 
 
-class LockManager:
-    my_dict = {}
-    dic_lock = Lock()
-
-    def __init__(self, cart_id):
-        self.cart_id = cart_id
-        self.lock_data = None
-
-    def __enter__(self):
-        with self.dic_lock:
-            self.lock_data = self.my_dict.get(self.cart_id, None)
-            if self.lock_data is None:
-                self.lock_data = [Lock(), 1]
-            else:
-                self.lock_data[1]+=1
-            self.my_dict[self.cart_id] = self.lock_data
-        self.lock_data[0].__enter__()
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.lock_data[0].__exit__()
-        with self.dic_lock:
-            self.lock_data = self.my_dict.get(self.cart_id, None)
-            if self.lock_data is not None:
-                if self.lock_data[1] == 1:
-                    self.my_dict.pop(self.cart_id)
-                else:
-                    self.lock_data[1] -= 1
-
-
 class ProductSerializer(serializers.ModelSerializer):
     tags = serializers.ListField(write_only=True, required=False)
     url = serializers.SerializerMethodField('get_url', read_only=True)
     recommend = serializers.SerializerMethodField('get_recommend', read_only=True)
+    bought_together = serializers.SerializerMethodField('get_bought_together', read_only=True)
     tags_read = serializers.SerializerMethodField('get_tags', read_only=True)
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'rate', 'description', 'tags', 'tags_read', 'url', 'recommend']
+        fields = ['id', 'name', 'rate', 'description', 'sku', 'tags', 'tags_read', 'url', 'recommend',
+                  'bought_together']
         read_only_fields = ['id', 'url']
+        list_serializer_class = BatchListSerializer
+
+    def loaders(self):
+        loaders = [get_loader(self.context, 'product_tags', load_product_tags, ())]
+        if self.context['request'].method == 'GET':
+            loaders += [get_loader(self.context, 'recommendations', load_recommendations, ()),
+                        get_loader(self.context, 'bought_together', load_bought_together, ())]
+        return loaders
+
+    def prime_loaders(self, instances):
+        for loader in self.loaders():
+            loader.prime(instance.id for instance in instances)
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
 
         if self.context['request'].method != 'GET':
             data.pop('recommend', None)
+            data.pop('bought_together', None)
 
         data['tags'] = data.pop('tags_read')
 
@@ -64,41 +54,66 @@ class ProductSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         tags_names = validated_data.pop('tags', [])
         instance = Product.objects.create(**validated_data)
-        for tag_name in tags_names:
-            tag, _ = Tag.objects.get_or_create(name=tag_name)
-            instance.tags.add(tag)
-        instance.save()
+        if tags_names:
+            instance.tags.add(*resolve_tags(tags_names).values())
+            refresh_recommendations([instance.id])
         return instance
 
     def update(self, instance, validated_data):
         tags_names = validated_data.pop('tags', [])
-        Product.objects.update(**validated_data)
-        instance = Product.objects.get(pk=instance.id)
-        if tags_names:
-            instance.tags.clear()
-            for tag_name in tags_names:
-                tag, _ = Tag.objects.get_or_create(name=tag_name)
-                instance.tags.add(tag)
-        instance.save()
+        # only the changed columns of this product are written
+        changed = [field for field, value in validated_data.items() if getattr(instance, field) != value]
+        for field in changed:
+            setattr(instance, field, validated_data[field])
+        if changed:
+            instance.save(update_fields=changed)
+        old_tags_ids = set_tags(instance, tags_names) if tags_names else None
+        if old_tags_ids is not None or 'rate' in changed:
+            refresh_recommendations([instance.id])
         return instance
 
     def get_url(self, obj):
         return obj.get_absolute_url()
 
     def get_recommend(self, obj):
-        instance = Product.objects.get(pk=obj.id)
-        tags_ids = instance.tags.values_list('id', flat=True)
-        my_query_set = Product.objects.filter(tags__in=tags_ids).exclude(id=obj.id)
-        my_query_set = my_query_set.annotate(same_tags=Count('tags')).order_by('-same_tags', '-rate')[:3]
-        result = []
-        for product in my_query_set:
-            serializer = ProductListSerializer(product)
-            result.append(serializer.data)
-        return result
+        if self.context['request'].method != 'GET':
+            return []
+        recommended = get_loader(self.context, 'recommendations', load_recommendations, ()).load(obj.id)
+        return ProductListSerializer(recommended, many=True).data
+
+    def get_bought_together(self, obj):
+        if self.context['request'].method != 'GET':
+            return []
+        others = get_loader(self.context, 'bought_together', load_bought_together, ()).load(obj.id)
+        return ProductListSerializer(others, many=True).data
 
     def get_tags(self, obj):
-        instance = Product.objects.get(pk=obj.id)
-        return [tag.name for tag in instance.tags.all()]
+        return list(get_loader(self.context, 'product_tags', load_product_tags, ()).load(obj.id))
+
+
+class TagFacetSerializer(serializers.Serializer):
+    name = serializers.CharField()
+    count = serializers.IntegerField()
+
+
+class ProductChangeSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField(max_length=Product._meta.get_field('name').max_length, required=False)
+    description = serializers.CharField(required=False, allow_blank=True)
+    rate = serializers.FloatField(required=False)
+
+
+class ProductBatchUpdateSerializer(serializers.Serializer):
+    products = ProductChangeSerializer(many=True, allow_empty=False, max_length=1000)
+
+    def validate_products(self, value):
+        if len({change['id'] for change in value}) != len(value):
+            raise serializers.ValidationError('a product can only be changed once per batch')
+        return value
+
+    def save(self, **kwargs):
+        updated, not_found = update_products(self.validated_data['products'])
+        return {'updated': updated, 'not_found': not_found}
 
 
 class CartSerializer(serializers.ModelSerializer):
@@ -111,6 +126,7 @@ class CartSerializer(serializers.ModelSerializer):
         model = Cart
         fields = ['id', 'products', 'status', 'order_date', 'products_with_count', 'url', 'new_products']
         read_only_fields = ['id', 'order_date', 'products_with_count']
+        list_serializer_class = BatchListSerializer
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
@@ -123,78 +139,52 @@ class CartSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError('customer can\'t change this/to this status')
         if value in [Cart.Status.DRAFT, Cart.Status.ORDERED]:
             return value
+        if value == Cart.Status.RECEIVED and self.instance is not None:
+            return value
         raise serializers.ValidationError('customer can\'t change this/to this status')
 
-    def validate(self, attrs):
-        user = self.context['request'].user
-        if self.context['request'].method == 'post' and Cart.objects.all().filter(customer=user).filter(status=Cart.Status.DRAFT):
-            raise serializers.ValidationError('there is already a draft cart, you can\'t make new one')
-        return attrs
-
     def create(self, validated_data):
         cart = Cart()
         user = self.context['request'].user
         cart.customer = user
-        cart.save()
         products = validated_data.get('products', [])
         if not products:
             raise serializers.ValidationError({'products': 'at least 1 product must be add'})
-        for product in products:
-            cart_item = cart.cartitem_set.all().filter(product=product)
-            if cart_item:
-                cart_item = cart_item[0]
-                cart_item.count += 1
-                cart_item.save()
-            else:
-                cart.products.add(product)
-        cart.status = Cart.Status(validated_data.get('status', Cart.Status.DRAFT.value))
-        if cart.status == Cart.Status.ORDERED:
-            cart.order_date = now()
-        cart.save()
+        # the cart starts as a draft, so a customer who already has one can't make a new one
+        with one_draft_per_customer():
+            cart.save()
+            add_cart_items(cart, products)
+            cart.status = Cart.Status(validated_data.get('status', Cart.Status.DRAFT.value))
+            if cart.status == Cart.Status.ORDERED:
+                cart.order_date = now()
+            cart.save()
         return cart
 
     def update(self, instance, validated_data):
-        with LockManager(f'cart_{instance.pk}'):
-            if validated_data.get('status', None) == Cart.Status.RECEIVED:
-                if instance.status == Cart.Status.DELIVERED:
-                    instance.status = Cart.Status.APPROVED
-                    instance.save()
-                elif instance.status == Cart.Status.ON_WAY:
-                    instance.status = Cart.Status.RECEIVED
-                    instance.save()
-                else:
-                    raise serializers.ValidationError({'details': 'customer can\'t change current this status'})
+        if validated_data.get('status', None) == Cart.Status.RECEIVED:
+            updated = apply_transitions([instance.pk], RECEIVE_TRANSITIONS)
+            if not updated:
+                raise serializers.ValidationError({'details': 'customer can\'t change current this status'})
+            instance.status = updated[instance.pk]
+            instance.version += 1
+            return instance
+        with cart_lock(instance):
             if instance.status != Cart.Status.DRAFT:
                 raise serializers.ValidationError({'details': 'customer can only change cart if status is draft'})
             products = validated_data.get('products', [])
-            if products:
-                instance.products.clear()
-                for product in products:
-                    cart_item = instance.cartitem_set.all().filter(product=product)
-                    if cart_item:
-                        cart_item = cart_item[0]
-                        cart_item.count += 1
-                        cart_item.save()
-                    else:
-                        instance.products.add(product)
-            new_products = validated_data.get('new_products', [])
-            if new_products:
-                for product in new_products:
-                    cart_item = instance.cartitem_set.all().filter(product=product)
-                    if cart_item:
-                        cart_item = cart_item[0]
-                        cart_item.count += 1
-                        cart_item.save()
-                    else:
-                        instance.products.add(product)
+            add_cart_items(instance, products, replace=True)
+            add_cart_items(instance, validated_data.get('new_products', []))
             instance.status = validated_data.get('status', instance.status)
             if instance.status == Cart.Status.ORDERED:
                 instance.order_date = now()
             instance.save()
         return instance
 
+    def prime_loaders(self, instances):
+        get_loader(self.context, 'cart_items', load_cart_items, ()).prime(instance.pk for instance in instances)
+
     def get_products_with_count(self, obj):
-        cart_item_list = obj.cartitem_set.all()
+        cart_item_list = get_loader(self.context, 'cart_items', load_cart_items, ()).load(obj.pk)
         cart_item_dic_list = []
         for cart_item in cart_item_list:
             cart_item_dic_list.append({'id': cart_item.product.id, 'name': cart_item.product.name,
@@ -262,6 +252,7 @@ class CartAdminSerializer(serializers.ModelSerializer):
     class Meta:
         model = Cart
         fields = ['id', 'customer', 'products', 'status', 'order_date', 'products_with_count', 'url']
+        list_serializer_class = BatchListSerializer
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
@@ -277,46 +268,35 @@ class CartAdminSerializer(serializers.ModelSerializer):
         cart = Cart()
         user = validated_data['customer']
         cart.customer = user
-        cart.save()
         products = validated_data.get('products', [])
         if not products:
             raise serializers.ValidationError({'products': 'at least 1 product must be add'})
-        for product in products:
-            cart_item = cart.cartitem_set.all().filter(product=product)
-            if cart_item:
-                cart_item = cart_item[0]
-                cart_item.count += 1
-                cart_item.save()
-            else:
-                cart.products.add(product)
-        cart.status = Cart.Status(validated_data.get('status', Cart.Status.DRAFT.value))
-        if cart.status == Cart.Status.ORDERED:
-            cart.order_date = now()
-        cart.save()
+        with one_draft_per_customer():
+            cart.save()
+            add_cart_items(cart, products)
+            cart.status = Cart.Status(validated_data.get('status', Cart.Status.DRAFT.value))
+            if cart.status == Cart.Status.ORDERED:
+                cart.order_date = now()
+            cart.save()
         return cart
 
     def update(self, instance, validated_data):
-        with LockManager(f'cart_{instance.pk}'):
+        with cart_lock(instance):
             products = validated_data.get('products', [])
-            if products:
-                instance.products.clear()
-                for product in products:
-                    cart_item = instance.cartitem_set.all().filter(product=product)
-                    if cart_item:
-                        cart_item = cart_item[0]
-                        cart_item.count += 1
-                        cart_item.save()
-                    else:
-                        instance.products.add(product)
+            add_cart_items(instance, products, replace=True)
             instance.status = validated_data.get('status', instance.status)
             if instance.status == Cart.Status.ORDERED:
                 instance.order_date = now()
             instance.customer = validated_data.get('customer', instance.customer)
-            instance.save()
+            with one_draft_per_customer():
+                instance.save()
         return instance
 
+    def prime_loaders(self, instances):
+        get_loader(self.context, 'cart_items', load_cart_items, ()).prime(instance.pk for instance in instances)
+
     def get_products_with_count(self, obj):
-        cart_item_list = obj.cartitem_set.all()
+        cart_item_list = get_loader(self.context, 'cart_items', load_cart_items, ()).load(obj.pk)
         cart_item_dic_list = []
         for cart_item in cart_item_list:
             cart_item_dic_list.append({'id': cart_item.product.id, 'name': cart_item.product.name,
@@ -334,20 +314,27 @@ class DeliveryCartSerializer(serializers.ModelSerializer):
         read_only_fields = ['customer', 'id']
 
     def update(self, instance, validated_data):
-        with LockManager(f'cart_{instance.pk}'):
-            if instance.status != Cart.Status.ON_WAY and instance.status != Cart.Status.RECEIVED:
-                raise serializers.ValidationError('you can\'t update the cart in the current status')
-            status = validated_data.get('status', Cart.Status.DELIVERED)
-            if status != Cart.Status.DELIVERED:
-                raise serializers.ValidationError('you are not allow to update to that status')
-            if instance.status == Cart.Status.ON_WAY:
-                instance.status = Cart.Status.DELIVERED
-            else:
-                instance.status = Cart.Status.APPROVED
-            instance.save()
+        status = validated_data.get('status', Cart.Status.DELIVERED)
+        if status != Cart.Status.DELIVERED:
+            raise serializers.ValidationError('you are not allow to update to that status')
+        updated = apply_transitions([instance.pk], DELIVERY_TRANSITIONS)
+        if not updated:
+            raise serializers.ValidationError('you can\'t update the cart in the current status')
+        instance.status = updated[instance.pk]
+        instance.version += 1
         return instance
 
 
+class DeliveryCartBulkSerializer(serializers.Serializer):
+    carts = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=1000)
+
+    def save(self, **kwargs):
+        cart_ids = set(self.validated_data['carts'])
+        updated = apply_transitions(cart_ids, DELIVERY_TRANSITIONS)
+        return {'updated': [{'id': cart_id, 'status': status} for cart_id, status in sorted(updated.items())],
+                'conflicts': sorted(cart_ids - set(updated))}
+
+
 class RetrieveUserSerializer(serializers.ModelSerializer):
     user_type = serializers.SerializerMethodField()
 
@@ -357,9 +344,7 @@ class RetrieveUserSerializer(serializers.ModelSerializer):
         read_only_fields = ['username', 'user_type', 'id']
 
     def get_user_type(self, obj):
-        if obj.is_superuser:
-            return 'admin'
-        elif obj.groups.filter(name='delivery').exists():
-            return 'delivery'
-        else:
-            return 'customer'
+        # users authenticated from the token claims already know their role
+        if hasattr(obj, 'role'):
+            return obj.role
+        return user_role(obj)
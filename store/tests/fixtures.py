@@ -1,4 +1,6 @@
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from ..models import Product
 from rest_framework.test import APIClient
@@ -39,3 +41,42 @@ def products(db):
     product_list = [Product.objects.create(name='p1'), Product.objects.create(name='p2'), Product.objects.create(name='p3')]
     return product_list
 
+
+
+@pytest.fixture
+def assert_constant_queries(db):
+    """
+    assert_constant_queries(request, add_rows) checks request() runs the same number of queries
+    before and after add_rows() added rows to its result, returns that number
+    """
+    def check(request, add_rows):
+        # fill the per-process caches (content types, token blacklist) first
+        request()
+        with CaptureQueriesContext(connection) as before:
+            request()
+        add_rows()
+        with CaptureQueriesContext(connection) as after:
+            request()
+        assert len(after) == len(before), '\n'.join(query['sql'] for query in after.captured_queries)
+        return len(after)
+    return check
+
+
+def explain_ordered_queries(request, table):
+    """
+    the plans of the queries on table with an ORDER BY run by request(), as postgres runs them when it
+    can't scan whole tables or bitmaps, so tiny tables are read through the indexes
+    """
+    from django.db import transaction
+    with CaptureQueriesContext(connection) as queries:
+        request()
+    plans = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ANALYZE {connection.ops.quote_name(table)}')
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('SET LOCAL enable_bitmapscan = off')
+        for query in queries.captured_queries:
+            if f'FROM {connection.ops.quote_name(table)}' in query['sql'] and 'ORDER BY' in query['sql']:
+                cursor.execute(f'EXPLAIN {query["sql"]}')
+                plans.append('\n'.join(row[0] for row in cursor.fetchall()))
+    return plans
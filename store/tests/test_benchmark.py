@@ -0,0 +1,55 @@
+import json
+
+import pytest
+from django.core.management import call_command
+
+from chat.models import Chat, Msg
+from ..models import Product, Cart, CartItem
+
+
+@pytest.mark.django_db
+def test_seed_and_run_benchmark(tmp_path):
+    call_command('seed_data', products=50, tags=5, users=4, carts=10, cart_items=30, chats=3, messages=20,
+                 batch_size=7)
+    assert Product.objects.count() == 50
+    assert Product.objects.filter(tags__isnull=False).distinct().count() == 50
+    assert Cart.objects.count() == 10 and not Cart.objects.filter(status=Cart.Status.DRAFT).exists()
+    assert CartItem.objects.count() == 30
+    assert Chat.objects.count() == 3 and Msg.objects.count() == 20
+    # no product twice in a cart
+    assert CartItem.objects.values('cart', 'product').distinct().count() == 30
+
+    output = tmp_path / 'results.json'
+    call_command('run_benchmark', requests=3, output=str(output),
+                 scenarios=['search-fulltext', 'product-detail', 'cart-create', 'cart-update', 'admin-carts'])
+    report = json.loads(output.read_text())
+    assert report['rows']['Product'] == 50
+    for name, result in report['scenarios'].items():
+        assert result['requests'] == 3
+        assert result['p50_ms'] <= result['p95_ms'] <= result['p99_ms']
+        assert result['queries']['max'] >= 1
+
+
+# the subscribers query the database from the threads of database_sync_to_async
+@pytest.mark.django_db(transaction=True)
+def test_websocket_fanout_benchmark():
+    from ..benchmark import run_benchmarks
+    report = run_benchmarks(['websocket-fanout'], 4, options={'websocket-fanout': {'subscribers': 3}})
+    result = report['scenarios']['websocket-fanout']
+    assert result['requests'] == 4 and result['options'] == {'subscribers': 3}
+    assert 0 < result['p50_ms'] <= result['p99_ms']
+    assert not Chat.objects.exists()
+    with pytest.raises(ValueError):
+        # the in-memory layer of the tests isn't shared by processes
+        run_benchmarks(['websocket-fanout'], 1, options={'websocket-fanout': {'workers': 2}})
+
+
+@pytest.mark.django_db(transaction=True)
+def test_chat_send_benchmark(settings, tmp_path):
+    from ..benchmark import run_benchmarks
+    settings.CHAT_WRITE_BEHIND_SPOOL = str(tmp_path / 'spool')
+    report = run_benchmarks(['chat-send', 'chat-send-write-behind'], 5)
+    for result in report['scenarios'].values():
+        assert result['requests'] == 5 and 0 < result['p50_ms'] <= result['p99_ms']
+    # every message was written, the chats are gone
+    assert not Chat.objects.exists()
@@ -1,10 +1,12 @@
 import pytest
 from django.urls import reverse
 from django.core import mail
+from django.core.management import call_command
 from rest_framework import status
-from .fixtures import auth_api_user, create_user, products, create_superuser, auth_api_superuser
-from ..models import Cart
-from django.contrib.auth.models import Group
+from .fixtures import auth_api_user, create_user, products, create_superuser, auth_api_superuser, \
+    assert_constant_queries
+from ..models import Cart, CartItem
+from django.contrib.auth.models import Group, User
 from rest_framework.test import APIClient
 
 
@@ -196,6 +198,43 @@ def test_receive_email_on_way(cart_status, products, create_user, auth_api_super
     url = reverse('RUD-cart-admin', kwargs={'pk': cart.id})
     response = auth_api_superuser.put(url, data={'status': cart_status})
     assert response.status_code == status.HTTP_200_OK
+    # queued by the request, sent by the worker
+    assert len(mail.outbox) == 0
+    assert cart.notifications.count() == 1
+    call_command('run_notifications', '--once')
+    assert len(mail.outbox) == 1
+    assert mail.outbox[0].to == [create_user.email]
+    call_command('run_notifications', '--once')
+    assert len(mail.outbox) == 1
+
+
+@pytest.mark.django_db
+def test_notification_retry(create_user, settings):
+    from smtplib import SMTPException
+    from unittest import mock
+    from django.utils.timezone import now
+    from ..notifications import send_pending_notifications
+    settings.NOTIFICATION_RETRY_DELAY = 10
+    cart = Cart.objects.create(customer=create_user, status=Cart.Status.ORDERED)
+    cart = Cart.objects.get(pk=cart.pk)
+    cart.status = Cart.Status.ON_WAY
+    cart.save()
+    # saving again without a status change doesn't queue another email
+    cart.save()
+    notification = cart.notifications.get()
+
+    with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=SMTPException('down')):
+        assert send_pending_notifications() == (0, 1)
+    notification.refresh_from_db()
+    assert notification.attempts == 1 and notification.last_error == 'down' and notification.sent_at is None
+    # not due yet
+    assert send_pending_notifications() == (0, 0)
+
+    notification.next_attempt_at = now()
+    notification.save()
+    assert send_pending_notifications() == (1, 0)
+    notification.refresh_from_db()
+    assert notification.sent_at is not None
     assert len(mail.outbox) == 1
 
 
@@ -224,3 +263,289 @@ def test_delivery_update_cart(create_user, create_superuser, products):
     assert cart.status == Cart.Status.DELIVERED
 
 
+
+
+@pytest.mark.django_db
+def test_bought_together(auth_api_user, products):
+    url = reverse('list-create-cart')
+    response = auth_api_user.post(url, data={'products': (products[0].id, products[1].id),
+                                             'status': Cart.Status.ORDERED})
+    assert response.status_code == status.HTTP_201_CREATED
+    response = auth_api_user.post(url, data={'products': (products[0].id, products[2].id, products[2].id),
+                                             'status': Cart.Status.DRAFT})
+    assert response.status_code == status.HTTP_201_CREATED
+
+    response = APIClient().get(reverse('RUD-product', kwargs={'pk': products[0].id}))
+    assert [product['id'] for product in response.json()['bought_together']] == [products[1].id]
+
+    draft_cart = Cart.objects.get(status=Cart.Status.DRAFT)
+    response = auth_api_user.put(reverse('RUD-cart', kwargs={'pk': draft_cart.id}), data={'status': Cart.Status.ORDERED})
+    assert response.status_code == status.HTTP_200_OK
+    response = APIClient().get(reverse('RUD-product', kwargs={'pk': products[2].id}))
+    assert [product['id'] for product in response.json()['bought_together']] == [products[0].id]
+
+    # the batch miner gives the same scores as the incremental updates
+    from django.core.management import call_command
+    from ..models import ProductCoPurchase
+    scores = set(ProductCoPurchase.objects.values_list('product', 'other', 'score'))
+    call_command('build_bought_together')
+    assert set(ProductCoPurchase.objects.values_list('product', 'other', 'score')) == scores
+
+
+@pytest.mark.django_db
+def test_add_ordered_cart_constant_queries(create_user, assert_constant_queries):
+    from ..models import Product, ProductCoPurchase
+    from ..recommendations import add_ordered_cart
+    cart = Cart.objects.create(customer=create_user, status=Cart.Status.ORDERED)
+
+    def add_items():
+        start = CartItem.objects.filter(cart=cart).count()
+        products = Product.objects.bulk_create([Product(name=f'p{start + i}') for i in range(10)])
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=product) for product in products])
+
+    add_items()
+    assert_constant_queries(lambda: add_ordered_cart(cart.id), add_items)
+    # each pair of the 20 products, three times for the first 10
+    assert ProductCoPurchase.objects.count() == 20 * 19
+    assert ProductCoPurchase.objects.filter(score=3).count() == 10 * 9
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('cart_size', [3, 60])
+def test_cart_items_queries_do_not_depend_on_cart_size(cart_size, create_user, django_assert_num_queries):
+    from ..carts import add_cart_items
+    from ..models import Product, CartItem
+    cart_products = Product.objects.bulk_create([Product(name=f'p{i}') for i in range(cart_size)])
+    cart = Cart.objects.create(customer=create_user)
+
+    # a single upsert, inside a savepoint
+    with django_assert_num_queries(3):
+        add_cart_items(cart, cart_products + cart_products[:1])
+    new_product = Product.objects.create(name='new')
+    with django_assert_num_queries(3):
+        add_cart_items(cart, cart_products[1:] + [new_product])
+    assert CartItem.objects.get(cart=cart, product=cart_products[1]).count == 2
+    # delete + insert, inside a savepoint
+    with django_assert_num_queries(4):
+        add_cart_items(cart, cart_products[:2] * 2, replace=True)
+
+    assert dict(CartItem.objects.filter(cart=cart).values_list('product_id', 'count')) == {
+        cart_products[0].id: 2, cart_products[1].id: 2}
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('backend', ['store.carts.RowCartLock', 'store.carts.AdvisoryCartLock'])
+def test_cart_lock_timeout(backend, settings, auth_api_user, auth_api_superuser, products, create_user):
+    import threading
+    from django.db import connection
+    from ..carts import cart_lock, lock_stats
+    settings.CART_LOCK_BACKEND = backend
+    settings.CART_LOCK_TIMEOUT = 0.2
+    cart = Cart.objects.create(customer=create_user)
+    locked, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        with cart_lock(cart):
+            locked.set()
+            release.wait(5)
+        connection.close()
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    locked.wait(5)
+    timeouts = lock_stats['timeouts']
+    url = reverse('RUD-cart', kwargs={'pk': cart.id})
+    response = auth_api_user.patch(url, data={'new_products': [products[0].id]})
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert lock_stats['timeouts'] == timeouts + 1
+    release.set()
+    thread.join()
+
+    response = auth_api_user.patch(url, data={'new_products': [products[0].id]})
+    assert response.status_code == status.HTTP_200_OK
+    metrics = auth_api_superuser.get(reverse('metrics')).content.decode()
+    assert f'cart_lock_timeouts_total {timeouts + 1}\n' in metrics
+    assert f'cart_lock_acquired_total {lock_stats["acquired"]}\n' in metrics
+    assert f'cart_lock_max_wait_seconds {lock_stats["max_wait_seconds"]}\n' in metrics
+    assert '# TYPE cart_lock_wait_seconds_total counter' in metrics
+
+
+@pytest.mark.django_db
+def test_customer_receive_cart(auth_api_user, create_user):
+    cart = Cart.objects.create(customer=create_user, status=Cart.Status.ON_WAY)
+    url = reverse('RUD-cart', kwargs={'pk': cart.id})
+    response = auth_api_user.patch(url, data={'status': Cart.Status.RECEIVED})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['status'] == Cart.Status.RECEIVED
+
+    # received twice is a conflict
+    response = auth_api_user.patch(url, data={'status': Cart.Status.RECEIVED})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert Cart.objects.get(pk=cart.id).status == Cart.Status.RECEIVED
+
+
+@pytest.mark.django_db
+def test_delivery_bulk_update_carts(create_user, create_superuser, django_assert_max_num_queries):
+    group = Group.objects.create(name='delivery')
+    create_user.groups.add(group)
+    api_client = APIClient()
+    response = api_client.post(reverse('token-obtain-pair'), {'username': create_user.username, 'password': '123'})
+    api_client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.json()['access'])
+    on_way = [Cart.objects.create(customer=create_superuser, status=Cart.Status.ON_WAY) for _ in range(20)]
+    received = Cart.objects.create(customer=create_superuser, status=Cart.Status.RECEIVED)
+    draft = Cart.objects.create(customer=create_superuser)
+
+    cart_ids = [cart.id for cart in on_way] + [received.id, draft.id]
+    url = reverse('delivery-carts')
+    with django_assert_max_num_queries(6):
+        response = api_client.post(url, data={'carts': cart_ids}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['conflicts'] == [draft.id]
+    assert {'id': received.id, 'status': Cart.Status.APPROVED} in response.json()['updated']
+    assert Cart.objects.filter(status=Cart.Status.DELIVERED).count() == 20
+
+    response = api_client.post(url, data={'carts': cart_ids}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {'updated': [], 'conflicts': sorted(cart_ids)}
+
+
+@pytest.mark.django_db
+def test_admin_carts_keyset_pagination(auth_api_superuser, create_user):
+    from django.utils.timezone import now, timedelta
+    carts = [Cart.objects.create(customer=create_user, status=Cart.Status.ORDERED,
+                                 order_date=now() - timedelta(days=i % 3) if i % 4 else None) for i in range(9)]
+    expected = [cart.id for cart in sorted(carts, key=lambda cart: (cart.order_date is None, cart.order_date
+                                                                    or now(), cart.id))]
+    url = reverse('list-create-cart-admin')
+    page = auth_api_superuser.get(url, {'cursor': '', 'page_size': 4, 'count': 'estimate'}).json()
+    assert 'count' in page
+    ids = [cart['id'] for cart in page['results']]
+    while page['next']:
+        page = auth_api_superuser.get(page['next']).json()
+        ids += [cart['id'] for cart in page['results']]
+    assert ids == expected
+    page = auth_api_superuser.get(page['previous']).json()
+    assert [cart['id'] for cart in page['results']] == expected[4:8]
+
+    # page numbers still work for the existing clients
+    response = auth_api_superuser.get(url, {'page': 2})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['count'] == 9
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('url_name, client', [('list-create-cart', 'auth_api_user'),
+                                              ('list-create-cart-admin', 'auth_api_superuser')])
+def test_cart_list_constant_queries(url_name, client, create_user, products, assert_constant_queries, request):
+    from ..carts import add_cart_items
+    api_client = request.getfixturevalue(client)
+
+    def add_cart():
+        cart = Cart.objects.create(customer=create_user, status=Cart.Status.ORDERED)
+        add_cart_items(cart, products)
+
+    add_cart()
+    url = reverse(url_name)
+    assert_constant_queries(lambda: api_client.get(url, {'page_size': 10}), lambda: [add_cart() for _ in range(4)])
+    response = api_client.get(url, {'page_size': 10})
+    assert len(response.json()['results']) == 5
+    assert [item['name'] for item in response.json()['results'][0]['products']] == ['p1', 'p2', 'p3']
+
+
+@pytest.mark.django_db
+def test_one_draft_cart_per_customer(auth_api_user, auth_api_superuser, create_user, products):
+    url = reverse('list-create-cart')
+    assert auth_api_user.post(url, data={'products': products[0].id}).status_code == status.HTTP_201_CREATED
+    response = auth_api_user.post(url, data={'products': products[1].id, 'status': Cart.Status.ORDERED})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert 'already a draft cart' in str(response.json())
+    assert Cart.objects.filter(customer=create_user).count() == 1
+
+    ordered = Cart.objects.create(customer=create_user, status=Cart.Status.ORDERED)
+    response = auth_api_superuser.patch(reverse('RUD-cart-admin', kwargs={'pk': ordered.id}),
+                                        data={'status': Cart.Status.DRAFT})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    ordered.refresh_from_db()
+    assert ordered.status == Cart.Status.ORDERED
+
+
+def explain_with_index_scans(queryset):
+    """the plan postgres picks for the queryset when it can't scan whole tables, so tiny tables use the indexes"""
+    from django.db import connection, transaction
+    with transaction.atomic(), connection.cursor() as cursor:
+        # the statistics left by other tests could make another index look as good
+        cursor.execute(f'ANALYZE {connection.ops.quote_name(queryset.model._meta.db_table)}')
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('lookup, index', [
+    (lambda user: Cart.objects.filter(customer=user, status=Cart.Status.DRAFT), 'unique_draft_cart_per_customer'),
+    (lambda user: Cart.objects.filter(customer=user, status=Cart.Status.ORDERED), 'cart_customer_status_idx'),
+    (lambda user: Cart.objects.filter(status=Cart.Status.ORDERED).order_by('order_date'), 'cart_status_order_date_idx'),
+    (lambda user: CartItem.objects.filter(cart_id=1, product_id=1), 'unique_cart_item_product'),
+])
+def test_cart_indexes_used(lookup, index, create_user, products):
+    from django.db import connection
+    if connection.vendor != 'postgresql':
+        pytest.skip('the indexes are checked with postgres plans')
+    for i, cart_status in enumerate([Cart.Status.DRAFT, Cart.Status.ORDERED, Cart.Status.ON_WAY]):
+        cart = Cart.objects.create(customer=create_user, status=cart_status)
+        CartItem.objects.create(cart=cart, product=products[i])
+    # the ordered carts of other customers, so the status alone isn't selective
+    for i in range(10):
+        customer = User.objects.create_user(username=f'customer{i}', password='pass')
+        Cart.objects.create(customer=customer, status=Cart.Status.ORDERED)
+    assert index in explain_with_index_scans(lookup(create_user))
+
+
+@pytest.mark.django_db
+def test_admin_carts_keyset_pages_walk_the_index(auth_api_superuser, create_user):
+    from django.db import connection
+    from django.utils.timezone import now
+    from .fixtures import explain_ordered_queries
+    if connection.vendor != 'postgresql':
+        pytest.skip('the plans are the ones of postgres')
+    Cart.objects.bulk_create([Cart(customer=create_user, status=Cart.Status.ORDERED, order_date=now())
+                              for _ in range(12)])
+    url = reverse('list-create-cart-admin')
+    first = auth_api_superuser.get(url, {'cursor': '', 'page_size': 5}).json()
+    for page_url in [f'{url}?cursor=&page_size=5', first['next'], first['next'] + '&count=exact']:
+        plans = explain_ordered_queries(lambda: auth_api_superuser.get(page_url), 'store_cart')
+        assert plans
+        for plan in plans:
+            assert 'cart_order_date_id_idx' in plan and 'Sort' not in plan, plan
+
+
+# the version stamps are bumped once the writes commit
+@pytest.mark.django_db(transaction=True)
+def test_cart_conditional_requests(auth_api_user, products, django_user_model):
+    cart = Cart.objects.create(customer=django_user_model.objects.get(username='user'))
+    cart.products.add(products[0])
+    url = reverse('RUD-cart', kwargs={'pk': cart.id})
+    response = auth_api_user.get(url)
+    etag = response['ETag']
+    response = auth_api_user.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response['ETag'] == etag and not response.content
+
+    # the cart changed since
+    response = auth_api_user.patch(url, data={'new_products': [products[1].id]}, HTTP_IF_MATCH=etag)
+    assert response.status_code == status.HTTP_200_OK
+    assert response['ETag'] != etag
+    assert auth_api_user.get(url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_200_OK
+    response = auth_api_user.patch(url, data={'new_products': [products[2].id]}, HTTP_IF_MATCH=etag)
+    assert response.status_code == status.HTTP_412_PRECONDITION_FAILED
+    assert not cart.cartitem_set.filter(product=products[2]).exists()
+
+    # so did the products it shows
+    etag = auth_api_user.get(url)['ETag']
+    products[0].name = 'renamed'
+    products[0].save()
+    assert auth_api_user.get(url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_200_OK
+
+    # the validators are checked once the owner is
+    other = APIClient()
+    other.force_authenticate(django_user_model.objects.create_user(username='other', password='pass'))
+    assert other.get(url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_403_FORBIDDEN
@@ -0,0 +1,57 @@
+import pytest
+from django.urls import reverse
+from rest_framework import status
+from .fixtures import auth_api_user, create_user, create_superuser, auth_api_superuser, products
+from ..metrics import metrics, instrument, QueryBudgetExceeded
+from ..models import Product
+from ..views import ProductListView
+
+
+@pytest.fixture
+def clean_metrics():
+    metrics.reset()
+    yield metrics
+    metrics.reset()
+
+
+@pytest.mark.django_db
+def test_metrics_endpoint(clean_metrics, products, auth_api_user, auth_api_superuser):
+    assert auth_api_user.get(reverse('index')).status_code == status.HTTP_200_OK
+    assert auth_api_user.get(reverse('metrics')).status_code == status.HTTP_403_FORBIDDEN
+
+    response = auth_api_superuser.get(reverse('metrics'))
+    assert response.status_code == status.HTTP_200_OK
+    assert response['Content-Type'].startswith('text/plain')
+    text = response.content.decode()
+    assert '# TYPE request_duration_seconds histogram' in text
+    assert 'request_duration_seconds_count{protocol="http",endpoint="index"} 1' in text
+    # the user, the catalog version, the count and the page
+    assert 'request_queries_bucket{protocol="http",endpoint="index",le="3"} 0' in text
+    assert 'request_queries_bucket{protocol="http",endpoint="index",le="5"} 1' in text
+    assert 'query_budget_exceeded_total{protocol="http",endpoint="index"} 0' in text
+    assert '# TYPE websocket_send_queue_depth gauge' in text
+
+
+@pytest.mark.django_db
+def test_query_budget(clean_metrics, products, monkeypatch, settings):
+    from rest_framework.test import APIClient
+    monkeypatch.setattr(ProductListView, 'query_budget', {'GET': 1})
+    with pytest.raises(QueryBudgetExceeded):
+        APIClient().get(reverse('index'))
+
+    settings.QUERY_BUDGET_STRICT = False
+    # another page, the first one is now cached
+    assert APIClient().get(reverse('index'), {'page_size': 2}).status_code == status.HTTP_200_OK
+    assert metrics.endpoints['http', 'index'].budget_exceeded == 2
+
+
+@pytest.mark.django_db
+def test_instrument_websocket_operation(clean_metrics, products):
+    @instrument('connect', query_budget=1)
+    def snapshot():
+        return ','.join(product.name for product in Product.objects.order_by('id'))
+
+    assert snapshot() == 'p1,p2,p3'
+    operation = metrics.endpoints['websocket', 'connect']
+    assert operation.queries.sum == 1
+    assert operation.response_bytes.sum == len('p1,p2,p3')
@@ -6,7 +6,8 @@ from rest_framework.test import APIClient
 from rest_framework import status
 import pytest
 from taggit.models import Tag
-from .fixtures import create_superuser, auth_api_superuser, products, auth_api_user, create_user
+from .fixtures import create_superuser, auth_api_superuser, products, auth_api_user, create_user, \
+    assert_constant_queries
 
 
 @pytest.mark.django_db
@@ -80,6 +81,24 @@ def test_search_products_with_tag(products):
     assert str(products[2].get_absolute_url()) not in response_body
 
 
+@pytest.mark.django_db
+def test_search_engine(settings, monkeypatch):
+    from django.db import connection
+    from .. import search
+    settings.PRODUCT_SEARCH_ENGINE = None
+    monkeypatch.setattr(search, 'trigrams_installed', lambda: False)
+    # the trigram indexes and the % operator are missing
+    assert search.search_engine('fuzzy') == 'memory'
+    assert search.search_engine('fulltext') == ('database' if connection.vendor == 'postgresql' else 'memory')
+    if connection.vendor == 'postgresql':
+        monkeypatch.setattr(search, 'trigrams_installed', lambda: True)
+        assert search.search_engine() == 'database'
+        # the threshold of each connection, pg_trgm installed or not
+        with connection.cursor() as cursor:
+            cursor.execute('SHOW pg_trgm.similarity_threshold')
+            assert float(cursor.fetchone()[0]) == search.SIMILARITY_THRESHOLD
+
+
 @pytest.mark.django_db
 def test_search_products_with_query(products):
     products[0].name = 'wood'
@@ -95,3 +114,537 @@ def test_search_products_with_query(products):
     assert response.status_code == status.HTTP_200_OK
     assert re.search(f".*{products[1].get_absolute_url()}.*{products[0].get_absolute_url()}.*", str(response.json()))
     assert str(products[2].get_absolute_url()) not in str(response.json())
+
+
+@pytest.mark.django_db
+def test_refresh_recommendations_of_a_popular_tag():
+    import random
+    from ..models import Product, ProductRecommendation
+    from ..recommendations import build_recommendations, refresh_recommendations, recommending
+    rng = random.Random(1)
+    products = [Product.objects.create(name=f'p{i}', rate=rng.randint(0, 5)) for i in range(40)]
+    for product in products:
+        # every product has the popular tag
+        product.tags.add('popular', *rng.sample(['a', 'b', 'c', 'd', 'e', 'f'], 2))
+    build_recommendations()
+
+    def recommendations():
+        return sorted(ProductRecommendation.objects.values_list('product_id', 'rank', 'recommended_id', 'same_tags'))
+
+    def refreshed(change, product):
+        before = dict(ProductRecommendation.objects.values_list('id', 'product_id'))
+        recommending_ids = recommending([product.id])
+        change()
+        refresh_recommendations([product.id], recommending_ids)
+        after = set(ProductRecommendation.objects.values_list('id', flat=True))
+        # the same recommendations as a full rebuild
+        expected = recommendations()
+        build_recommendations()
+        assert expected == recommendations()
+        return {product_id for row_id, product_id in before.items() if row_id not in after}
+
+    products[0].rate = 6
+    products[0].save()
+    assert len(refreshed(lambda: None, products[0])) < len(products) // 2
+    products[1].tags.set(['popular', 'a', 'b', 'c'])
+    assert len(refreshed(lambda: None, products[1])) < len(products) // 2
+    refreshed(products[2].delete, products[2])
+
+
+# the version stamps are bumped once the writes commit
+@pytest.mark.django_db(transaction=True)
+def test_product_recommendations(auth_api_superuser):
+    url = reverse('add-product')
+    ids = []
+    for name, rate, tags in [('p1', 0, ['a', 'b']), ('p2', 1, ['a']), ('p3', 5, ['a', 'b']), ('p4', 9, ['c'])]:
+        response = auth_api_superuser.post(url, data={'name': name, 'rate': rate, 'tags': tags}, format='json')
+        assert response.status_code == status.HTTP_201_CREATED
+        ids.append(response.json()['id'])
+
+    response = APIClient().get(reverse('RUD-product', kwargs={'pk': ids[0]}))
+    assert [product['id'] for product in response.json()['recommend']] == [ids[2], ids[1]]
+
+    # adding a shared tag to p2 and rating it up should move it before p3
+    response = auth_api_superuser.patch(reverse('RUD-product', kwargs={'pk': ids[1]}),
+                                        data={'tags': ['a', 'b'], 'rate': 8}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    response = APIClient().get(reverse('RUD-product', kwargs={'pk': ids[0]}))
+    assert [product['id'] for product in response.json()['recommend']] == [ids[1], ids[2]]
+
+    response = auth_api_superuser.delete(reverse('RUD-product', kwargs={'pk': ids[1]}))
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    response = APIClient().get(reverse('RUD-product', kwargs={'pk': ids[0]}))
+    assert [product['id'] for product in response.json()['recommend']] == [ids[2]]
+
+
+@pytest.mark.django_db
+def test_build_recommendations_command(products):
+    from django.core.management import call_command
+    products[0].tags.add('tag1')
+    products[1].tags.add('tag1')
+    call_command('build_recommendations')
+    response = APIClient().get(reverse('RUD-product', kwargs={'pk': products[0].id}))
+    assert [product['id'] for product in response.json()['recommend']] == [products[1].id]
+    response = APIClient().get(reverse('RUD-product', kwargs={'pk': products[2].id}))
+    assert response.json()['recommend'] == []
+
+
+@pytest.mark.django_db
+def test_search_products_fulltext(products):
+    products[0].name = 'wooden chair'
+    products[0].save()
+    products[1].name = 'table'
+    products[1].description = 'a table to put next to your chair'
+    products[1].rate = 5
+    products[1].save()
+    products[2].name = 'blanket'
+    products[2].save()
+
+    url = reverse('index')
+    response = APIClient().get(url, {'query': 'chairs', 'mode': 'fulltext'})
+    assert response.status_code == status.HTTP_200_OK
+    # a match in the name ranks above a match in the description, even with a lower rate
+    assert [product['id'] for product in response.json()['results']] == [products[0].id, products[1].id]
+
+    response = APIClient().get(url, {'query': 'chairs', 'mode': 'fulltext', 'cursor': '', 'page_size': 1})
+    assert [product['id'] for product in response.json()['results']] == [products[0].id]
+    response = APIClient().get(response.json()['next'])
+    assert [product['id'] for product in response.json()['results']] == [products[1].id]
+    assert response.json()['next'] is None
+
+    response = APIClient().get(url, {'query': 'chairs', 'mode': 'unknown'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.fixture
+def memory_search(settings):
+    from ..search_index import product_index
+    settings.PRODUCT_SEARCH_ENGINE = 'memory'
+    product_index.reset()
+    yield product_index
+    product_index.reset()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_search_products_in_memory(products, memory_search, django_assert_max_num_queries):
+    products[0].name = 'wood'
+    products[0].save()
+    products[1].name = 'wool'
+    products[1].save()
+    products[2].name = 'blanket'
+    products[2].description = 'made of wool'
+    products[2].save()
+
+    url = reverse('index')
+    api_client = APIClient()
+    response = api_client.get(url, {'query': 'wool'})
+    assert response.status_code == status.HTTP_200_OK
+    assert [product['id'] for product in response.json()['results']] == [products[1].id, products[0].id,
+                                                                         products[2].id]
+
+    # the index follows the writes, a search only loads the catalog version and the page products
+    products[1].name = 'cotton'
+    products[1].save()
+    products[0].tags.add('tag1')
+    with django_assert_max_num_queries(2):
+        response = api_client.get(url, {'query': 'wool', 'tag': 'tag1'})
+    assert [product['id'] for product in response.json()['results']] == [products[0].id]
+    products[2].delete()
+    response = api_client.get(url, {'query': 'wool'})
+    assert [product['id'] for product in response.json()['results']] == [products[0].id]
+    assert response.json()['count'] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_search_index_ignores_rolled_back_writes(products, memory_search):
+    from django.db import transaction
+    from ..models import Product
+    products[0].name = 'wool'
+    products[0].save()
+    product_id = products[0].id
+    assert memory_search.search('wool') == [product_id]
+    with pytest.raises(ValueError), transaction.atomic():
+        Product.objects.create(name='wool blanket')
+        products[0].delete()
+        raise ValueError('rolled back')
+    assert memory_search.search('wool') == [product_id]
+
+
+def test_search_index_builds(memory_search, monkeypatch):
+    import threading
+    import time
+    from ..search_index import _IndexData
+    loads = []
+
+    def load():
+        loads.append(1)
+        time.sleep(0.05)
+        return _IndexData()
+    monkeypatch.setattr(memory_search, '_load', load)
+    # the concurrent first searches wait for a single build
+    threads = [threading.Thread(target=memory_search.search, args=('wool',)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+
+    def broken_load():
+        raise RuntimeError('the database is gone')
+    monkeypatch.setattr(memory_search, '_load', broken_load)
+    memory_search.rebuilding = True
+    memory_search.dirty.add(1)
+    thread = threading.Thread(target=memory_search._rebuild_in_background)
+    thread.start()
+    thread.join()
+    # a failed rebuild doesn't prevent the next ones
+    assert not memory_search.rebuilding and not memory_search.dirty
+    assert memory_search.data is not None
+
+
+@pytest.mark.django_db
+def test_products_keyset_pagination():
+    from ..models import Product
+    created = Product.objects.bulk_create([Product(name=f'p{i}', rate=i % 4) for i in range(12)])
+    expected = [product.id for product in sorted(created, key=lambda product: (-product.rate, product.id))]
+
+    api_client = APIClient()
+    response = api_client.get(reverse('index'), {'cursor': '', 'page_size': 5, 'count': 'exact'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['count'] == 12
+    assert response.json()['previous'] is None
+    ids, pages = [product['id'] for product in response.json()['results']], [response.json()]
+    while pages[-1]['next']:
+        pages.append(api_client.get(pages[-1]['next']).json())
+        ids += [product['id'] for product in pages[-1]['results']]
+    assert ids == expected
+    assert 'count' not in pages[-1]
+
+    # going back from the last page gives the previous pages again
+    previous = api_client.get(pages[-1]['previous']).json()
+    assert previous['results'] == pages[-2]['results']
+    previous = api_client.get(previous['previous']).json()
+    assert previous['results'] == pages[0]['results']
+    assert previous['previous'] is None
+
+    response = api_client.get(reverse('index'), {'cursor': 'not a cursor'})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+def test_products_keyset_pages_walk_the_index():
+    from django.db import connection
+    from ..models import Product
+    from ..response_cache import response_cache
+    from .fixtures import explain_ordered_queries
+    if connection.vendor != 'postgresql':
+        pytest.skip('the plans are the ones of postgres')
+    Product.objects.bulk_create([Product(name=f'p{i}', rate=i % 4) for i in range(12)])
+    api_client = APIClient()
+    first = api_client.get(reverse('index'), {'cursor': '', 'page_size': 5}).json()
+    for url in [f"{reverse('index')}?cursor=&page_size=5", first['next']]:
+        # not from the response cache
+        response_cache.clear()
+        plans = explain_ordered_queries(lambda: api_client.get(url), 'store_product')
+        assert plans
+        for plan in plans:
+            assert 'product_rate_id_idx' in plan and 'Sort' not in plan, plan
+
+
+@pytest.mark.django_db
+def test_product_detail_constant_queries(auth_api_user, assert_constant_queries):
+    from ..models import Product, ProductCoPurchase
+    from ..recommendations import build_recommendations
+    product = Product.objects.create(name='bed')
+    product.tags.add('wood')
+    url = reverse('RUD-product', kwargs={'pk': product.id})
+
+    def add_related():
+        for i in range(5):
+            other = Product.objects.create(name=f'chair {i}', rate=i)
+            other.tags.add('wood')
+            product.tags.add(f'tag {i}')
+            ProductCoPurchase.objects.create(product=product, other=other, score=i)
+        build_recommendations()
+
+    assert_constant_queries(lambda: auth_api_user.get(url), add_related)
+    data = auth_api_user.get(url).json()
+    assert len(data['tags']) == 6
+    assert [p['name'] for p in data['recommend']] == ['chair 4', 'chair 3', 'chair 2']
+    assert [p['name'] for p in data['bought_together']] == ['chair 4', 'chair 3', 'chair 2']
+
+
+@pytest.mark.django_db
+def test_import_products(auth_api_superuser, auth_api_user, tmp_path, memory_search, monkeypatch):
+    import json
+    from django.core.management import call_command
+    from ..management.commands import import_products as command
+    from ..models import Product
+    from ..recommendations import build_recommendations
+    rebuilds = []
+
+    def counted_build_recommendations():
+        rebuilds.append(True)
+        return build_recommendations()
+    monkeypatch.setattr(command, 'build_recommendations', counted_build_recommendations)
+    # built before the import, which updates it
+    assert memory_search.search('bed') == []
+    url = reverse('import-products')
+    body = '\n'.join([json.dumps({'sku': 'b1', 'name': 'bed', 'rate': 4, 'tags': ['wood', 'bedroom']}),
+                      json.dumps({'sku': 'c1', 'name': 'chair', 'tags': ['wood']}),
+                      '{not json',
+                      json.dumps({'name': '', 'rate': 1}),
+                      json.dumps({'name': 'lamp', 'description': 'a lamp'})])
+    assert auth_api_user.post(url, body, content_type='application/x-ndjson').status_code == \
+        status.HTTP_403_FORBIDDEN
+    response = auth_api_superuser.post(url, body, content_type='application/x-ndjson')
+    assert response.status_code == status.HTTP_200_OK
+    report = response.json()
+    assert (report['created'], report['updated'], report['skipped']) == (3, 0, 2)
+    assert [error['line'] for error in report['errors']] == [3, 4]
+    bed = Product.objects.get(sku='b1')
+    assert sorted(bed.tags.names()) == ['bedroom', 'wood']
+    # the recommendations of the imported products were refreshed
+    assert [p['name'] for p in auth_api_user.get(reverse('RUD-product', kwargs={'pk': bed.id})).json()['recommend']] \
+        == ['chair']
+    assert memory_search.search('bed') == [bed.id]
+    assert memory_search.search('bed', tag='bedroom') == [bed.id]
+
+    # the sku is the key of the updates, the tags of a row replace the product ones
+    path = tmp_path / 'products.csv'
+    path.write_text('sku,name,rate,tags\nb1,big bed,5,"wood,king size"\nd1,desk,2,\n')
+    call_command('import_products', str(path))
+    bed.refresh_from_db()
+    assert (bed.name, bed.rate) == ('big bed', 5)
+    assert sorted(bed.tags.names()) == ['king size', 'wood']
+    assert Product.objects.count() == 4
+    assert memory_search.search('bed', tag='bedroom') == []
+
+    # the whole catalog only on request
+    assert rebuilds == []
+    call_command('import_products', str(path), '--rebuild-recommendations')
+    assert rebuilds == [True]
+    assert [p['name'] for p in auth_api_user.get(reverse('RUD-product', kwargs={'pk': bed.id})).json()['recommend']] \
+        == ['chair']
+
+    response = auth_api_superuser.post(url, [{'sku': 'd1', 'name': 'desk', 'rate': 3}], format='json')
+    assert response.json()['updated'] == 1
+    assert Product.objects.get(sku='d1').rate == 3
+
+
+@pytest.mark.django_db
+def test_import_products_queries(assert_constant_queries):
+    from ..importer import import_products
+    imported = []
+
+    def rows():
+        start = len(imported)
+        imported.extend(range(start, start + 10))
+        return [(i, {'sku': f'p{i}', 'name': f'product {i}', 'tags': [f'tag {i}', 'all']}) for i in imported]
+
+    # the second import updates the products of the first and creates as many
+    assert_constant_queries(lambda: import_products(rows(), recommendations=False), lambda: None)
+
+
+@pytest.mark.django_db
+def test_resolve_tags_slug_collisions(django_assert_max_num_queries):
+    from ..importer import resolve_tags
+    Tag.objects.create(name='Red Wood', slug='red-wood')
+    Tag.objects.create(name='red wood!', slug='red-wood_1')
+    # the lookup of the names, a bulk insert and a lookup, the slugs query, a bulk insert and a lookup of the numbered ones
+    with django_assert_max_num_queries(6):
+        tags = resolve_tags(['red wood', 'red-wood', 'RED WOOD', 'oak'])
+    assert sorted(tag.slug for tag in tags.values()) == ['oak', 'red-wood_2', 'red-wood_3', 'red-wood_4']
+    assert all(tag.pk and tag.name == name for name, tag in tags.items())
+
+
+@pytest.mark.django_db
+def test_patch_product_only_changes_it(auth_api_superuser, products):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from ..models import Product
+    products[0].tags.add('wood', 'old')
+    url = reverse('RUD-product', kwargs={'pk': products[0].id})
+    with CaptureQueriesContext(connection) as queries:
+        response = auth_api_superuser.patch(url, data={'name': 'renamed', 'tags': ['wood', 'new']}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "store_product"')]
+    # only the changed column of that product is written
+    assert len(updates) == 1 and 'WHERE "store_product"."id" =' in updates[0] and '"rate"' not in updates[0]
+    assert Product.objects.get(pk=products[1].id).name == products[1].name
+    assert sorted(Product.objects.get(pk=products[0].id).tags.names()) == ['new', 'wood']
+
+
+@pytest.mark.django_db
+def test_batch_update_products(auth_api_superuser, auth_api_user, products):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from ..models import Product
+    url = reverse('batch-update-products')
+    changes = {'products': [{'id': products[0].id, 'rate': 4.5}, {'id': products[1].id, 'name': 'renamed'},
+                            {'id': 0, 'rate': 1}]}
+    assert auth_api_user.patch(url, changes, format='json').status_code == status.HTTP_403_FORBIDDEN
+    with CaptureQueriesContext(connection) as queries:
+        response = auth_api_superuser.patch(url, changes, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {'updated': sorted([products[0].id, products[1].id]), 'not_found': [0]}
+    assert len([q for q in queries.captured_queries if q['sql'].startswith('UPDATE "store_product"')]) == 1
+    first, second = Product.objects.get(pk=products[0].id), Product.objects.get(pk=products[1].id)
+    assert (first.name, first.rate) == (products[0].name, 4.5)
+    assert (second.name, second.rate) == ('renamed', products[1].rate)
+
+    duplicated = {'products': [{'id': products[0].id, 'rate': 1}, {'id': products[0].id, 'rate': 2}]}
+    assert auth_api_superuser.patch(url, duplicated, format='json').status_code == status.HTTP_400_BAD_REQUEST
+    max_length = Product._meta.get_field('name').max_length
+    too_long = {'products': [{'id': products[0].id, 'name': 'x' * (max_length + 1)}]}
+    assert auth_api_superuser.patch(url, too_long, format='json').status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db(transaction=True)
+def test_catalog_version_bumped_after_commit():
+    from django.db import transaction
+    from ..conditional import bump_version, get_versions, CATALOG
+    before = get_versions(CATALOG)[CATALOG][0]
+    with transaction.atomic():
+        bump_version(CATALOG)
+        bump_version(CATALOG)
+        # the shared row isn't written, nor locked, by the transaction
+        assert get_versions(CATALOG)[CATALOG][0] == before
+    assert get_versions(CATALOG)[CATALOG][0] == before + 2
+    with transaction.atomic():
+        bump_version(CATALOG)
+        transaction.set_rollback(True)
+    assert get_versions(CATALOG)[CATALOG][0] == before + 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_catalog_conditional_requests(products, auth_api_superuser, django_assert_max_num_queries):
+    api_client = APIClient()
+    list_url, detail_url = reverse('index'), reverse('RUD-product', kwargs={'pk': products[0].id})
+    response = api_client.get(list_url)
+    etag, last_modified = response['ETag'], response['Last-Modified']
+    detail_etag = api_client.get(detail_url)['ETag']
+    # answered from the version stamp, without loading the products
+    with django_assert_max_num_queries(1):
+        assert api_client.get(list_url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_304_NOT_MODIFIED
+    assert api_client.get(list_url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code == \
+        status.HTTP_304_NOT_MODIFIED
+    with django_assert_max_num_queries(1):
+        assert api_client.get(detail_url, HTTP_IF_NONE_MATCH=detail_etag).status_code == \
+            status.HTTP_304_NOT_MODIFIED
+
+    # a write to another product may change the recommendations of this one
+    auth_api_superuser.patch(reverse('RUD-product', kwargs={'pk': products[1].id}), {'tags': ['wood']},
+                             format='json')
+    assert api_client.get(list_url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_200_OK
+    assert api_client.get(detail_url, HTTP_IF_NONE_MATCH=detail_etag).status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db(transaction=True)
+def test_order_changes_the_pages_of_its_products(products, auth_api_user):
+    from ..models import Cart
+    api_client = APIClient()
+    urls = [reverse('RUD-product', kwargs={'pk': product.id}) for product in products[:3]]
+    etags = [api_client.get(url)['ETag'] for url in urls]
+    response = auth_api_user.post(reverse('list-create-cart'), data={'products': (products[0].id, products[1].id),
+                                                                     'status': Cart.Status.ORDERED})
+    assert response.status_code == status.HTTP_201_CREATED
+    # their bought together products changed, the page of a product not in the order didn't
+    assert [api_client.get(url, HTTP_IF_NONE_MATCH=etag).status_code for url, etag in zip(urls, etags)] == \
+        [status.HTTP_200_OK, status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_catalog_response_cache(products, auth_api_superuser, auth_api_user, settings,
+                                django_assert_max_num_queries):
+    from django.core.cache import caches
+    from ..response_cache import response_cache
+    api_client = APIClient()
+    url = reverse('index')
+    first = api_client.get(url, {'page_size': 2})
+    assert response_cache.stats['misses'] == 1
+    # the same parameters, normalized, only the version stamp is loaded
+    with django_assert_max_num_queries(1):
+        response = api_client.get(url, {'page_size': ' 2 ', 'tag': '', 'utm_source': 'mail'})
+    assert response.json()['results'] == first.json()['results']
+    assert response_cache.stats['local_hits'] == 1
+    # the links are the ones of the request, not of the one which was cached
+    assert response.json()['next'] == 'http://testserver/store/?page=2&page_size=+2+&tag=&utm_source=mail'
+    assert first.json()['next'] == 'http://testserver/store/?page=2&page_size=2'
+    # the users which are logged in aren't served from the cache
+    auth_api_user.get(url, {'page_size': 2})
+    assert (response_cache.stats['local_hits'], response_cache.stats['misses']) == (1, 1)
+
+    # a write moves the catalog to a new namespace
+    auth_api_superuser.patch(reverse('RUD-product', kwargs={'pk': products[0].id}), {'rate': 10}, format='json')
+    response = api_client.get(url, {'page_size': 2})
+    assert response.json()['results'][0]['id'] == products[0].id
+    assert response_cache.stats['misses'] == 2
+
+    # the shared tier serves the workers whose own cache doesn't have the response
+    settings.RESPONSE_CACHE_SHARED = 'default'
+    caches['default'].clear()
+    api_client.get(url, {'page_size': 3})
+    response_cache.entries.clear()
+    assert len(api_client.get(url, {'page_size': 3}).json()['results']) == 3
+    assert response_cache.stats['shared_hits'] == 1
+    metrics = auth_api_superuser.get(reverse('metrics')).content.decode()
+    assert 'response_cache_hits_total{tier="shared"} 1' in metrics
+
+
+@pytest.mark.django_db
+def test_cached_keyset_links(products):
+    from urllib.parse import urlsplit
+    from django.http import QueryDict
+    from ..response_cache import response_cache
+    url = reverse('index')
+    first = APIClient().get(url, {'page_size': 2, 'cursor': '', 'count': 'exact', 'ref': 'a'}).json()
+    response = APIClient().get(url, {'page_size': 2, 'cursor': '', 'count': 'exact', 'ref': 'b'}).json()
+    assert response_cache.stats['local_hits'] == 1
+    assert response['count'] == first['count']
+    # the next page doesn't count the results again
+    assert QueryDict(urlsplit(response['next']).query).dict() == \
+        {'cursor': QueryDict(urlsplit(first['next']).query)['cursor'], 'page_size': '2', 'ref': 'b'}
+
+
+def test_response_cache_is_bounded(settings):
+    from ..response_cache import ResponseCache
+    settings.RESPONSE_CACHE_SIZE = 2
+    cache = ResponseCache()
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    # b was the least recently used
+    assert list(cache.entries) == ['a', 'c'] and cache.stats['evictions'] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_tag_facets(auth_api_superuser, products, memory_search):
+    from ..facets import rebuild_tag_counts
+    from ..models import Product, TagCount
+    url = reverse('tags')
+    for name, tags in [('wood chair', ['wood', 'chair']), ('wood table', ['wood', 'table'])]:
+        assert auth_api_superuser.post(reverse('add-product'), {'name': name, 'tags': tags},
+                                       format='json').status_code == status.HTTP_201_CREATED
+    products[0].tags.add('wood', 'old')
+    assert APIClient().get(url).json() == [{'name': 'wood', 'count': 3}, {'name': 'chair', 'count': 1},
+                                           {'name': 'old', 'count': 1}, {'name': 'table', 'count': 1}]
+
+    # the counts follow the tag changes and the deletions
+    chair = Product.objects.get(name='wood chair')
+    auth_api_superuser.patch(reverse('RUD-product', kwargs={'pk': chair.id}), {'tags': ['chair', 'old']},
+                             format='json')
+    products[0].tags.clear()
+    auth_api_superuser.delete(reverse('RUD-product', kwargs={'pk': Product.objects.get(name='wood table').id}))
+    expected = [{'name': 'chair', 'count': 1}, {'name': 'old', 'count': 1}]
+    assert APIClient().get(url).json() == expected
+    counts = dict(TagCount.objects.values_list('tag__name', 'count'))
+    rebuild_tag_counts()
+    assert {name: count for name, count in counts.items() if count} == \
+        dict(TagCount.objects.values_list('tag__name', 'count'))
+
+    # restricted to the search results
+    assert APIClient().get(url, {'query': 'chair'}).json() == expected
+    assert APIClient().get(url, {'tag': 'chair', 'limit': 1}).json() == [{'name': 'chair', 'count': 1}]
+    assert APIClient().get(url, {'limit': 0}).status_code == status.HTTP_400_BAD_REQUEST
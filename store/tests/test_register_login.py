@@ -1,3 +1,5 @@
+import datetime
+
 import pytest
 from django.urls import reverse
 from rest_framework.test import APIClient
@@ -64,3 +66,89 @@ def test_register_login_logout():
 
 
 
+
+
+@pytest.mark.django_db
+def test_blacklist_sync_and_prune(auth_api_user, create_user, settings, django_assert_num_queries):
+    import datetime
+    from django.core.management import call_command
+    from django.utils.timezone import now
+    from rest_framework_simplejwt.tokens import AccessToken
+    from ..models import BlackListedToken
+    from ..tokens import revoked_tokens
+
+    url = reverse('retrieve-user')
+    response = auth_api_user.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    # the user and its type come from the token claims, checking the blacklist costs nothing
+    with django_assert_num_queries(0):
+        response = auth_api_user.get(url)
+    assert response.status_code == status.HTTP_200_OK
+
+    # a logout done by another worker is seen at the next sync
+    token = AccessToken(auth_api_user._credentials['HTTP_AUTHORIZATION'].split()[1])
+    BlackListedToken.objects.create(jti=token['jti'], user=create_user,
+                                    expires_at=now() + datetime.timedelta(minutes=5))
+    settings.TOKEN_BLACKLIST_SYNC_INTERVAL = 0
+    response = auth_api_user.get(url)
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    # a logout committed after one with a greater id is seen too
+    expires_at = now() + datetime.timedelta(minutes=5)
+    late_id = BlackListedToken.objects.create(jti='late', user=create_user, expires_at=expires_at).id
+    BlackListedToken.objects.filter(id=late_id).delete()
+    BlackListedToken.objects.create(jti='early', user=create_user, expires_at=expires_at)
+    assert revoked_tokens.is_revoked({'jti': 'early'})
+    BlackListedToken.objects.create(id=late_id, jti='late', user=create_user, expires_at=expires_at)
+    assert revoked_tokens.is_revoked({'jti': 'late'})
+
+    BlackListedToken.objects.create(jti='expired', user=create_user, expires_at=now() - datetime.timedelta(minutes=5))
+    call_command('prune_blacklisted_tokens')
+    assert sorted(BlackListedToken.objects.values_list('jti', flat=True)) == sorted([token['jti'], 'early', 'late'])
+    assert revoked_tokens.is_revoked(token)
+
+
+@pytest.mark.django_db
+def test_role_claims(create_user, create_superuser, django_assert_num_queries):
+    from django.contrib.auth.models import Group
+    from ..models import Cart
+    from ..tokens import revoked_tokens
+    api_client = APIClient()
+    response = api_client.post(reverse('token-obtain-pair'), {'username': create_user.username, 'password': '123'})
+    refresh = response.json()['refresh']
+    api_client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.json()['access'])
+    assert api_client.get(reverse('retrieve-user')).json()['user_type'] == 'customer'
+    cart = Cart.objects.create(customer=create_superuser, status=Cart.Status.ON_WAY)
+    url = reverse('delivery-cart', kwargs={'pk': cart.id})
+    assert api_client.put(url).status_code == status.HTTP_403_FORBIDDEN
+
+    # the tokens issued before the role change are revoked, a refresh gives the new role
+    create_user.groups.add(Group.objects.create(name='delivery'))
+    # issued in the same second as the revocation, but before it
+    assert api_client.get(reverse('retrieve-user')).status_code == status.HTTP_403_FORBIDDEN
+    response = api_client.post(reverse('token_refresh'), {'refresh': refresh})
+    assert response.status_code == status.HTTP_200_OK
+    api_client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.json()['access'])
+    assert api_client.get(reverse('retrieve-user')).json()['user_type'] == 'delivery'
+
+    # delivery authentication and authorization don't query the database
+    with django_assert_num_queries(2):  # loading the cart and updating its status
+        response = api_client.put(url)
+    assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('change', [{'is_superuser': False}, {'is_staff': False}, {'is_active': False}])
+def test_tokens_revoked_when_the_claimed_fields_change(auth_api_superuser, create_superuser, change):
+    url = reverse('list-create-cart-admin')
+    assert auth_api_superuser.get(url).status_code == status.HTTP_200_OK
+    # a save which doesn't change them keeps the tokens
+    create_superuser.email = 'admin@example.com'
+    create_superuser.save()
+    assert auth_api_superuser.get(url).status_code == status.HTTP_200_OK
+
+    user = User.objects.get(pk=create_superuser.pk)
+    for field, value in change.items():
+        setattr(user, field, value)
+    user.save()
+    assert auth_api_superuser.get(url).status_code in (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN)
@@ -0,0 +1,182 @@
+import datetime
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_init, post_save
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+from django.utils.timezone import now
+from rest_framework_simplejwt.authentication import JWTAuthentication, JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import BlackListedToken, UserTokenRevocation
+
+
+def token_expiry(token):
+    return datetime.datetime.fromtimestamp(token['exp'], tz=datetime.timezone.utc)
+
+
+def user_role(user):
+    if user.is_superuser:
+        return 'admin'
+    elif user.groups.filter(name='delivery').exists():
+        return 'delivery'
+    return 'customer'
+
+
+def add_user_claims(token, user):
+    token['role'] = user_role(user)
+    token['username'] = user.username
+    token['is_staff'] = user.is_staff
+    token['is_superuser'] = user.is_superuser
+    # iat is in whole seconds, too coarse to tell a token issued just before a revocation from one issued after
+    token['issued_at'] = now().timestamp()
+    return token
+
+
+class RoleTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        return add_user_claims(super().get_token(user), user)
+
+
+class RoleTokenRefreshSerializer(TokenRefreshSerializer):
+    """the refreshed access token gets the current role of the user, not the one of the refresh token"""
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: refresh[api_settings.USER_ID_CLAIM]}).first()
+        if user is None or not user.is_active:
+            raise AuthenticationFailed('User not found or inactive', code='user_not_found')
+        access = refresh.access_token
+        access.set_iat()
+        return {'access': str(add_user_claims(access, user))}
+
+
+class RoleTokenUser(TokenUser):
+    @cached_property
+    def role(self):
+        return self.token.get('role', 'customer')
+
+
+class RoleTokenAuthentication(JWTStatelessUserAuthentication):
+    """
+    authenticate from the token claims without loading the user, for views which don't need a User instance.
+    tokens issued before the role claims existed still load the user
+    """
+
+    def get_user(self, validated_token):
+        if 'role' not in validated_token:
+            return JWTAuthentication.get_user(self, validated_token)
+        return super().get_user(validated_token)
+
+
+class RevokedTokens:
+    """
+    in-process copy of the blacklisted tokens which haven't expired yet and of the recent per user revocations,
+    so checking a token costs no query. it's synchronized with the database every TOKEN_BLACKLIST_SYNC_INTERVAL
+    seconds by loading again every blacklisted token which hasn't expired (pruning keeps them few), so a logout
+    made on another worker is seen after at most that delay, whatever the order the logouts commit in
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.revoked = {}
+        self.users_revoked_before = {}
+        self.synced_at = None
+
+    def sync(self):
+        current = now()
+        # a high-water mark on the ids would miss the rows committed after a row with a greater id
+        revoked = dict(BlackListedToken.objects.filter(expires_at__gt=current).values_list('jti', 'expires_at'))
+        # the revocations of this worker whose transaction isn't committed yet are kept
+        revoked.update((jti, expires_at) for jti, expires_at in self.revoked.items() if expires_at > current)
+        self.revoked = revoked
+        # older revocations only concern expired access tokens
+        self.users_revoked_before = dict(UserTokenRevocation.objects.filter(
+            revoked_before__gt=current - api_settings.ACCESS_TOKEN_LIFETIME).values_list('user_id', 'revoked_before'))
+        self.synced_at = time.monotonic()
+
+    def is_revoked(self, token):
+        interval = getattr(settings, 'TOKEN_BLACKLIST_SYNC_INTERVAL', 5)
+        with self.lock:
+            if self.synced_at is None or time.monotonic() - self.synced_at > interval:
+                self.sync()
+            if token['jti'] in self.revoked:
+                return True
+            revoked_before = self.users_revoked_before.get(token.get(api_settings.USER_ID_CLAIM))
+        if revoked_before is None:
+            return False
+        issued_at = token.get('issued_at')
+        if issued_at is None:
+            # only iat and its one second resolution, the tokens issued in the second of the revocation are revoked
+            return token.get('iat', 0) < math.ceil(revoked_before.timestamp())
+        return issued_at < revoked_before.timestamp()
+
+    def revoke(self, token):
+        jti, expires_at = token['jti'], token_expiry(token)
+        BlackListedToken.objects.get_or_create(jti=jti, defaults={'user_id': token[api_settings.USER_ID_CLAIM],
+                                                                  'expires_at': expires_at})
+        with self.lock:
+            self.revoked[jti] = expires_at
+
+    def revoke_user_tokens(self, user_ids):
+        revoked_before = now()
+        UserTokenRevocation.objects.bulk_create(
+            [UserTokenRevocation(user_id=user_id, revoked_before=revoked_before) for user_id in user_ids],
+            update_conflicts=True, unique_fields=['user'], update_fields=['revoked_before'])
+        with self.lock:
+            self.users_revoked_before.update({user_id: revoked_before for user_id in user_ids})
+
+
+revoked_tokens = RevokedTokens()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def revoke_tokens_on_groups_change(sender, instance, action, reverse, pk_set, **kwargs):
+    # the role claim of the tokens issued before the change may be wrong
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        user_ids = [instance.pk]
+    elif pk_set:
+        user_ids = list(pk_set)
+    else:
+        user_ids = list(instance.user_set.values_list('pk', flat=True))
+    if user_ids:
+        revoked_tokens.revoke_user_tokens(user_ids)
+
+
+# the user fields the token claims are derived from, besides the groups
+CLAIMED_USER_FIELDS = ('is_active', 'is_staff', 'is_superuser')
+
+
+@receiver(post_init, sender=User)
+def remember_claimed_user_fields(sender, instance, **kwargs):
+    instance._claimed_fields = tuple(instance.__dict__.get(field) for field in CLAIMED_USER_FIELDS)
+
+
+@receiver(post_save, sender=User)
+def revoke_tokens_on_claims_change(sender, instance, created, **kwargs):
+    # a demoted or deactivated user keeps its access until its tokens expire otherwise, a queryset update
+    # sends no signal and must revoke the tokens itself
+    claimed = tuple(getattr(instance, field) for field in CLAIMED_USER_FIELDS)
+    if not created and claimed != instance._claimed_fields:
+        revoked_tokens.revoke_user_tokens([instance.pk])
+    instance._claimed_fields = claimed
+
+
+def prune_blacklisted_tokens():
+    """delete the blacklisted tokens which expired anyway, returns how many were deleted"""
+    deleted, _ = BlackListedToken.objects.filter(expires_at__lte=now()).delete()
+    UserTokenRevocation.objects.filter(revoked_before__lte=now() - api_settings.REFRESH_TOKEN_LIFETIME).delete()
+    return deleted
@@ -7,10 +7,15 @@ urlpatterns = [
     path('carts/<int:pk>/', views.RetrieveUpdateDestroyCartView.as_view(), name='RUD-cart'),
     path('carts/', views.ListCreateCartView.as_view(), name='list-create-cart'),
     path('products/<int:pk>/', views.ProductView.as_view(), name='RUD-product'),
+    path('products/import/', views.ProductImportView.as_view(), name='import-products'),
+    path('products/batch/', views.ProductBatchUpdateView.as_view(), name='batch-update-products'),
+    path('tags/', views.TagFacetsView.as_view(), name='tags'),
     path('register/', views.RegisterView.as_view(), name='register'),
     path('carts/admin/', views.ListCartAdminView.as_view(), name='list-create-cart-admin'),
     path('carts/admin/<int:pk>/', views.RUDCartAdmin.as_view(), name='RUD-cart-admin'),
     path('delivery/carts/<int:pk>/', views.DeliveryCartView.as_view(), name='delivery-cart'),
+    path('delivery/carts/', views.DeliveryCartBulkView.as_view(), name='delivery-carts'),
     path('user/', views.RetrieveUserView.as_view(), name='retrieve-user'),
-    path('logout/', views.LogoutView.as_view(), name='logout')
+    path('logout/', views.LogoutView.as_view(), name='logout'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
 ]
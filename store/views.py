@@ -1,69 +1,150 @@
+import codecs
+
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.models import User
-from django.contrib.postgres.search import TrigramSimilarity
-from django.db.models import Q, F
 from django.core.exceptions import ObjectDoesNotExist
 from rest_framework.throttling import UserRateThrottle
 from rest_framework.views import APIView
+from django.http import HttpResponse
 
 from rest_framework import generics
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.serializers import ValidationError
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from taggit.models import Tag
 
-from .models import Product, Cart, BlackListedToken
+from .models import Product, Cart
 from . import serializers
 from . import permissions
-
-
-class ResultsSetPagination(PageNumberPagination):
-    page_size = 5
-    page_size_query_param = 'page_size'
-    max_page_size = 10
-
-
-class ProductListView(generics.ListAPIView):
+from . import search
+from .recommendations import recommending, refresh_recommendations
+from .pagination import ResultsSetPagination
+from .tokens import revoked_tokens, RoleTokenAuthentication
+from .metrics import metrics
+from .importer import READERS, import_products
+from .carts import cart_lock
+from .conditional import ConditionalGetMixin, get_versions, co_purchases_of, CATALOG, CO_PURCHASES
+from .response_cache import CachedGetMixin
+from .facets import tag_facets
+
+
+def catalog_products(query_params):
+    """
+    the products matching the query and tag parameters, a queryset or the SearchResults of the
+    in-process index, and the keyset ordering of a search (None when there is no query)
+    """
+    my_query_set = Product.objects.defer('search_vector').order_by('id')
+    query = query_params.get('query')
+    tag = query_params.get('tag')
+
+    if query is not None and query != "":
+        mode = query_params.get('mode', 'fuzzy')
+        if mode not in search.SEARCH_MODES:
+            raise ValidationError({'mode': f'mode must be one of {search.SEARCH_MODES}'})
+        if search.search_engine(mode) == 'memory':
+            return search.search_products_in_memory(query, tag=tag or None), None
+
+    if tag is not None and tag !="":
+        try:
+            tag_id = Tag.objects.get(name=tag)
+            my_query_set = my_query_set.filter(tags__in=[tag_id])
+        except ObjectDoesNotExist as e:
+            my_query_set = Product.objects.none()
+
+    if query is not None and query != "":
+        return search.search_products(my_query_set, query, mode), search.SEARCH_ORDERINGS[mode]
+
+    return my_query_set, None
+
+
+class CatalogMixin(CachedGetMixin):
+    def get_validators(self):
+        version, updated_at = get_versions(CATALOG)[CATALOG]
+        return f'catalog-{version}', updated_at
+
+
+class ProductListView(CatalogMixin, generics.ListAPIView):
     permission_classes = []
     serializer_class = serializers.ProductListSerializer
     pagination_class = ResultsSetPagination
+    keyset_ordering = ('-rate', 'id')
+    query_budget = {'GET': 8}
+    cache_params = ('query', 'tag', 'mode', 'page', 'page_size', 'cursor', 'count')
 
     def get_queryset(self):
-        my_query_set = Product.objects.all().order_by('id')
-        query = self.request.query_params.get('query')
-        tag = self.request.query_params.get('tag')
+        products, keyset_ordering = catalog_products(self.request.query_params)
+        if keyset_ordering is not None:
+            self.keyset_ordering = keyset_ordering
+        return products
 
-        if tag is not None and tag !="":
-            try:
-                tag_id = Tag.objects.get(name=tag)
-                my_query_set = my_query_set.filter(tags__in=[tag_id])
-            except ObjectDoesNotExist as e:
-                my_query_set = Product.objects.none()
 
-        if query is not None and query != "":
-            my_query_set = my_query_set.annotate(
-                similarity1=TrigramSimilarity('name', query),
-                similarity2=TrigramSimilarity('description', query),
-            ).filter(Q(similarity1__gt=0.1) | Q(similarity2__gt=0.1))\
-                .annotate(similaritysum=F('similarity1')*2 + F('similarity2'))\
-                .order_by('-similaritysum', '-similarity1', '-similarity2', '-rate')
+class TagFacetsView(CatalogMixin, generics.ListAPIView):
+    """
+    the tags with their number of products, most used first, of the whole catalog or of the products
+    matching the query and tag parameters (the ones of the product list) when given
+    """
+    permission_classes = []
+    serializer_class = serializers.TagFacetSerializer
+    pagination_class = None
+    # a search may first (re)build the in-process index
+    query_budget = {'GET': 6}
+    cache_params = ('query', 'tag', 'mode', 'limit')
+    default_limit = 50
+    max_limit = 1000
 
-        return my_query_set
+    def get_queryset(self):
+        params = self.request.query_params
+        try:
+            limit = int(params.get('limit', self.default_limit))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= self.max_limit:
+            raise ValidationError({'limit': f'limit must be between 1 and {self.max_limit}'})
+        products = None
+        if params.get('query') or params.get('tag'):
+            products, _ = catalog_products(params)
+        return tag_facets(products, limit)
 
 
 class AddProductView(generics.CreateAPIView):
+    authentication_classes = [RoleTokenAuthentication]
     queryset = Product.objects.all()
     permission_classes = [IsAuthenticated, permissions.IsTokenValid, IsAdminUser]
     serializer_class = serializers.ProductSerializer
 
 
-class RetrieveUpdateDestroyCartView(generics.RetrieveUpdateDestroyAPIView):
+class RetrieveUpdateDestroyCartView(ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
+    """the ETag of the cart can be sent in If-Match to update it only if nobody changed it since"""
     queryset = Cart.objects.all()
     permission_classes = [IsAuthenticated, permissions.IsOwner]
     serializer_class = serializers.CartSerializer
     throttle_classes = [UserRateThrottle]
+    query_budget = {'GET': 6}
+
+    def get_object(self):
+        # loaded once for the validators and the response
+        if getattr(self, 'cart', None) is None:
+            self.cart = super().get_object()
+        return self.cart
+
+    def get_validators(self):
+        cart = self.get_object()
+        # the items show the names of the products
+        version, _ = get_versions(CATALOG)[CATALOG]
+        return f'cart-{cart.pk}-{cart.version}-{version}', None
+
+    def update(self, request, *args, **kwargs):
+        if 'HTTP_IF_MATCH' not in request.META:
+            response = super().update(request, *args, **kwargs)
+        else:
+            # the version checked is the one the update applies to
+            with cart_lock(self.get_object()):
+                response = self.conditional_response(request) or super().update(request, *args, **kwargs)
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        self.load_validators()
+        return self.set_validators(response)
 
     def destroy(self, request, *args, **kwargs):
         if 'pk' not in kwargs:
@@ -79,16 +160,71 @@ class ListCreateCartView(generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = serializers.CartSerializer
     pagination_class = ResultsSetPagination
+    keyset_ordering = ('order_date', 'id')
+    query_budget = {'GET': 6}
 
     def get_queryset(self):
         user = self.request.user
         return Cart.objects.filter(customer=user)
 
 
-class ProductView(generics.RetrieveUpdateDestroyAPIView):
+class ProductImportView(APIView):
+    """
+    create or update (by sku) products in bulk, the body is a JSON list of products, NDJSON
+    (application/x-ndjson) or CSV (text/csv), the last two are read as a stream
+    """
+    authentication_classes = [RoleTokenAuthentication]
+    permission_classes = [IsAuthenticated, permissions.IsTokenValid, IsAdminUser]
+    stream_formats = {'application/x-ndjson': 'ndjson', 'application/ndjson': 'ndjson', 'text/csv': 'csv'}
+
+    def post(self, request, format=None):
+        stream_format = self.stream_formats.get(request.content_type.split(';')[0].strip())
+        if stream_format is not None:
+            lines = codecs.iterdecode(request.stream or (), 'utf-8')
+            report = import_products(READERS[stream_format](lines))
+        elif isinstance(request.data, list):
+            report = import_products(READERS['json'](request.data))
+        else:
+            raise ValidationError({'details': 'expected a list of products'})
+        response_status = status.HTTP_400_BAD_REQUEST if report['skipped'] and not \
+            (report['created'] or report['updated']) else status.HTTP_200_OK
+        return Response(data=report, status=response_status)
+
+
+class ProductBatchUpdateView(APIView):
+    """apply changes to many products at once, e.g. {"products": [{"id": 1, "rate": 4.5}, ...]}"""
+    authentication_classes = [RoleTokenAuthentication]
+    permission_classes = [IsAuthenticated, permissions.IsTokenValid, IsAdminUser]
+
+    def patch(self, request, format=None):
+        serializer = serializers.ProductBatchUpdateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(data=serializer.save(), status=status.HTTP_200_OK)
+
+
+class ProductView(CachedGetMixin, generics.RetrieveUpdateDestroyAPIView):
+    authentication_classes = [RoleTokenAuthentication]
     permission_classes = [permissions.IsAdminOrReadOnly]
     serializer_class = serializers.ProductSerializer
     queryset = Product.objects.all()
+    query_budget = {'GET': 6}
+
+    def get_validators(self):
+        # the page shows the recommendations and the bought together products, they change with
+        # other products, a deleted product changes the catalog version so it isn't answered with 304.
+        # an order only bumps the co-purchases of its own products
+        names = (CATALOG, CO_PURCHASES, co_purchases_of(self.kwargs['pk']))
+        versions = get_versions(*names)
+        stamps = [f'{versions[name][0]}' for name in names]
+        updated = [updated_at for _, updated_at in versions.values() if updated_at is not None]
+        return f'product-{self.kwargs["pk"]}-{"-".join(stamps)}', max(updated, default=None)
+
+    def perform_destroy(self, instance):
+        product_id = instance.id
+        # their recommendations of the product are deleted with it
+        recommending_ids = recommending([product_id])
+        instance.delete()
+        refresh_recommendations([product_id], recommending_ids)
 
 
 class RegisterView(generics.CreateAPIView):
@@ -98,34 +234,55 @@ class RegisterView(generics.CreateAPIView):
 
 
 class RegisterAdminView(generics.CreateAPIView):
+    authentication_classes = [RoleTokenAuthentication]
     permission_classes = [IsAuthenticated, permissions.IsTokenValid, IsAdminUser]
     serializer_class = serializers.RegisterSerializer
     queryset = User.objects.all()
 
 
 class ListCartAdminView(generics.ListCreateAPIView):
+    authentication_classes = [RoleTokenAuthentication]
     permission_classes = [IsAuthenticated, permissions.IsTokenValid, IsAdminUser]
     serializer_class = serializers.CartAdminSerializer
     queryset = Cart.objects.all()
     pagination_class = ResultsSetPagination
+    keyset_ordering = ('order_date', 'id')
+    query_budget = {'GET': 6}
 
 
 class RUDCartAdmin(generics.RetrieveUpdateDestroyAPIView):
+    authentication_classes = [RoleTokenAuthentication]
     permission_classes = [IsAuthenticated, permissions.IsTokenValid, IsAdminUser]
     serializer_class = serializers.CartAdminSerializer
     queryset = Cart.objects.all()
+    query_budget = {'GET': 5}
 
 
 class DeliveryCartView(generics.RetrieveUpdateAPIView):
+    authentication_classes = [RoleTokenAuthentication]
     permission_classes = [IsAuthenticated, permissions.IsTokenValid, permissions.IsDelivery]
     serializer_class = serializers.DeliveryCartSerializer
     queryset = Cart.objects.all()
+    query_budget = {'GET': 3, 'PUT': 4}
+
+
+class DeliveryCartBulkView(APIView):
+    authentication_classes = [RoleTokenAuthentication]
+    permission_classes = [IsAuthenticated, permissions.IsTokenValid, permissions.IsDelivery]
+    query_budget = {'POST': 3}
+
+    def post(self, request, format=None):
+        serializer = serializers.DeliveryCartBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(data=serializer.save(), status=status.HTTP_200_OK)
 
 
 class RetrieveUserView(APIView):
+    authentication_classes = [RoleTokenAuthentication]
     permission_classes = [IsAuthenticated, permissions.IsTokenValid]
     serializer_class = serializers.DeliveryCartSerializer
     queryset = User.objects.all()
+    query_budget = {'GET': 2}
 
     def get(self, request, format=None):
         return Response(data=serializers.RetrieveUserSerializer(request.user).data, status=200)
@@ -135,7 +292,13 @@ class LogoutView(APIView):
     permission_classes = [IsAuthenticated, permissions.IsTokenValid]
 
     def post(self, request, format=None):
-        user = request.user
-        token = request.auth
-        BlackListedToken.objects.create(user=user, token=token)
+        revoked_tokens.revoke(request.auth)
         return Response(data='user logged out!', status=200)
+
+
+class MetricsView(APIView):
+    authentication_classes = [RoleTokenAuthentication]
+    permission_classes = [IsAuthenticated, permissions.IsTokenValid, IsAdminUser]
+
+    def get(self, request, format=None):
+        return HttpResponse(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')